@@ -2,10 +2,19 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import re
+import sys
+
+sys.path.append('../shared/RSV_data_analysis')
+from coverage_store import CoverageStore, is_coverage_store
 
 # Load the data
 
-df = pd.read_csv("../../preprint/data/coverage/collected_rsv_coverage_rsv_a_2023_2024_PREPRINT.tsv")
+# binary season coverage store (extract_coverage_RSV_Vpipe.py --store) if available, no coverage text to parse
+coverage_store_dir = "../../preprint/data/coverage/coverage_store_rsv_a_2023_2024_PREPRINT"
+if is_coverage_store(coverage_store_dir):
+    df = CoverageStore(coverage_store_dir).to_frame()
+else:
+    df = pd.read_csv("../../preprint/data/coverage/collected_rsv_coverage_rsv_a_2023_2024_PREPRINT.tsv")
 print(np.unique(df['sample']))
 #print(df)
 # add one to avoid log of zero
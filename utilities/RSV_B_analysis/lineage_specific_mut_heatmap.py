@@ -5,6 +5,12 @@ import numpy as np
 import matplotlib.pylab as plt
 import json
 import matplotlib.patches as mpatches
+import sys
+
+sys.path.append('../shared/RSV_data_analysis')
+from coverage_store import CoverageStore, is_coverage_store
+from mutation_catalog import MutationCatalog
+from timeline_io import read_timeline_matrices, frequency_table
 
 
 with open('../shared/RSV_data_analysis/rsv_definitions/RSVB_nucleotide_mutations_0.9.json', 'r') as file:
@@ -15,58 +21,39 @@ swiss_clades = "B.D.E.1" # lineage for which all signature mutation frequencies
 
 COVERAGE_THRESHOLD = 30
 
-coverage = pd.read_csv("../../preprint/data/coverage/collected_rsv_coverage_rsv_b_2022_2023_PREPRINT.tsv")
-timeline_tsv_mutation = pd.read_csv('../../preprint/data/timeline_tsv/RSV_B/timeline_mutation_rsv_b_2022_2023_PREPRINT.tsv',
-                                    sep='\t', usecols=['submissionId',
-                                                       'date',
-                                                       'location',
-                                                       'nucleotideMutationFrequency',
-                                                       'aminoAcidMutationFrequency'])
-
-timeline_tsv_mutation = timeline_tsv_mutation.sort_values(by=['location', 'date'],
-                                                          ascending=[False, True])
-
-
-timeline_tsv_mutation_sorted = {}
-timeline_tsv_aminoacid_mutation_sorted = {}
-for _, row in timeline_tsv_mutation.iterrows():#['date', 'nucleotideMutationFrequency']:
-    nucleotide_mut_freq = row['nucleotideMutationFrequency']
-    aminoacid_mut_freq = row['aminoAcidMutationFrequency']
+# binary season coverage store (extract_coverage_RSV_Vpipe.py --store) if available, no coverage text to parse
+coverage_store_dir = "../../preprint/data/coverage/coverage_store_rsv_b_2022_2023_PREPRINT"
+if is_coverage_store(coverage_store_dir):
+    coverage_store = CoverageStore(coverage_store_dir)
 
-    if pd.isna(nucleotide_mut_freq) or nucleotide_mut_freq == '':
-      #  print(row)
-        continue
-    date = row['date']
-    location = row['location']
-    id = row['submissionId']
+    def coverage_at(sample, position):
+        return coverage_store.matrix[coverage_store.samples.get_loc(sample), position - 1]
+else:
+    coverage = pd.read_csv("../../preprint/data/coverage/collected_rsv_coverage_rsv_b_2022_2023_PREPRINT.tsv")
 
-    sample_muts = json.loads(row['nucleotideMutationFrequency'])
-    sample_aminoacid_muts = json.loads(row['aminoAcidMutationFrequency'])
+    def coverage_at(sample, position):
+        return coverage.loc[(coverage['pos'] == position) & (coverage['sample'] == sample), 'coverage'].values[0]
+# timeline .tsv with json columns, or a long .parquet/.arrow table (make_mutation_tsv.py --format)
+timeline_tsv_mutation, mutation_frequencies = read_timeline_matrices(
+    '../../preprint/data/timeline_tsv/RSV_B/timeline_mutation_rsv_b_2022_2023_PREPRINT.tsv',
+    columns=['nucleotideMutationFrequency'], usecols=['submissionId', 'date', 'location'], dropna=True)
 
-    sample_muts_sorted = dict(sorted(sample_muts.items(),
-                                               key=lambda x: int(re.findall(r'\d+', x[0])[0]) # sort by SNP location
-                                               )
-                                        )
-    sample_aminoacid_muts_sorted = dict(sorted(sample_aminoacid_muts.items(),
-                                               key=lambda x: int(re.findall(r'\d+', x[0])[-1]) #sort by the last number (SNP location)
-                                               )
-                                        )
-    timeline_tsv_mutation_sorted[id] = sample_muts_sorted
-    timeline_tsv_aminoacid_mutation_sorted[id] = sample_aminoacid_muts_sorted
+timeline_tsv_mutation = timeline_tsv_mutation.sort_values(by=['location', 'date'],
+                                                          ascending=[False, True])
 
 
+# mutation keys are parsed once, shared by sorting and filtering below
+catalog = MutationCatalog()
 
-timeline_tsv_mutation_sorted_df = pd.DataFrame.from_dict(timeline_tsv_mutation_sorted)
-timeline_tsv_aminoacid_mutation_sorted_df = pd.DataFrame.from_dict(timeline_tsv_aminoacid_mutation_sorted)
-df = timeline_tsv_mutation_sorted_df.transpose()
+# samples x mutations frequencies in the sorted sample order, sorted by SNP location
+df = frequency_table(mutation_frequencies['nucleotideMutationFrequency'].take_samples(timeline_tsv_mutation.index),
+                     timeline_tsv_mutation['submissionId'].to_numpy())
+df = df[catalog.sort_by_position(df.columns)]
 
 #
 
 # drop deletions and insertions:
-for mutation in df.columns:
-
-    if (len(re.findall(r'[A-Za-z]+', mutation)[0]) > 1) or (len(re.findall(r'[A-Za-z]+', mutation)[1]) > 1):
-        df = df.drop(columns=mutation)
+df = df.loc[:, ~catalog.is_indel(df.columns)]
 
 # mutations that are not in B.D.E.1 definition are dropped -- we are plotting only lineage signature mutation frequencies
 for mutation in df.columns:
@@ -80,11 +67,11 @@ for mutation in clades_definitions[swiss_clades]:
 
     if mutation not in df.columns:
         df[mutation] = np.nan
-        position = int(re.findall(r'\d+', mutation)[0])
+        position = catalog.positions([mutation])[0]
         print(position)
         for sample in df.index:
 
-            if (coverage.loc[(coverage['pos'] == position) & (coverage['sample'] == sample), 'coverage'].values[0] >= COVERAGE_THRESHOLD):
+            if (coverage_at(sample, position) >= COVERAGE_THRESHOLD):
                 if (pd.isna(df.loc[sample, mutation])):
                     df.loc[sample, mutation] = 0.0
 
@@ -101,7 +88,7 @@ df.index = [re.sub(r'^10_', 'ZH_', str(ind)) for ind in df.index]
 df_full_genome_plot = df
 
 # dataframe of mutation definitions
-sorted_columns = sorted(df_full_genome_plot.columns, key = lambda x: int(re.findall(r'\d+', x)[0]))
+sorted_columns = catalog.sort_by_position(df_full_genome_plot.columns)
 df_full_genome_plot = df_full_genome_plot[sorted_columns]
 
 mutations_df = pd.DataFrame(0, index=[swiss_clades], columns=df_full_genome_plot.columns)
@@ -4,6 +4,11 @@ import seaborn as sns
 import matplotlib.pylab as plt
 import json
 import matplotlib.patches as mpatches
+import sys
+
+sys.path.append('../shared/RSV_data_analysis')
+from mutation_catalog import MutationCatalog
+from timeline_io import read_timeline_matrices, frequency_table
 
 
 with open('../shared/RSV_data_analysis/rsv_definitions/RSVB_nucleotide_mutations_0.9.json', 'r') as file:
@@ -11,69 +16,36 @@ with open('../shared/RSV_data_analysis/rsv_definitions/RSVB_nucleotide_mutations
 
 european_clades = ["B.D", "B.D.1", "B.D.1.1", "B.D.4", "B.D.4.1", "B.D.4.1.1", "B.D.E.1", "B.D.E.2", "B.D.E.4"]
 
-timeline_tsv_mutation = pd.read_csv(
+# timeline .tsv with json columns, or a long .parquet/.arrow table (make_mutation_tsv.py --format)
+timeline_tsv_mutation, mutation_frequencies = read_timeline_matrices(
     '../../preprint/data/timeline_tsv/RSV_B/timeline_mutation_rsv_b_2022_2023_PREPRINT.tsv',
-                                    sep='\t',
-                                    usecols=['date', 'location','nucleotideMutationFrequency', 'aminoAcidMutationFrequency'])
-timeline_tsv_mutation = timeline_tsv_mutation.sort_values(by=['location', 'date'],
-                                                          ascending=[False, True])
-
-timeline_tsv_mutation_sorted = {}
-timeline_tsv_aminoacid_mutation_sorted = {}
-for _, row in timeline_tsv_mutation.iterrows():#['date', 'nucleotideMutationFrequency']:
-
-    nucleotide_mut_freq = row['nucleotideMutationFrequency']
-    aminoacid_mut_freq = row['aminoAcidMutationFrequency']
-
-    if pd.isna(nucleotide_mut_freq) or nucleotide_mut_freq == '':
-      #  print(row)
-        continue
-    date = row['date']
-    location = row['location']
-
-    sample_muts = json.loads(row['nucleotideMutationFrequency'])
-    sample_aminoacid_muts = json.loads(row['aminoAcidMutationFrequency'])
-
-    sample_muts_sorted = dict(sorted(sample_muts.items(),
-                                               key=lambda x: int(re.findall(r'\d+', x[0])[0]) # sort by SNP location
-                                               )
-                                        )
-    sample_aminoacid_muts_sorted = dict(sorted(sample_aminoacid_muts.items(),
-                                               key=lambda x: int(re.findall(r'\d+', x[0])[-1]) #sort by the last number (SNP location)
-                                               )
-                                        )
-    timeline_tsv_mutation_sorted[str(date)+"_"+location.split(" ")[1]] = sample_muts_sorted
-    timeline_tsv_aminoacid_mutation_sorted[str(date)+"_"+location.split(" ")[1]] = sample_aminoacid_muts_sorted
-
-
-
-timeline_tsv_mutation_sorted_df = pd.DataFrame.from_dict(timeline_tsv_mutation_sorted)
-timeline_tsv_aminoacid_mutation_sorted_df = pd.DataFrame.from_dict(timeline_tsv_aminoacid_mutation_sorted)
-df = timeline_tsv_mutation_sorted_df.transpose()
-df_aa = timeline_tsv_aminoacid_mutation_sorted_df.transpose()
+    usecols=['date', 'location'], dropna=True)
+timeline_tsv_mutation = timeline_tsv_mutation.sort_values(by=['location', 'date'], ascending=[False, True])
+
+# mutation keys are parsed once, shared by sorting and filtering below
+catalog = MutationCatalog()
+
+# samples x mutations frequencies in the sorted sample order, sorted by SNP location
+# (amino acid mutations by the SNP location at their end)
+sample_labels = (timeline_tsv_mutation['date'].astype(str) + "_" +
+                 timeline_tsv_mutation['location'].str.split(" ").str[1]).to_numpy()
+df = frequency_table(mutation_frequencies['nucleotideMutationFrequency'].take_samples(timeline_tsv_mutation.index),
+                     sample_labels)
+df = df[catalog.sort_by_position(df.columns)]
+df_aa = frequency_table(mutation_frequencies['aminoAcidMutationFrequency'].take_samples(timeline_tsv_mutation.index),
+                        sample_labels)
+df_aa = df_aa[catalog.sort_by_position(df_aa.columns)]
 
 # drop deletions and insertions:
-for mutation in df.columns:
-
-    if (len(re.findall(r'[A-Za-z]+', mutation)[0]) > 1) or (len(re.findall(r'[A-Za-z]+', mutation)[1]) > 1):
-        df = df.drop(columns=mutation)
-        df_aa = df_aa.loc[:, ~df_aa.columns.str.contains(f'_{re.escape(mutation)}')]
+df = df.loc[:, ~catalog.is_indel(df.columns)]
+df_aa = df_aa.loc[:, ~catalog.is_indel(df_aa.columns)]
 
 # drop mutations in non-coding regions and synonymous mutations (to save the place in full-genome plot):
 df_aa_full_genome_plot = df_aa
 df_full_genome_plot = df
 
-to_drop = []
-nt_subst_drop = []
-for aa_substitution in df_aa_full_genome_plot.columns:
-
-    aa_letters = re.findall(r'[A-Za-z]+', aa_substitution.split('_')[0])
-    if len(aa_letters) == 2 and (aa_letters[0] == aa_letters[1]):
-        to_drop.append(aa_substitution)
-        nt_subst_drop.append( aa_substitution.split('_')[-1])
-    elif len(aa_letters) < 2:
-        to_drop.append(aa_substitution)
-        nt_subst_drop.append( aa_substitution.split('_')[-1])
+to_drop = df_aa_full_genome_plot.columns[~catalog.is_amino_acid_change(df_aa_full_genome_plot.columns)]
+nt_subst_drop = catalog.field('nucleotide')[catalog.intern(to_drop)]
 
 df_aa_full_genome_plot = df_aa_full_genome_plot.loc[:, ~df_aa_full_genome_plot.columns.isin(to_drop)]
 df_full_genome_plot = df_full_genome_plot.loc[:, ~df_full_genome_plot.columns.isin(nt_subst_drop)]
@@ -211,8 +183,10 @@ fig.savefig("../../preprint/plots/mutation_heatmap/timeline_tsv_mutation_sorted_
 
 # F-gene heatmap
 
-df_F_gene = df.loc[:, [col for col in df.columns if 5676 < int(re.findall(r'\d+', col)[0]) < 7400]]
-df_aa_F_gene = df_aa.loc[:, [col for col in df_aa.columns if 5676 < int(re.findall(r'\d+', col)[-1]) < 7400]]
+positions = catalog.positions(df.columns)
+df_F_gene = df.loc[:, (5676 < positions) & (positions < 7400)]
+positions = catalog.positions(df_aa.columns)
+df_aa_F_gene = df_aa.loc[:, (5676 < positions) & (positions < 7400)]
 
 row_separator = next(i for i, label in enumerate(df_F_gene.index) if "GE" in label)
 
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+import synthetic_season
+
+"""
+Benchmark of the data-analysis scripts on synthetic seasons (synthetic_season.py)
+- a season is generated per sample count, then every stage runs as a separate process in its own output directory:
+  annotate (annotate_vcf.py), coverage (extract_coverage_RSV_Vpipe.py), mutation_tsv (make_mutation_tsv.py) and
+  tallymut (make_tallymut.py), on both references of the concatenated reference where the script supports it
+- wall time and peak resident memory (ru_maxrss of os.wait4) are measured per run, stages are repeated --repeat times
+- select_signatures (select_signatures.py --require-reduction) runs on the signatures matrix of the shipped RSV-A
+  clade definitions (rsv_definitions/RSVA_nucleotide_mutations_0.9.json) and fails if no mutation is left out
+- the results are written as json together with the git commit of the tree; --compare prints the time and memory
+  ratios to the results of another commit
+"""
+
+STAGES = ['annotate', 'coverage', 'mutation_tsv', 'tallymut', 'select_signatures']
+VCF_GLOB = 'season/results/*/*/variants/SNVs/snvs.vcf'
+ANNOTATED_VCF_GLOB = 'season/results/*/*/variants/SNVs/snvs_annotated.vcf'
+COVERAGE_GLOB = 'season/results/*/*/alignments/coverage.tsv.gz'
+DEFINITIONS_DIR = os.path.join(synthetic_season.SCRIPTS_DIR, 'rsv_definitions')
+SHIPPED_DEFINITIONS = 'RSVA_nucleotide_mutations_0.9.json'
+
+
+# Command line of a stage, run from season_dir/<stage>
+def stage_command(stage, season_dir, references):
+    script = os.path.join(synthetic_season.SCRIPTS_DIR, {'annotate': 'annotate_vcf.py',
+                                                         'coverage': 'extract_coverage_RSV_Vpipe.py',
+                                                         'mutation_tsv': 'make_mutation_tsv.py',
+                                                         'tallymut': 'make_tallymut.py',
+                                                         'select_signatures': 'select_signatures.py'}[stage])
+    vcf_files = os.path.join(season_dir, VCF_GLOB)
+    annotated_vcf_files = os.path.join(season_dir, ANNOTATED_VCF_GLOB)
+    coverage_files = os.path.join(season_dir, COVERAGE_GLOB)
+    timeline_tsv = os.path.join(season_dir, 'timeline.tsv')
+
+    if stage == 'annotate':
+        genbank_files = [os.path.join(synthetic_season.REFERENCES_DIR, name) for name in synthetic_season.GENBANK_FILES]
+        return [sys.executable, script, vcf_files, ','.join(genbank_files)] + references
+    if stage == 'coverage':
+        return [sys.executable, script, coverage_files, references[0]]
+    if stage == 'mutation_tsv':
+        return [sys.executable, script, annotated_vcf_files, timeline_tsv, coverage_files] + references
+    if stage == 'select_signatures':
+        return [sys.executable, script, os.path.join(season_dir, 'shipped_signatures.csv'), 'selected_signatures.csv',
+                '--require-reduction']
+    signatures = ','.join(os.path.join(season_dir, f'signatures_{reference}.csv') for reference in references)
+    return [sys.executable, script, signatures, annotated_vcf_files, coverage_files, timeline_tsv] + references + \
+        ['--output', 'tallymut_{reference}.tsv']
+
+
+# Run a command, returns the wall time (s), peak resident memory (MB) and exit code
+def measure(command, cwd, log_file):
+    with open(log_file, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    # the process was reaped by os.wait4
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak_rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return wall, peak_rss, process.returncode
+
+
+# Signatures matrix of the shipped clade definitions, input of the select_signatures stage
+def write_shipped_signatures(season_dir):
+    subprocess.run([sys.executable, os.path.join(DEFINITIONS_DIR, 'rsv_signatures.py'),
+                    os.path.join(DEFINITIONS_DIR, SHIPPED_DEFINITIONS),
+                    '--output', os.path.join(season_dir, 'shipped_signatures.csv')], check=True)
+
+
+def run_stage(stage, season_dir, references, repeat):
+    stage_dir = os.path.join(season_dir, stage)
+    walls, peak_rss, returncode = [], 0.0, 0
+    for _ in range(repeat):
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        os.makedirs(stage_dir)
+        wall, rss, returncode = measure(stage_command(stage, season_dir, references), stage_dir,
+                                        os.path.join(season_dir, f'{stage}.log'))
+        if returncode != 0:
+            print(f'{stage} failed, see {os.path.join(season_dir, stage + ".log")}')
+            break
+        walls.append(wall)
+        peak_rss = max(peak_rss, rss)
+    return {'stage': stage, 'wall_seconds': walls, 'best_seconds': min(walls) if walls else None,
+            'peak_rss_mb': peak_rss, 'returncode': returncode}
+
+
+def git_commit():
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare(results, baseline):
+    baseline_runs = {(run['samples'], run['stage']): run for run in baseline['results']}
+    print(f'compared to {baseline["commit"]}:')
+    for run in results['results']:
+        base = baseline_runs.get((run['samples'], run['stage']))
+        if base is None or not base['best_seconds'] or not run['best_seconds']:
+            continue
+        print(f'{run["stage"]:>17} {run["samples"]:>6} samples: time x{run["best_seconds"] / base["best_seconds"]:.2f}'
+              f', peak memory x{run["peak_rss_mb"] / base["peak_rss_mb"]:.2f}')
+
+
+def main(samples, stages=None, repeat=1, genome_length=None, variants_per_sample=100, n_signatures=150, seed=1,
+         output=None, work_dir=None, keep=False, baseline=None):
+    stages = stages or STAGES
+    work_dir = work_dir or tempfile.mkdtemp(prefix='rsv_benchmark_')
+    commit, dirty = git_commit()
+    results = {'commit': commit,
+               'dirty': dirty,
+               'timestamp': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'parameters': {'genome_length': genome_length, 'variants_per_sample': variants_per_sample,
+                              'signatures': n_signatures, 'seed': seed, 'repeat': repeat},
+               'results': []}
+
+    for n_samples in samples:
+        season_dir = os.path.join(work_dir, f'samples_{n_samples}')
+        references = synthetic_season.make_season(season_dir, n_samples, genome_length=genome_length,
+                                                  variants_per_sample=variants_per_sample, n_signatures=n_signatures,
+                                                  seed=seed)
+        if 'select_signatures' in stages:
+            write_shipped_signatures(season_dir)
+        for stage in stages:
+            run = run_stage(stage, season_dir, references, repeat)
+            run['samples'] = n_samples
+            results['results'].append(run)
+            if run['best_seconds'] is not None:
+                print(f'{stage:>17} {n_samples:>6} samples: {run["best_seconds"]:8.2f} s, '
+                      f'{run["peak_rss_mb"]:8.1f} MB')
+        if not keep:
+            shutil.rmtree(season_dir)
+
+    if not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if output:
+        with open(output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    if baseline:
+        with open(baseline) as fh:
+            compare(results, json.load(fh))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='time the data-analysis scripts on synthetic seasons and report their peak memory')
+
+    parser.add_argument('--samples', type=int, nargs='+', default=[50],
+                        help='sample counts of the synthetic seasons, e.g. 50 200 800 for the scaling')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=None, help='stages to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the best time is reported')
+    parser.add_argument('--genome-length', type=int, default=None,
+                        help='positions per reference with coverage (default: the reference length)')
+    parser.add_argument('--variants-per-sample', type=int, default=100, help='SNVs per sample and reference')
+    parser.add_argument('--signatures', type=int, default=150, help='signature mutations per reference')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='json file of the results')
+    parser.add_argument('--compare', default=None, help='json results of an earlier run to compare with')
+    parser.add_argument('--work-dir', default=None, help='directory of the synthetic seasons (default: a temporary one)')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic seasons and stage outputs')
+
+    args = parser.parse_args()
+    results = main(args.samples, stages=args.stages, repeat=args.repeat, genome_length=args.genome_length,
+                   variants_per_sample=args.variants_per_sample, n_signatures=args.signatures, seed=args.seed,
+                   output=args.output, work_dir=args.work_dir, keep=args.keep, baseline=args.compare)
+    # failed stages (and the select_signatures check) fail the run
+    if any(run['returncode'] != 0 for run in results['results']):
+        sys.exit(1)
@@ -0,0 +1,198 @@
+import os
+import csv
+import glob
+import argparse
+import subprocess
+import sys
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+from Bio import SeqIO
+
+"""
+Synthetic V-pipe season for benchmarking the data-analysis scripts (utilities/shared/RSV_data_analysis)
+- results/<sample>/date/variants/SNVs/snvs.vcf: SNVs at positions of the shipped GenBank references, drawn mostly
+  from a pool of mutations circulating in the season (so they recur across samples) and partly private to the sample
+- results/<sample>/date/alignments/coverage.tsv.gz: per-position coverage of every reference, with amplicon-like
+  blocks of varying depth and drop-outs
+- snvs_annotated.vcf: the snvs.vcf files annotated with annotate_vcf.py, as in the pipeline
+- timeline.tsv: the samples (and a few samples without results, as drop-outs) with date and location
+- signatures_{reference}.csv: lineages x mutations matrix of signature mutations taken from the season pool
+Everything is drawn from a seeded generator, the same parameters give the same season.
+"""
+
+REFERENCES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'workflow', 'resources',
+                              'references')
+GENBANK_FILES = ['EPI_ISL_412866_hRSV_A_England_397_2017.gb', 'EPI_ISL_1653999_hRSV_B_Australia_VIC-RCH056_2019.gb']
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared', 'RSV_data_analysis')
+
+LOCATIONS = {'Lugano (TI)': '05', 'Zürich (ZH)': '10', 'Basel (BS)': '15', 'Genève (GE)': '16', 'Chur (GR)': '17',
+             'Laupen (BE)': '25'}
+SEASON_START = date(2023, 10, 2)
+AMPLICON_LENGTH = 400
+# share of the variants of a sample drawn from the season pool, the others are private
+POOL_SHARE = 0.7
+DROPOUT_SAMPLE_SHARE = 0.05
+DROPOUT_AMPLICON_SHARE = 0.1
+
+VCF_HEADER = """##fileformat=VCFv4.0
+{contigs}
+##INFO=<ID=AF,Number=1,Type=Float,Description="Allele frequency">
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Read depth">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+"""
+
+
+# Sequences of the GenBank references, by record id (EPI_ISL_412866, EPI_ISL_1653999)
+def read_references(genbank_files):
+    references = {}
+    for genbank_file in genbank_files:
+        record = SeqIO.read(genbank_file, 'genbank')
+        references[record.id] = str(record.seq).upper()
+    return references
+
+
+# Pool of mutations circulating in the season: position, alternative base and popularity (share of the samples)
+def season_pool(rng, sequence, genome_length, size):
+    positions = np.sort(rng.choice(np.arange(1, min(genome_length, len(sequence)) + 1), size=size, replace=False))
+    return pd.DataFrame({'pos': positions,
+                         'ref': [sequence[pos - 1] for pos in positions],
+                         'alt': [_other_base(rng, sequence[pos - 1]) for pos in positions],
+                         'popularity': rng.beta(0.5, 1.5, size=size)})
+
+
+def sample_variants(rng, sequence, genome_length, pool, n_variants):
+    n_pool = min(int(round(n_variants * POOL_SHARE)), len(pool))
+    from_pool = pool.iloc[rng.choice(len(pool), size=n_pool, replace=False,
+                                     p=pool['popularity'] / pool['popularity'].sum())]
+    private_positions = rng.choice(np.arange(1, min(genome_length, len(sequence)) + 1), size=n_variants - n_pool,
+                                   replace=False)
+    private = pd.DataFrame({'pos': private_positions,
+                            'ref': [sequence[pos - 1] for pos in private_positions],
+                            'alt': [_other_base(rng, sequence[pos - 1]) for pos in private_positions]})
+    variants = pd.concat([from_pool[['pos', 'ref', 'alt']], private], ignore_index=True)
+    variants = variants.drop_duplicates('pos').sort_values('pos')
+    # low frequencies are the most common, as in wastewater samples
+    variants['af'] = np.clip(rng.beta(0.6, 1.2, size=len(variants)), 0.01, 1.0)
+    variants['dp'] = rng.integers(30, 3000, size=len(variants))
+    return variants
+
+
+# Coverage of every position: amplicon-like blocks around a sample depth, some amplicons drop out
+def sample_coverage(rng, genome_length):
+    depth = rng.lognormal(np.log(800), 0.8)
+    n_amplicons = -(-genome_length // AMPLICON_LENGTH)
+    amplicon_depth = depth * rng.lognormal(0, 0.7, size=n_amplicons)
+    amplicon_depth[rng.random(n_amplicons) < DROPOUT_AMPLICON_SHARE] = 0
+    coverage = np.repeat(amplicon_depth, AMPLICON_LENGTH)[:genome_length]
+    return (coverage * rng.uniform(0.8, 1.2, size=genome_length)).astype(np.int64)
+
+
+def write_vcf(path, variants_by_reference, references):
+    contigs = '\n'.join(f'##contig=<ID={reference},length={len(sequence)}>'
+                        for reference, sequence in references.items())
+    with open(path, 'w') as fh:
+        fh.write(VCF_HEADER.format(contigs=contigs))
+        for reference, variants in variants_by_reference.items():
+            for pos, ref, alt, af, dp in variants[['pos', 'ref', 'alt', 'af', 'dp']].itertuples(index=False):
+                fh.write(f'{reference}\t{pos}\t.\t{ref}\t{alt}\t100\tPASS\tAF={af:.4f};DP={dp}\n')
+
+
+def write_coverage(path, sample_column, coverage_by_reference):
+    coverage = pd.concat([pd.DataFrame({'ref': reference, 'pos': np.arange(1, len(coverage) + 1),
+                                        sample_column: coverage})
+                          for reference, coverage in coverage_by_reference.items()])
+    coverage.to_csv(path, sep='\t', index=False, compression='gzip')
+
+
+def write_signatures(path, rng, pool, n_signatures, n_lineages):
+    signatures = pool.iloc[np.sort(rng.choice(len(pool), size=min(n_signatures, len(pool)), replace=False))]
+    mutations = (signatures['ref'] + signatures['pos'].astype(str) + signatures['alt']).tolist()
+    flags = (rng.random((n_lineages, len(mutations))) < 0.3).astype(int)
+    with open(path, 'w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['Lineages'] + mutations)
+        for lineage, lineage_flags in enumerate(flags):
+            writer.writerow([f'L.{lineage + 1}'] + lineage_flags.tolist())
+
+
+def make_season(output_dir, n_samples, genome_length=None, variants_per_sample=100, n_signatures=150, n_lineages=8,
+                seed=1, genbank_files=None, annotate=True):
+    """Write a synthetic season to output_dir/season (results tree) and output_dir (timeline.tsv, signatures)."""
+    genbank_files = genbank_files or [os.path.join(REFERENCES_DIR, name) for name in GENBANK_FILES]
+    references = read_references(genbank_files)
+    rng = np.random.default_rng(seed)
+    lengths = {reference: genome_length or len(sequence) for reference, sequence in references.items()}
+    pools = {reference: season_pool(rng, sequence, lengths[reference],
+                                    size=min(max(3 * variants_per_sample, n_signatures), lengths[reference],
+                                             len(sequence)))
+             for reference, sequence in references.items()}
+
+    timeline = []
+    locations = list(LOCATIONS)
+    for i in range(n_samples):
+        location = locations[i % len(locations)]
+        sample_date = SEASON_START + timedelta(days=i // len(locations))
+        sample_name = f'{LOCATIONS[location]}_{sample_date:%Y_%m_%d}'
+        batch = f'{sample_date:%Y%m%d}_synthetic'
+        timeline.append({'submissionId': sample_name, 'batch': batch, 'reads': int(rng.integers(50000, 2000000)),
+                         'reference': 'RSV', 'primerProtocol': 'v1', 'location_code': LOCATIONS[location],
+                         'date': f'{sample_date:%Y-%m-%d}', 'location': location})
+        # drop-outs are in the timeline, but have no results
+        if rng.random() < DROPOUT_SAMPLE_SHARE:
+            continue
+
+        # the second level is named 'date' in the V-pipe layout read by the scripts
+        sample_dir = os.path.join(output_dir, 'season', 'results', sample_name, 'date')
+        os.makedirs(os.path.join(sample_dir, 'variants', 'SNVs'), exist_ok=True)
+        os.makedirs(os.path.join(sample_dir, 'alignments'), exist_ok=True)
+        write_vcf(os.path.join(sample_dir, 'variants', 'SNVs', 'snvs.vcf'),
+                  {reference: sample_variants(rng, sequence, lengths[reference], pools[reference],
+                                              min(variants_per_sample, lengths[reference]))
+                   for reference, sequence in references.items()},
+                  references)
+        write_coverage(os.path.join(sample_dir, 'alignments', 'coverage.tsv.gz'), f'{sample_name}/date',
+                       {reference: sample_coverage(rng, lengths[reference]) for reference in references})
+
+    pd.DataFrame(timeline).to_csv(os.path.join(output_dir, 'timeline.tsv'), sep='\t', index=False)
+    for reference in references:
+        write_signatures(os.path.join(output_dir, f'signatures_{reference}.csv'), rng, pools[reference],
+                         n_signatures, n_lineages)
+
+    if annotate:
+        annotate_season(output_dir, genbank_files, list(references))
+    return list(references)
+
+
+# snvs_annotated.vcf next to every snvs.vcf, with the annotate_vcf.py of this tree
+def annotate_season(output_dir, genbank_files, references):
+    vcf_files = os.path.join(output_dir, 'season', 'results', '*', '*', 'variants', 'SNVs', 'snvs.vcf')
+    if not glob.glob(vcf_files):
+        return
+    subprocess.run([sys.executable, os.path.join(SCRIPTS_DIR, 'annotate_vcf.py'), vcf_files,
+                    ','.join(genbank_files)] + references, check=True, stdout=subprocess.DEVNULL)
+
+
+def _other_base(rng, base):
+    return rng.choice([other for other in 'ACGT' if other != base])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='write a synthetic V-pipe season (results tree, timeline.tsv and signatures) for benchmarks')
+
+    parser.add_argument('output_dir', help='directory of the season; the results tree is written to output_dir/season')
+    parser.add_argument('--samples', type=int, default=100, help='number of samples in the timeline')
+    parser.add_argument('--genome-length', type=int, default=None,
+                        help='number of positions per reference with coverage (default: the reference length); '
+                             'variants are only drawn within the reference')
+    parser.add_argument('--variants-per-sample', type=int, default=100, help='SNVs per sample and reference')
+    parser.add_argument('--signatures', type=int, default=150, help='signature mutations per reference')
+    parser.add_argument('--lineages', type=int, default=8, help='lineages of the signatures matrices')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-annotate', action='store_true', help='do not write snvs_annotated.vcf files')
+
+    args = parser.parse_args()
+    make_season(args.output_dir, args.samples, genome_length=args.genome_length,
+                variants_per_sample=args.variants_per_sample, n_signatures=args.signatures,
+                n_lineages=args.lineages, seed=args.seed, annotate=not args.no_annotate)
@@ -5,24 +5,64 @@ and here: https://github.com/rpetit3/vcf-annotator/blob/master/vcf-annotator.py
 """
 
 
-from fuc import pyvcf
 import collections
+import hashlib
+import json
+import os
+import numpy as np
+import pysam
 from Bio import SeqIO
 from Bio.Seq import Seq
+from Bio.Data import CodonTable
 import vcf
 import glob
+import logging
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import instrumentation
+from parse_cache import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# bumped whenever the layout of the serialized annotation table changes
+ANNOTATION_TABLE_VERSION = 1
+
+# number of VCF records annotated at once, memory use does not grow with the size of the VCF
+BATCH_RECORDS = 10000
+
+# bumped whenever the annotation results (or their layout in the memo file) change
+ANNOTATION_MEMO_VERSION = 1
+# VCF info fields set by the annotation, in the order they are added to a record
+ANNOTATION_FIELDS = ['RefCodon', 'AltCodon', 'RefAminoAcid', 'AltAminoAcid', 'CodonPosition', 'SNPCodonPosition',
+                     'AminoAcidChange', 'IsSynonymous', 'IsTransition', 'Comments', 'IsGenic', 'IsPseudo',
+                     'LocusTag', 'Gene', 'Note', 'Inference', 'Product', 'ProteinID', 'FeatureType', 'VariantType']
+
+# VCF info fields filled from the qualifiers of the annotated features
+INFO_QUALIFIERS = {
+    'Note': 'note', 'LocusTag': 'locus_tag',
+    'Gene': 'gene', 'Product': 'product',
+    'ProteinID': 'protein_id',
+    'Inference': 'inference'
+}
+
+# codon -> amino acid lookup of the standard code (stop codons as *), codon index = 16 * b1 + 4 * b2 + b3
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = BASE_CODES[ord(base.lower())] = code
+CODON_AMINO_ACIDS = np.array([CodonTable.unambiguous_dna_by_id[1].forward_table.get(b1 + b2 + b3, '*')
+                              for b1 in 'ACGT' for b2 in 'ACGT' for b3 in 'ACGT'], dtype=object)
 
 
 class Annotator(object):
     """Annotate a given VCF file according to the reference GenBank."""
 
-    def __init__(self, gb_file=False, vcf_file=False):
-        """Initialize variables."""
+    def __init__(self, gb_file=False, vcf_file=False, table_file=None, chrom_names=None, memo=None):
+        """Initialize variables, gb_file can also be an already parsed GenBank."""
+        self.__memo = memo
         self.__annotated_features = ["CDS", "tRNA", "rRNA", "ncRNA",
                                      "misc_feature"]
-        self.__gb = GenBank(gb_file)
-        self.__vcf = VCFTools(vcf_file)
+        self.__gb = gb_file if isinstance(gb_file, GenBank) else GenBank(gb_file, table_file=table_file)
+        self.__vcf = VCFTools(vcf_file, chrom_names=chrom_names)
         self.add_annotation_info()
 
     def add_annotation_info(self):
@@ -52,12 +92,32 @@ class Annotator(object):
             ['FeatureType', None, 'String', 'The feature type of variant.'],
         ])
 
-    def annotate_vcf_records(self):
-        """Annotate each record in the VCF acording to the input GenBank."""
-        for record in self.__vcf.records:
-            self.__gb.accession = record.CHROM
-            self.__gb.version = record.CHROM
-            self.__gb.index = record.POS
+    def annotated_records(self, batch_size=BATCH_RECORDS):
+        """Generator of the annotated VCF records, read and annotated batch by batch."""
+        for records in self.__vcf.record_batches(batch_size):
+            self.annotate_vcf_records(records)
+            for record in records:
+                yield record
+
+    def annotate_vcf_records(self, records):
+        """Annotate each record of a batch acording to the input GenBank, or from the memo if seen before."""
+        if self.__memo is None:
+            self.__annotate_records(records)
+            return
+
+        # key of every record before the annotation (which can replace the ALT of ambiguous SNPs)
+        keys = [self.__memo.key(record) for record in records]
+        missing = [(key, record) for key, record in zip(keys, records) if not self.__memo.restore(key, record)]
+        self.__annotate_records([record for _, record in missing])
+        for key, record in missing:
+            self.__memo.store(key, record)
+
+    def __annotate_records(self, records):
+        # features and codons of all records are looked up at once in the annotation table
+        annotation = self.__gb.lookup([record.CHROM for record in records],
+                                      np.array([record.POS for record in records], dtype=np.int64))
+        genic_snps = []
+        for i, record in enumerate(records):
 
             # Set defaults
             record.INFO['RefCodon'] = '.'
@@ -81,38 +141,15 @@ class Annotator(object):
             record.INFO['FeatureType'] = 'inter_genic'
 
             # Get annotation info
-            if self.__gb.feature_exists:
-                record.INFO['FeatureType'] = self.__gb.feature.type
-                if self.__gb.feature.type in self.__annotated_features:
-                    feature = self.__gb.feature
-                    if feature.type == "CDS":
+            if annotation['feature'][i] >= 0:
+                feature = self.__gb.feature_info[annotation['name'][i]][annotation['feature'][i]]
+                record.INFO['FeatureType'] = feature['type']
+                if feature['type'] in self.__annotated_features:
+                    if feature['type'] == "CDS":
                         record.INFO['IsGenic'] = '1'
-
-                    qualifiers = {
-                        'Note': 'note', 'LocusTag': 'locus_tag',
-                        'Gene': 'gene', 'Product': 'product',
-                        'ProteinID': 'protein_id',
-                        'Inference': 'inference'
-                    }
-
-                    if feature.type == "tRNA":
-                        qualifiers['Note'] = 'anticodon'
-                    for k, v in qualifiers.items():
-                        if v in feature.qualifiers:
-                            # Spell out semi-colons, commas and spaces
-                            record.INFO[k] = feature.qualifiers[v][0].replace(
-                                ';', '[semi-colon]'
-                            ).replace(
-                                ',', '[comma]'
-                            ).replace(
-                                ' ', '[space]'
-                            )
-                            if v == 'anticodon':
-                                record.INFO[k] = 'anticodon{0}'.format(
-                                    record.INFO[k]
-                                )
-
-                    if 'pseudo' in feature.qualifiers:
+                    # qualifiers, with semi-colons, commas and spaces spelled out
+                    record.INFO.update(feature['info'])
+                    if feature['pseudo']:
                         record.INFO['IsPseudo'] = '1'
 
             # Determine variant type
@@ -138,22 +175,18 @@ class Annotator(object):
                     alt_base = str(record.ALT[0])
 
                     # Determine codon information
-                    codon = self.__gb.codon_by_position(record.POS)
-                    record.INFO['RefCodon'] = ''.join(list(codon[0]))
-                    record.INFO['SNPCodonPosition'] = codon[1]
-                    record.INFO['CodonPosition'] = codon[2]
+                    snp_codon_position = int(annotation['codon_offset'][i])
+                    record.INFO['SNPCodonPosition'] = snp_codon_position
+                    record.INFO['CodonPosition'] = int(annotation['codon_number'][i])
                     # MODIFICATION
                     # Instead of base from ref sequence use base from vcf file
-                    ref_base = str(record.REF[0])
-                    record.INFO['RefCodon'] = list(record.INFO['RefCodon'])
-                    record.INFO['RefCodon'][
-                        record.INFO['SNPCodonPosition']
-                    ] = ref_base
-                    record.INFO['RefCodon'] = ''.join(record.INFO['RefCodon'])
+                    ref_codon = str(annotation['ref_codon'][i])
+                    record.INFO['RefCodon'] = (ref_codon[:snp_codon_position] + str(record.REF[0]) +
+                                               ref_codon[snp_codon_position + 1:])
                     # END MODIFICATION
 
                     # Adjust for ambiguous base and negative strand.
-                    if feature.strand == -1:
+                    if feature['strand'] == -1:
                         alt_base = str(
                             Seq(alt_base).complement()
                         )
@@ -164,137 +197,193 @@ class Annotator(object):
                         )
 
                     # Determine alternates
-                    record.INFO['AltCodon'] = list(record.INFO['RefCodon'])
-                    record.INFO['AltCodon'][
-                        record.INFO['SNPCodonPosition']
-                    ] = alt_base
-                    record.INFO['AltCodon'] = ''.join(record.INFO['AltCodon'])
-                    record.INFO['RefAminoAcid'] = Seq(
-                        record.INFO['RefCodon']
-                    ).translate()
-                    record.INFO['AltAminoAcid'] = Seq(
-                        record.INFO['AltCodon']
-                    ).translate()
-                    record.INFO['AminoAcidChange'] = '{0}{1}{2}'.format(
-                        str(record.INFO['RefAminoAcid']),
-                        record.INFO['CodonPosition'],
-                        str(record.INFO['AltAminoAcid'])
-                    )
-
-                    if record.INFO['VariantType'] != 'Ambiguous_SNP':
-                        ref = str(record.INFO['RefAminoAcid'])
-                        alt = str(record.INFO['AltAminoAcid'])
-                        if ref == alt:
-                            record.INFO['IsSynonymous'] = 1
-                        else:
-                            record.INFO['IsSynonymous'] = 0
+                    ref_codon = record.INFO['RefCodon']
+                    record.INFO['AltCodon'] = (ref_codon[:snp_codon_position] + alt_base +
+                                               ref_codon[snp_codon_position + 1:])
+                    genic_snps.append(record)
+
+        # translate the codons of all genic SNPs in one go
+        ref_amino_acids = self.__gb.translate_codons([record.INFO['RefCodon'] for record in genic_snps])
+        alt_amino_acids = self.__gb.translate_codons([record.INFO['AltCodon'] for record in genic_snps])
+        for record, ref, alt in zip(genic_snps, ref_amino_acids, alt_amino_acids):
+            record.INFO['RefAminoAcid'] = ref
+            record.INFO['AltAminoAcid'] = alt
+            record.INFO['AminoAcidChange'] = '{0}{1}{2}'.format(
+                ref,
+                record.INFO['CodonPosition'],
+                alt
+            )
+
+            if record.INFO['VariantType'] != 'Ambiguous_SNP':
+                if ref == alt:
+                    record.INFO['IsSynonymous'] = 1
+                else:
+                    record.INFO['IsSynonymous'] = 0
 
     def write_vcf(self, output='/dev/stdout'):
-        """Write the VCF to the specified output."""
-        self.__vcf.write_vcf(output)
+        """Annotate the VCF and write it to the specified output, streaming the records."""
+        self.__vcf.write_vcf(self.annotated_records(), output)
 
 
 class GenBank(object):
-    """A class for parsing GenBank files."""
+    """A class for parsing GenBank files into a per-position annotation table."""
 
-    def __init__(self, gb=False):
-        """Inititalize variables."""
+    def __init__(self, gb=False, table_file=None):
+        """Inititalize variables, the annotation table is loaded from table_file if it matches the GenBank files."""
         self.genbank_file = gb
-        self.records = {}
-        self.record_index = {}
+        self.genbank_files = gb if isinstance(gb, list) else [gb]
+        self.checksum = genbank_checksum(self.genbank_files)
+        # per record: arrays of feature index (-1: none), codon offset, codon number and reference codon per position
+        self.tables = {}
+        # per record: type, strand, pseudo flag and (escaped) qualifiers of every feature
+        self.feature_info = {}
         self.record_ids = {}
-        self.__gb = None
-        self._index = None
-        self._accession = None
-        self.__position_index = None
-        self.feature = None
         self.features = ["CDS", "rRNA", "tRNA", "ncRNA", "repeat_region",
                          "misc_feature"]
-        self.gene_codons = {}
-        self.parse_genbank()
-
-    @property
-    def accession(self):
-        """Accession for records."""
-        return self._index
-
-    @accession.setter
-    def accession(self, value):
-        if value not in self.records:
-            print("self.record_ids[value]", self.record_ids)
-            value = self.record_ids[value]
-
-        self._accession = value
-        self.__gb = self.records[value]
-        self.__position_index = self.record_index[value]
-
-    @property
-    def index(self):
-        """Postion index for features."""
-        return self._index
-
-    @index.setter
-    def index(self, value):
-        try:
-            self._index = self.__position_index[value - 1]
-        except:
-            self._index = None
-        self.__set_feature()
+        if not (table_file and os.path.isfile(table_file) and self.load_table(table_file)):
+            self.parse_genbank()
+            if table_file:
+                self.save_table(table_file)
 
     def parse_genbank(self):
-        with open(self.genbank_file, 'r') as gb_fh:
+        # several GenBank files can be given, e.g. one per reference of a concatenated reference
+        for genbank_file in self.genbank_files:
+            self.__parse_genbank_file(genbank_file)
+
+    def __parse_genbank_file(self, genbank_file):
+        with open(genbank_file, 'r') as gb_fh:
             for record in SeqIO.parse(gb_fh, 'genbank'):
-                self.records[record.name] = record
-                self.gene_codons[record.name] = {}
-                self.record_index[record.name] = [None] * len(record.seq)
                 self.record_ids[record.id] = record.name
-                for i in range(len(record.features)):
-                    if record.features[i].type in self.features:
-                        start = int(record.features[i].location.start)
-                        end = int(record.features[i].location.end)
-                        self.record_index[record.name][start:end] = [i] * (end - start)
-
-    def __set_feature(self):
-        if self._index is None:
-            self.feature_exists = False
-            self.feature = None
-        else:
-            self.feature_exists = True
-            self.feature = self.records[self._accession].features[self._index]
-
-    def codon_by_position(self, pos):
-        """Retreive the codon given a position of a CDS feature."""
-        if self._index not in self.gene_codons[self._accession]:
-            self.split_into_codons()
-        gene_position = self.position_in_gene(pos)
-        codon_position = gene_position // 3
-        return [self.gene_codons[self._accession][self._index][codon_position],
-                gene_position % 3,
-                codon_position + 1]
-
-    def split_into_codons(self):
-        """Split the complete CDS feature in to a list of codons."""
-        start = self.feature.location.start
-        end = self.feature.location.end
-        seq = ''.join(list(self.__gb.seq[start:end]))
-
-        if self.feature.strand == -1:
-            seq = Seq(seq).reverse_complement()
-
-        self.gene_codons[self._accession][self._index] = [
-            seq[i:i + 3] for i in range(0, len(seq), 3)
-        ]
-
-    def position_in_gene(self, pos):
-        """Return a codon postion in a gene."""
-        if self.feature.strand == 1:
-            return pos - self.feature.location.start - 1
-        else:
-            return self.feature.location.end - pos
-
-    def base_by_pos(self, pos):
-        """Print the base by position."""
-        print(self.__gb.seq[pos - 1])
+                self.tables[record.name] = self.__annotation_table(record)
+                self.feature_info[record.name] = [self.__feature_info(feature) for feature in record.features]
+
+    def __annotation_table(self, record):
+        """Feature, codon offset, codon number and reference codon of every position of a record."""
+        length = len(record.seq)
+        # the last feature covering a position wins
+        feature_index = np.full(length, -1, dtype=np.int32)
+        for i, feature in enumerate(record.features):
+            if feature.type in self.features:
+                feature_index[int(feature.location.start):int(feature.location.end)] = i
+
+        codon_offset = np.full(length, -1, dtype=np.int8)
+        codon_number = np.zeros(length, dtype=np.int32)
+        ref_codon = np.full(length, '', dtype='U3')
+        seq = str(record.seq)
+        for i in np.unique(feature_index[feature_index >= 0]):
+            feature = record.features[i]
+            if feature.type != "CDS":
+                continue
+            start = int(feature.location.start)
+            end = int(feature.location.end)
+            # Split the complete CDS feature in to codons
+            gene_seq = seq[start:end]
+            if feature.strand == -1:
+                gene_seq = str(Seq(gene_seq).reverse_complement())
+            codons = np.array([gene_seq[j:j + 3] for j in range(0, len(gene_seq), 3)], dtype='U3')
+
+            # 0-based positions where the feature is annotated, and their positions in the gene
+            at = np.flatnonzero(feature_index == i)
+            if feature.strand == 1:
+                gene_position = at - start
+            else:
+                gene_position = end - at - 1
+            codon_offset[at] = gene_position % 3
+            codon_number[at] = gene_position // 3 + 1
+            ref_codon[at] = codons[gene_position // 3]
+
+        return {'feature': feature_index, 'codon_offset': codon_offset, 'codon_number': codon_number,
+                'ref_codon': ref_codon}
+
+    def __feature_info(self, feature):
+        qualifiers = dict(INFO_QUALIFIERS)
+        if feature.type == "tRNA":
+            qualifiers['Note'] = 'anticodon'
+        info = {}
+        for k, v in qualifiers.items():
+            if v in feature.qualifiers:
+                # Spell out semi-colons, commas and spaces
+                info[k] = feature.qualifiers[v][0].replace(
+                    ';', '[semi-colon]'
+                ).replace(
+                    ',', '[comma]'
+                ).replace(
+                    ' ', '[space]'
+                )
+                if v == 'anticodon':
+                    info[k] = 'anticodon{0}'.format(info[k])
+        return {'type': feature.type, 'strand': feature.strand, 'pseudo': 'pseudo' in feature.qualifiers,
+                'info': info}
+
+    def save_table(self, table_file):
+        """Serialize the annotation table (numpy .npz), to be reused by later runs."""
+        arrays = {'{0}/{1}'.format(name, column): values
+                  for name, table in self.tables.items() for column, values in table.items()}
+        meta = {'version': ANNOTATION_TABLE_VERSION, 'checksum': self.checksum,
+                'record_ids': self.record_ids, 'feature_info': self.feature_info}
+        with open(table_file + '.tmp', 'wb') as table_fh:
+            np.savez(table_fh, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(table_file + '.tmp', table_file)
+
+    def load_table(self, table_file):
+        """Load a serialized annotation table, False if it was made from other GenBank files."""
+        with np.load(table_file) as table_npz:
+            meta = json.loads(str(table_npz['meta']))
+            if meta['version'] != ANNOTATION_TABLE_VERSION or meta['checksum'] != self.checksum:
+                return False
+            self.record_ids = meta['record_ids']
+            self.feature_info = meta['feature_info']
+            self.tables = {}
+            for key in table_npz.files:
+                if key != 'meta':
+                    name, column = key.rsplit('/', 1)
+                    self.tables.setdefault(name, {})[column] = table_npz[key]
+        return True
+
+    def record_name(self, accession):
+        """Name of the record of an accession (record name or id)."""
+        if accession in self.tables:
+            return accession
+        if accession in self.record_ids:
+            return self.record_ids[accession]
+        raise KeyError('{0} is not a record of {1}'.format(accession, ', '.join(self.genbank_files)))
+
+    def lookup(self, accessions, positions):
+        """Record name, feature index (-1: none), codon offset, codon number and reference codon at 1-based positions."""
+        accessions = np.asarray(accessions, dtype=object)
+        annotation = {'name': np.empty(len(positions), dtype=object),
+                      'feature': np.full(len(positions), -1, dtype=np.int32),
+                      'codon_offset': np.full(len(positions), -1, dtype=np.int8),
+                      'codon_number': np.zeros(len(positions), dtype=np.int32),
+                      'ref_codon': np.full(len(positions), '', dtype='U3')}
+        for accession in set(accessions):
+            at = np.flatnonzero(accessions == accession)
+            name = self.record_name(accession)
+            table = self.tables[name]
+            index = positions[at] - 1
+            inside = (index >= 0) & (index < len(table['feature']))
+            annotation['name'][at] = name
+            for column in ['feature', 'codon_offset', 'codon_number', 'ref_codon']:
+                annotation[column][at[inside]] = table[column][index[inside]]
+        return annotation
+
+    def translate_codons(self, codons):
+        """
+        Translate a list of codons (standard code, as Seq.translate). Codons of the four bases are translated
+        with the 64 entry lookup table, others (ambiguous bases, incomplete codons) with Seq.translate.
+        """
+        amino_acids = np.empty(len(codons), dtype=object)
+        is_triplet = np.array([len(codon) == 3 for codon in codons], dtype=bool)
+        triplets = ''.join([codon for codon in codons if len(codon) == 3]).encode('ascii', 'replace')
+        base_codes = BASE_CODES[np.frombuffer(triplets, dtype=np.uint8).reshape(-1, 3)]
+        is_standard = (base_codes < 4).all(axis=1)
+
+        standard = np.flatnonzero(is_triplet)[is_standard]
+        base_codes = base_codes[is_standard].astype(np.int64)
+        amino_acids[standard] = CODON_AMINO_ACIDS[base_codes[:, 0] * 16 + base_codes[:, 1] * 4 + base_codes[:, 2]]
+        for i in np.setdiff1d(np.arange(len(codons)), standard):
+            amino_acids[i] = str(Seq(codons[i]).translate())
+        return list(amino_acids)
 
     def determine_iupac_base(self, bases):
         """
@@ -336,13 +425,93 @@ class GenBank(object):
         return 0
 
 
+class AnnotationMemo(object):
+    """Annotation results of VCF records, keyed by (contig, pos, ref, alt) and the GenBank checksum."""
+
+    def __init__(self, memo_file, checksum):
+        """Load the memo file (if it exists), results of other GenBank files are kept but not used."""
+        self.memo_file = memo_file
+        self.checksum = checksum
+        self.memo = {}
+        if memo_file and os.path.isfile(memo_file):
+            with open(memo_file, 'r') as memo_fh:
+                content = json.load(memo_fh)
+            if content['version'] == ANNOTATION_MEMO_VERSION:
+                self.memo = content['annotations']
+        self.annotations = self.memo.setdefault(checksum, {})
+        # results added and lookups done since the last take_updates
+        self.new_annotations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, record):
+        return '{0}\t{1}\t{2}\t{3}'.format(record.CHROM, record.POS, record.REF,
+                                          ','.join(str(alt) for alt in record.ALT))
+
+    def restore(self, key, record):
+        """Set the memoized annotation of a record, False if the record was not seen before."""
+        annotation = self.annotations.get(key)
+        if annotation is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        values, alt = annotation
+        record.INFO.update(zip(ANNOTATION_FIELDS, values))
+        if record.INFO['VariantType'] == 'Ambiguous_SNP':
+            record.ALT = alt
+        return True
+
+    def store(self, key, record):
+        """Memoize the annotation of a record (and the IUPAC ALT of ambiguous SNPs)."""
+        values = [value if isinstance(value, (int, str)) else str(value)
+                  for value in [record.INFO[field] for field in ANNOTATION_FIELDS]]
+        alt = record.ALT if record.INFO['VariantType'] == 'Ambiguous_SNP' else None
+        self.annotations[key] = self.new_annotations[key] = [values, alt]
+
+    def take_updates(self):
+        """New results, hits and misses since the last call (of a worker process), which are then reset."""
+        updates = (self.new_annotations, self.hits, self.misses)
+        self.new_annotations = {}
+        self.hits = 0
+        self.misses = 0
+        return updates
+
+    def merge(self, new_annotations, hits, misses):
+        """Add the results, hits and misses of a worker process."""
+        self.annotations.update(new_annotations)
+        self.new_annotations.update(new_annotations)
+        self.hits += hits
+        self.misses += misses
+
+    def save(self):
+        with open(self.memo_file + '.tmp', 'w') as memo_fh:
+            json.dump({'version': ANNOTATION_MEMO_VERSION, 'annotations': self.memo}, memo_fh)
+        os.replace(self.memo_file + '.tmp', self.memo_file)
+
+
 class VCFTools(object):
     """A class for parsing VCF formatted files."""
 
-    def __init__(self, vcf_file):
-        """Initialize variables."""
-        self.reader = vcf.Reader(open(vcf_file, 'r'))
-        self.records = [record for record in self.reader]
+    def __init__(self, vcf_file, chrom_names=None):
+        """Initialize variables, only records of chrom_names (if given) are kept."""
+        self.vcf_file = vcf_file
+        self.chrom_names = chrom_names
+        # the header is read here, the records only while streaming them
+        self.__vcf_fh = open(vcf_file, 'r')
+        self.reader = vcf.Reader(self.__vcf_fh)
+
+    def record_batches(self, batch_size):
+        """Generator of lists of at most batch_size records, the VCF is closed after the last one."""
+        batch = []
+        for record in self.reader:
+            if self.chrom_names is None or record.CHROM in self.chrom_names:
+                batch.append(record)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+        self.__vcf_fh.close()
 
     def add_information_fields(self, info_list):
         """Add a given list of information fields to the VCF."""
@@ -356,42 +525,91 @@ class VCFTools(object):
         if id:
             self.reader.infos[id] = _Info(id, num, type, desc)
 
-    def write_vcf(self, output='/dev/stdout'):
-        """Write the VCF to a given output file."""
-        vcf_writer = vcf.Writer(open(output, 'w'), self.reader)
-        for record in self.records:
-            vcf_writer.write_record(record)
+    def write_vcf(self, records, output='/dev/stdout'):
+        """Write the (streamed) records to a given output file."""
+        with open(output, 'w') as output_fh:
+            vcf_writer = vcf.Writer(output_fh, self.reader)
+            for record in records:
+                vcf_writer.write_record(record)
 
-def update_vcf_chrom(in_vcf, out_vcf, chrom_name):
-    vf = pyvcf.VcfFrame.from_file(in_vcf)
-#    vf.df['CHROM'] = chrom_name
-    #vf.df = vf.df[vf.df['ALT']!='-']
-    vf.df = vf.df[vf.df['CHROM'] == chrom_name]
 
-    vf.to_file(out_vcf)
 
+def genbank_checksum(genbank_files):
+    # checksum of the content of the GenBank file(s), in the given order
+    return hashlib.sha256(''.join(file_sha256(genbank_file) for genbank_file in genbank_files).encode()).hexdigest()
 
-def main(input_dir, fname_genbank_file, chrom_name):
 
-# Code below adapted to iterate over multiple VCF files
-    # get list of VCF files in the input directory
+# Annotate a single VCF file, keeping the records of the given reference(s)
+def annotate_vcf_file(fname_snv_in, genbank, chrom_names, bgzip=False, memo=None):
+    logger.debug(fname_snv_in)
+    annotator = Annotator(gb_file=genbank, vcf_file=fname_snv_in, chrom_names=chrom_names, memo=memo)
 
-    vcf_files = glob.glob(input_dir, recursive=True)
+    fname_snv_out = str(fname_snv_in).split('.vcf')[0] + '_annotated.vcf'
+    # written next to the output and renamed, so an interrupted run never leaves a truncated output behind
+    annotator.write_vcf(fname_snv_out + '.tmp')
+    if not bgzip:
+        os.replace(fname_snv_out + '.tmp', fname_snv_out)
+        return fname_snv_out
+
+    # block-compressed and tabix-indexed, so later stages can fetch regions (vcf_ingest.py)
+    pysam.tabix_compress(fname_snv_out + '.tmp', fname_snv_out + '.gz.tmp', force=True)
+    os.remove(fname_snv_out + '.tmp')
+    pysam.tabix_index(fname_snv_out + '.gz.tmp', preset='vcf', force=True)
+    os.replace(fname_snv_out + '.gz.tmp', fname_snv_out + '.gz')
+    os.replace(fname_snv_out + '.gz.tmp.tbi', fname_snv_out + '.gz.tbi')
+    return fname_snv_out + '.gz'
 
-    for fname_snv_in in vcf_files:
 
+# parsed GenBank and annotation memo of a worker process, handed over once when the worker starts
+_worker_genbank = None
+_worker_memo = None
 
-        fname_snv_temp = str(fname_snv_in).split('.vcf')[0]+'.temp.vcf'
-        print(fname_snv_temp)
 
-        update_vcf_chrom(fname_snv_in, fname_snv_temp, chrom_name)
+def _init_worker(genbank, memo):
+    global _worker_genbank, _worker_memo
+    _worker_genbank = genbank
+    _worker_memo = memo
 
-        annotator = Annotator(gb_file=fname_genbank_file, vcf_file=fname_snv_temp)
-        annotator.annotate_vcf_records()
 
-        fname_snv_out = str(fname_snv_in).split('.vcf')[0] + '_annotated.vcf'
+def _annotate_vcf_task(task):
+    fname_snv_in, chrom_names, bgzip = task
+    fname_snv_out = annotate_vcf_file(fname_snv_in, _worker_genbank, chrom_names, bgzip, _worker_memo)
+    # new memo results of this file go back to the main process
+    return fname_snv_out, _worker_memo.take_updates() if _worker_memo is not None else None
 
-        annotator.write_vcf(fname_snv_out)
+
+def main(input_dir, fname_genbank_file, chrom_name, table_file=None, jobs=1, bgzip=False, memo_file=None):
+
+# Code below adapted to iterate over multiple VCF files
+    # get list of VCF files in the input directory
+
+    vcf_files = glob.glob(input_dir, recursive=True)
+    # chrom_name can be a single reference or a list of references (all kept in one pass)
+    chrom_names = chrom_name if isinstance(chrom_name, list) else [chrom_name]
+
+    # the GenBank file(s) are parsed a single time for all VCF files
+    with instrumentation.stage('read_genbank'):
+        genbank = GenBank(fname_genbank_file, table_file=table_file)
+        # mutations recurring across samples (and runs) are annotated once
+        memo = AnnotationMemo(memo_file, genbank.checksum) if memo_file else None
+
+    with instrumentation.stage('annotate'):
+        instrumentation.count_files(vcf_files)
+        if jobs > 1 and len(vcf_files) > 1:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                     initargs=(genbank, memo)) as executor:
+                for _, updates in executor.map(_annotate_vcf_task,
+                                               [(fname_snv_in, chrom_names, bgzip) for fname_snv_in in vcf_files]):
+                    if updates is not None:
+                        memo.merge(*updates)
+        else:
+            for fname_snv_in in vcf_files:
+                annotate_vcf_file(fname_snv_in, genbank, chrom_names, bgzip, memo)
+
+    if memo is not None:
+        memo.save()
+        logger.info('annotation memo: %d hits, %d misses, %d new annotations',
+                    memo.hits, memo.misses, len(memo.new_annotations))
 
 
 if __name__ == "__main__":
@@ -400,9 +618,24 @@ if __name__ == "__main__":
 
     parser.add_argument("input_dir",
                         help='path to input vcf file')
-    parser.add_argument("fname_genbank_file", help='genbank file')
-    parser.add_argument("chrom_name", help='reference name')
-
+    parser.add_argument("fname_genbank_file",
+                        help='genbank file (comma separated list for several references, e.g. RSV-A and RSV-B)')
+    parser.add_argument("chrom_name", nargs='+',
+                        help='reference name(s); records of all given references are annotated in a single pass')
+    parser.add_argument("--annotation-table", default=None,
+                        help='.npz file of the precomputed per-position annotation table, built from the GenBank '
+                             'file(s) if missing or outdated and reused by later runs')
+    parser.add_argument("--jobs", type=int, default=1, help='number of worker processes annotating the VCF files')
+    parser.add_argument("--bgzip", action='store_true',
+                        help='write bgzip-compressed, tabix-indexed snvs_annotated.vcf.gz files')
+    parser.add_argument("--memo", default=None,
+                        help='json file of memoized annotations, records seen before (in any VCF of this or an '
+                             'earlier run with the same GenBank files) are not annotated again')
+
+
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
-    main(args.input_dir, args.fname_genbank_file, args.chrom_name)
+    instrumentation.setup(args, 'annotate_vcf')
+    main(args.input_dir, args.fname_genbank_file.split(','), args.chrom_name, table_file=args.annotation_table,
+         jobs=args.jobs, bgzip=args.bgzip, memo_file=args.memo)
@@ -0,0 +1,118 @@
+import glob
+import numpy as np
+import pandas as pd
+import instrumentation
+from coverage_store import CoverageStore, is_coverage_store
+
+"""
+Coverage reader shared by extract_coverage_RSV_Vpipe.py, make_tallymut.py and make_mutation_tsv.py
+- read_coverage_by_reference function streams a 1-based coverage.tsv.gz file in chunks and fills one int32 array
+  per reference (contig), index i holding the coverage of position i + 1; only the wanted reference(s) and,
+  optionally, positions are kept
+- coverage_to_frame function converts such an array to the long (pos, coverage, sample) data frame
+- process_multiple_coverage_files function reads the coverage.tsv.gz files of all samples into a
+  samples x positions int32 matrix per reference, or maps the matrices of binary season coverage stores
+  (coverage_store.py) without parsing any text
+Positions missing from a coverage file are treated as zero coverage.
+"""
+
+# number of coverage.tsv rows parsed at once
+CHUNK_ROWS = 200000
+
+
+def read_coverage(coverage_tsv_file, sample_name, reference, positions=None, length=None):
+    return read_coverage_by_reference(coverage_tsv_file, sample_name, [reference],
+                                      {reference: positions} if positions is not None else None,
+                                      {reference: length} if length is not None else None)[reference]
+
+
+# Extract the coverage information from single coverage.tsv.gz file, for one or several references
+def read_coverage_by_reference(coverage_tsv_file, sample_name, references, positions=None, lengths=None):
+    coverage_column = f'{sample_name}/date'
+    coverage = {reference: np.zeros((lengths or {}).get(reference, 0), dtype=np.int32) for reference in references}
+    # lookup tables of the wanted positions
+    wanted = {reference: _position_mask(positions[reference]) for reference in references} if positions else None
+
+    # read coverage.tsv file chunk by chunk, only the needed columns
+    for chunk in pd.read_csv(coverage_tsv_file, sep='\t', usecols=['ref', 'pos', coverage_column],
+                             dtype={'ref': str, 'pos': np.int64, coverage_column: np.int32}, chunksize=CHUNK_ROWS):
+        instrumentation.count(rows=len(chunk))
+        for reference in references:
+            reference_rows = (chunk['ref'] == reference).to_numpy()
+            if not reference_rows.any():
+                continue
+            pos = chunk['pos'].to_numpy()[reference_rows]
+            depth = chunk[coverage_column].to_numpy()[reference_rows]
+            if wanted is not None:
+                # positions beyond the lookup table are not wanted
+                keep = np.zeros(len(pos), dtype=bool)
+                in_table = pos < len(wanted[reference])
+                keep[in_table] = wanted[reference][pos[in_table]]
+                pos, depth = pos[keep], depth[keep]
+                if len(pos) == 0:
+                    continue
+            # coverage.tsv files are 1-based
+            if pos.max() > len(coverage[reference]):
+                coverage[reference] = _grow(coverage[reference], int(pos.max()))
+            coverage[reference][pos - 1] = depth
+
+    return coverage
+
+
+def _position_mask(positions):
+    positions = np.asarray(list(positions), dtype=np.int64)
+    mask = np.zeros(positions.max() + 1 if len(positions) else 1, dtype=bool)
+    mask[positions] = True
+    return mask
+
+
+def _grow(coverage, length):
+    grown = np.zeros(length, dtype=np.int32)
+    grown[:len(coverage)] = coverage
+    return grown
+
+
+def coverage_to_frame(coverage, sample_name):
+    ''' function to convert a coverage array into a dataframe of columns pos (1-based), coverage and sample'''
+    return pd.DataFrame({'pos': np.arange(1, len(coverage) + 1),
+                         'coverage': coverage,
+                         'sample': sample_name})
+
+
+# Extract the coverage information from multiple coverage.tsv.gz files, every file is read a single time.
+# If samples is given, only the coverage files of these samples are read (coverage stores are mapped as a whole)
+def process_multiple_coverage_files(coverage_input_dir, references, positions=None, samples=None):
+    # a binary season coverage store per reference, e.g. coverage_stores/{reference}
+    if is_coverage_store(coverage_input_dir.format(reference=references[0])):
+        coverage_out = {}
+        for reference in references:
+            store = CoverageStore(coverage_input_dir.format(reference=reference))
+            coverage_out[reference] = (store.samples, store.matrix)
+        return coverage_out
+
+    # get list of coverage files in the input directory
+    coverage_files = glob.glob(coverage_input_dir, recursive=True)
+    # extract the sample name from the directory name
+    sample_names = [coverage_file.split('/')[-4] for coverage_file in coverage_files]
+    if samples is not None:
+        samples = set(samples)
+        wanted = [i for i, sample_name in enumerate(sample_names) if sample_name in samples]
+        coverage_files, sample_names = [coverage_files[i] for i in wanted], [sample_names[i] for i in wanted]
+    instrumentation.count_files(coverage_files)
+
+    rows = {reference: [] for reference in references}
+    for coverage_file, sample_name in zip(coverage_files, sample_names):
+        coverage = read_coverage_by_reference(coverage_file, sample_name, references, positions=positions)
+        for reference in references:
+            rows[reference].append(coverage[reference])
+
+    # samples x positions matrix per reference, column j holds position j + 1
+    coverage_out = {}
+    for reference in references:
+        length = max([len(coverage) for coverage in rows[reference]] + [0])
+        matrix = np.zeros((len(sample_names), length), dtype=np.int32)
+        for i, coverage in enumerate(rows[reference]):
+            matrix[i, :len(coverage)] = coverage
+        coverage_out[reference] = (pd.Index(sample_names), matrix)
+
+    return coverage_out
@@ -0,0 +1,108 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+"""
+Binary season coverage store of a single reference, written by extract_coverage_RSV_Vpipe.py --store
+- coverage.u32: samples x positions uint32 matrix (row-major), read memory-mapped, so rows (samples) and column
+  ranges (regions) are sliced without copying or parsing any text
+- index.json: reference, number of positions and the sample ids (with date and location, if known) in row order
+New samples are appended at the end of the matrix.
+"""
+
+DATA_FILE = 'coverage.u32'
+INDEX_FILE = 'index.json'
+
+
+def is_coverage_store(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+class CoverageStore(object):
+    """Memory-mapped samples x positions coverage matrix of one reference."""
+
+    def __init__(self, store_dir):
+        """Open an existing store."""
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE), 'r') as index_fh:
+            self.index = json.load(index_fh)
+        self.reference = self.index['reference']
+        self.length = self.index['length']
+        self.__matrix = None
+
+    @classmethod
+    def create(cls, store_dir, reference, length):
+        """Create an empty store for a reference of the given length."""
+        os.makedirs(store_dir, exist_ok=True)
+        open(os.path.join(store_dir, DATA_FILE), 'wb').close()
+        _write_json(os.path.join(store_dir, INDEX_FILE), {'reference': reference, 'length': int(length),
+                                                          'samples': []})
+        return cls(store_dir)
+
+    @property
+    def samples(self):
+        """Sample ids in row order."""
+        return pd.Index([sample['sample'] for sample in self.index['samples']])
+
+    @property
+    def sample_info(self):
+        """Sample ids, dates and locations as a data frame."""
+        return pd.DataFrame(self.index['samples'], columns=['sample', 'date', 'location'])
+
+    @property
+    def matrix(self):
+        """The (read-only) memory-mapped samples x positions matrix, column j holds position j + 1."""
+        n_samples = len(self.index['samples'])
+        if self.__matrix is None or self.__matrix.shape[0] != n_samples:
+            if n_samples == 0:
+                self.__matrix = np.zeros((0, self.length), dtype=np.uint32)
+            else:
+                self.__matrix = np.memmap(os.path.join(self.store_dir, DATA_FILE), dtype=np.uint32, mode='r',
+                                          shape=(n_samples, self.length))
+        return self.__matrix
+
+    def sample(self, sample_name):
+        """Coverage of a single sample (view)."""
+        return self.matrix[self.samples.get_loc(sample_name)]
+
+    def region(self, start, end):
+        """Coverage of all samples at the 1-based positions start to end (view)."""
+        return self.matrix[:, start - 1:end]
+
+    def append(self, sample_name, coverage, date=None, location=None):
+        """Append the coverage array of a new sample (index i holding position i + 1)."""
+        if sample_name in self.samples:
+            raise ValueError('sample {0} is already in the coverage store'.format(sample_name))
+        if len(coverage) > self.length:
+            raise ValueError('coverage of {0} is longer than the reference {1} ({2} > {3})'.format(
+                sample_name, self.reference, len(coverage), self.length))
+        row = np.zeros(self.length, dtype=np.uint32)
+        row[:len(coverage)] = coverage
+        self.__drop_unindexed_rows()
+        with open(os.path.join(self.store_dir, DATA_FILE), 'ab') as data_fh:
+            data_fh.write(row.tobytes())
+
+        self.index['samples'].append({'sample': sample_name, 'date': date, 'location': location})
+        _write_json(os.path.join(self.store_dir, INDEX_FILE), self.index)
+
+    def to_frame(self):
+        """Long data frame of columns pos (1-based), coverage and sample, as in collected_rsv_coverage_*.tsv."""
+        n_samples, length = self.matrix.shape
+        return pd.DataFrame({'pos': np.tile(np.arange(1, length + 1), n_samples),
+                             'coverage': self.matrix.ravel(),
+                             'sample': np.repeat(self.samples.to_numpy(), length)})
+
+    def __drop_unindexed_rows(self):
+        # rows of an interrupted append never made it into the index; only the writer drops them, readers ignore
+        # them (a reader could otherwise cut off the row of an append in progress)
+        data_path = os.path.join(self.store_dir, DATA_FILE)
+        expected_bytes = len(self.index['samples']) * self.length * 4
+        if os.path.getsize(data_path) > expected_bytes:
+            os.truncate(data_path, expected_bytes)
+
+
+def _write_json(path, content):
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(content, fh, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
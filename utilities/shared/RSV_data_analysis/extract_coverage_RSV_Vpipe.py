@@ -1,33 +1,36 @@
 import pandas as pd
 import glob
+import logging
 import argparse
+import instrumentation
+from coverage_reader import read_coverage, coverage_to_frame
+from coverage_store import CoverageStore, is_coverage_store
 
 """
 Extract information from 1-based coverage.tsv.gz files after running V-pipe from each sample and
-produce a single csv file with coverage
+produce a single csv file with coverage, or (--store) append the samples to a binary season coverage store
 """
 
+logger = logging.getLogger(__name__)
+
 def extract_cov(coverage_tsv_file, sample_name, reference):
-    # read coverage.tsv file
-    coverage_file = pd.read_csv(coverage_tsv_file, sep = '\t', usecols = ['ref', 'pos', f'{sample_name}/date'])
+    # read coverage.tsv file (streamed, only rows of the reference are kept)
+    coverage = read_coverage(coverage_tsv_file, sample_name, reference)
     # coverage.tsv files are 1-based
-    coverage_file = coverage_file[coverage_file['ref']==reference]
-    position = pd.DataFrame(coverage_file['pos'])
-    coverage = pd.DataFrame(coverage_file[f'{sample_name}/date']).rename(columns={f'{sample_name}/date': 'coverage'})
-    total_coverage = pd.concat([position, coverage], axis=1).set_index('pos')
-    total_coverage['sample'] = sample_name
-    print(total_coverage.head())
+    total_coverage = coverage_to_frame(coverage, sample_name).set_index('pos')
+    logger.debug('%s', total_coverage.head())
     return total_coverage
 
 def process_multiple_coverage_files(input_dir, reference_genome):
 
     # get list of coverage files in the input directory
     coverage_files = glob.glob(input_dir, recursive = True)
+    instrumentation.count_files(coverage_files)
     rows = []
     for coverage_file in coverage_files:
         # extract the sample name from the directory name
         sample_name = coverage_file.split('/')[-4]
-        print(sample_name)
+        logger.debug(sample_name)
 
         df = extract_cov(coverage_file, sample_name, reference=reference_genome)
         # append the dataframe to the list of dataframes
@@ -37,9 +40,50 @@ def process_multiple_coverage_files(input_dir, reference_genome):
     return coverage_out
 
 
-def main(input_dir_cov, reference_genome):
-    collected_subsampled_coverage = process_multiple_coverage_files(input_dir_cov, reference_genome)
-    collected_subsampled_coverage.to_csv(f'collected_rsv_coverage_{input_dir_cov.split("/")[-6]}.tsv')
+# Append the samples not yet in the coverage store, with date and location from timeline.tsv (if given)
+def update_coverage_store(input_dir, reference_genome, store_dir, timeline_tsv=None):
+    sample_info = {}
+    if timeline_tsv:
+        timeline = pd.read_csv(timeline_tsv, sep='\t', usecols=['submissionId', 'date', 'location'], dtype=str)
+        sample_info = timeline.set_index('submissionId').to_dict('index')
+
+    store = CoverageStore(store_dir) if is_coverage_store(store_dir) else None
+    if store is not None and store.reference != reference_genome:
+        raise ValueError(f'coverage store {store_dir} holds {store.reference}, not {reference_genome}')
+
+    # get list of coverage files in the input directory
+    coverage_files = glob.glob(input_dir, recursive = True)
+    new_coverage = {}
+    for coverage_file in coverage_files:
+        # extract the sample name from the directory name
+        sample_name = coverage_file.split('/')[-4]
+        if store is not None and sample_name in store.samples:
+            continue
+        instrumentation.count_files([coverage_file])
+        new_coverage[sample_name] = read_coverage(coverage_file, sample_name, reference_genome)
+
+    # a new store is as long as the longest coverage of the samples added, not only of the first one
+    if store is None and new_coverage:
+        store = CoverageStore.create(store_dir, reference_genome,
+                                     max(len(coverage) for coverage in new_coverage.values()))
+    for sample_name, coverage in new_coverage.items():
+        logger.info('adding %s to the coverage store', sample_name)
+        info = sample_info.get(sample_name, {})
+        store.append(sample_name, coverage, date=info.get('date'), location=info.get('location'))
+
+    return store
+
+
+def main(input_dir_cov, reference_genome, store_dir=None, timeline_tsv=None):
+    if store_dir:
+        with instrumentation.stage('update_store'):
+            update_coverage_store(input_dir_cov, reference_genome, store_dir, timeline_tsv)
+        return
+    with instrumentation.stage('read_coverage'):
+        collected_subsampled_coverage = process_multiple_coverage_files(input_dir_cov, reference_genome)
+    with instrumentation.stage('write'):
+        collected_subsampled_coverage.to_csv(f'collected_rsv_coverage_{input_dir_cov.split("/")[-6]}.tsv')
+        instrumentation.count(rows=len(collected_subsampled_coverage))
 
 
 if __name__ == '__main__':
@@ -47,5 +91,11 @@ if __name__ == '__main__':
     parser.add_argument("input_dir_cov",
                         help='input directory containing coverage.tsv.gz files')
     parser.add_argument("reference_genome")
+    parser.add_argument("--store", default=None,
+                        help='directory of a binary season coverage store to create or append new samples to, '
+                             'instead of writing the csv file')
+    parser.add_argument("--timeline", default=None, help='timeline.tsv with the dates and locations of the samples')
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
-    main(args.input_dir_cov, args.reference_genome)
\ No newline at end of file
+    instrumentation.setup(args, 'extract_coverage_RSV_Vpipe')
+    main(args.input_dir_cov, args.reference_genome, store_dir=args.store, timeline_tsv=args.timeline)
\ No newline at end of file
@@ -0,0 +1,147 @@
+import atexit
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+"""
+Stage-level instrumentation shared by the scripts (make_tallymut.py, make_mutation_tsv.py, extract_coverage_RSV_Vpipe.py,
+annotate_vcf.py)
+- stage(name) context manager measures the wall time, CPU time and peak resident memory of a stage; the readers add
+  the rows processed, the files opened and their size (file_bytes) to the innermost open stage (count, count_files),
+  nested stages add up to their parent; file_bytes is the size of the input files, not the bytes actually read
+  (fewer for the region fetches from tabix-indexed VCFs)
+- enabled by --profile (add_arguments, setup): every finished stage is a line of a JSONL report, closed by a summary
+  line of the whole run; --profiler cprofile|pyinstrument also captures a profile of the run next to the report
+- --log-level sets the level of the logging output, large debug output (data frames) is only formatted at DEBUG
+Without --profile, stages are only logged at DEBUG level and counting does nothing.
+"""
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+COUNTERS = ['rows', 'files', 'file_bytes']
+
+# report of the current run, None if --profile is not given
+_report = None
+
+
+class Report(object):
+    """JSONL report of the stages of a run, and the optional profiler capturing the run."""
+
+    def __init__(self, path, script, profiler=None):
+        self.path = path
+        self.script = script
+        self.run = '{0}-{1}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+        self.open_stages = []
+        self.totals = dict.fromkeys(COUNTERS, 0)
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.profiler_name = profiler
+        self.profiler = None
+        if profiler == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profiler == 'pyinstrument':
+            # pyinstrument is only needed for its profiles
+            from pyinstrument import Profiler
+            self.profiler = Profiler()
+            self.profiler.start()
+
+    def write(self, record):
+        record = dict({'script': self.script, 'run': self.run}, **record)
+        with open(self.path, 'a') as fh:
+            fh.write(json.dumps(record) + '\n')
+
+    def close(self):
+        record = {'stage': None, 'wall_seconds': time.perf_counter() - self.start,
+                  'cpu_seconds': time.process_time() - self.start_cpu, **self.totals, **_peak_memory(),
+                  'argv': sys.argv}
+        if self.profiler_name == 'cprofile':
+            self.profiler.disable()
+            record['profile'] = _profile_path(self.path, '.prof')
+            self.profiler.dump_stats(record['profile'])
+        elif self.profiler_name == 'pyinstrument':
+            self.profiler.stop()
+            record['profile'] = _profile_path(self.path, '.html')
+            with open(record['profile'], 'w') as fh:
+                fh.write(self.profiler.output_html())
+        self.write(record)
+
+
+@contextmanager
+def stage(name):
+    """Measure a stage of the script; yields the counters of the stage (rows, files, file_bytes)."""
+    counters = dict.fromkeys(COUNTERS, 0)
+    if _report is not None:
+        _report.open_stages.append((name, counters))
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield counters
+    finally:
+        wall = time.perf_counter() - start
+        logger.debug('%s: %.2f s', name, wall)
+        if _report is not None:
+            _report.open_stages.pop()
+            # counts of a nested stage are also counts of its parent
+            if _report.open_stages:
+                parent = _report.open_stages[-1][1]
+                for counter in COUNTERS:
+                    parent[counter] += counters[counter]
+            _report.write({'stage': '/'.join([open_name for open_name, _ in _report.open_stages] + [name]),
+                           'wall_seconds': wall, 'cpu_seconds': time.process_time() - start_cpu,
+                           **counters, **_peak_memory()})
+
+
+def count(rows=0, files=0, file_bytes=0):
+    """Add to the counters of the innermost open stage (and to the totals of the run)."""
+    if _report is None:
+        return
+    counts = {'rows': rows, 'files': files, 'file_bytes': file_bytes}
+    for counter in COUNTERS:
+        _report.totals[counter] += counts[counter]
+        if _report.open_stages:
+            _report.open_stages[-1][1][counter] += counts[counter]
+
+
+def count_files(paths):
+    """Count files opened and their size on disk (not the bytes read from them)."""
+    if _report is None:
+        return
+    paths = list(paths)
+    count(files=len(paths), file_bytes=sum(os.path.getsize(path) for path in paths if os.path.exists(path)))
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', nargs='?', const='', default=None,
+                        help='write a JSONL report of the stages (wall and CPU time, rows, files opened and their size, '
+                             'peak memory) to the given file (default: <script>.profile.jsonl)')
+    parser.add_argument('--profiler', default=None, choices=['cprofile', 'pyinstrument'],
+                        help='with --profile, also capture a profile of the run next to the report')
+    parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS,
+                        help='level of the log output, DEBUG shows the intermediate data frames')
+
+
+def setup(args, script):
+    """Configure logging and, with --profile, the report of the run (closed when the script exits)."""
+    global _report
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+    if args.profile is None:
+        return
+    _report = Report(args.profile or f'{script}.profile.jsonl', script, profiler=args.profiler)
+    atexit.register(_report.close)
+
+
+def _peak_memory():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS; children are the finished worker processes
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+
+def _profile_path(report_path, extension):
+    return (report_path[:-len('.jsonl')] if report_path.endswith('.jsonl') else report_path) + extension
@@ -0,0 +1,161 @@
+import os
+import sys
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rsv_definitions'))
+from lapis_client import LapisClient, LAPIS_URL, MAX_WORKERS
+
+"""
+Local snapshot store of LAPIS aggregate tables (aminoAcidMutations, nucleotideMutations), a single SQLite file
+- snapshot command downloads the tables of every virus once, globally and per country (all mutations,
+  minProportion=0, no limit), concurrently with the client of rsv_definitions/lapis_client.py; one snapshot is
+  written in a single transaction, with the time it was taken and the dataVersion of LAPIS
+- mutations are indexed by (mutation, country), so the proportion of a handful of mutations, globally or in a
+  country, is answered offline (query command, SnapshotStore.proportions, used by query_amino_acid_subst.py)
+- queries read the latest snapshot, or a given one, so tables of the preprint are reproducible
+Global tables are stored with an empty country.
+"""
+
+SNAPSHOT_DB = 'lapis_snapshot.sqlite'
+VIRUSES = ['rsv-a', 'rsv-b']
+ENDPOINTS = ['aminoAcidMutations']
+COUNTRIES = ['Switzerland']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, taken_at TEXT, base_url TEXT);
+CREATE TABLE IF NOT EXISTS snapshot_tables (snapshot INTEGER, virus TEXT, endpoint TEXT, country TEXT,
+                                            data_version TEXT, rows INTEGER);
+CREATE TABLE IF NOT EXISTS mutations (snapshot INTEGER, virus TEXT, endpoint TEXT, country TEXT, mutation TEXT,
+                                      count INTEGER, proportion REAL);
+CREATE INDEX IF NOT EXISTS mutations_mutation_country ON mutations (mutation, country, virus, endpoint, snapshot);
+"""
+
+
+class SnapshotStore(object):
+    """SQLite store of snapshots of LAPIS mutation tables."""
+
+    def __init__(self, path=SNAPSHOT_DB):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def snapshot(self, client, viruses=VIRUSES, endpoints=ENDPOINTS, countries=COUNTRIES):
+        """Download the tables of every virus and endpoint, globally and per country; returns the snapshot id."""
+        tables = [(virus, endpoint, country) for virus in viruses for endpoint in endpoints
+                  for country in [''] + list(countries)]
+
+        def fetch(table):
+            virus, endpoint, country = table
+            params = {'minProportion': 0.0, 'orderBy': 'sequenceName'}
+            if country:
+                params['country'] = country
+            return client.response(virus, endpoint, params)
+
+        with ThreadPoolExecutor(max_workers=client.max_workers) as executor:
+            responses = list(executor.map(fetch, tables))
+
+        # the whole snapshot or nothing
+        with self.connection:
+            snapshot = self.connection.execute(
+                'INSERT INTO snapshots (taken_at, base_url) VALUES (?, ?)',
+                (datetime.now(timezone.utc).isoformat(timespec='seconds'), client.base_url)).lastrowid
+            for (virus, endpoint, country), response in zip(tables, responses):
+                records = response['data']
+                self.connection.execute('INSERT INTO snapshot_tables VALUES (?, ?, ?, ?, ?, ?)',
+                                        (snapshot, virus, endpoint, country,
+                                         str(response.get('info', {}).get('dataVersion', '')), len(records)))
+                self.connection.executemany('INSERT INTO mutations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            [(snapshot, virus, endpoint, country, record['mutation'],
+                                              record['count'], record['proportion']) for record in records])
+        return snapshot
+
+    def snapshots(self):
+        """Snapshots taken, with the tables of each."""
+        return pd.read_sql_query('SELECT id AS snapshot, taken_at, base_url, virus, endpoint, country, data_version, '
+                                 'rows FROM snapshots JOIN snapshot_tables ON snapshot_tables.snapshot = snapshots.id '
+                                 'ORDER BY id, virus, endpoint, country', self.connection)
+
+    def latest(self):
+        """Id of the latest snapshot, None if there is none."""
+        return self.connection.execute('SELECT MAX(id) FROM snapshots').fetchone()[0]
+
+    def proportions(self, virus, mutations, country=None, endpoint='aminoAcidMutations', snapshot=None):
+        """
+        Count and proportion of the mutations (found in the table) in the latest or given snapshot, globally or in a
+        country, with the total number of sequences (count / proportion), in the order of the LAPIS table; raises
+        ValueError if the snapshot has no such table.
+        """
+        snapshot = snapshot if snapshot is not None else self.latest()
+        if snapshot is None:
+            raise ValueError('no snapshot in {0}, run lapis_snapshot.py snapshot first'.format(self.path))
+        if self.connection.execute('SELECT 1 FROM snapshot_tables WHERE snapshot = ? AND virus = ? AND endpoint = ? '
+                                   'AND country = ?', (snapshot, virus, endpoint, country or '')).fetchone() is None:
+            raise ValueError('snapshot {0} of {1} has no {2} table of {3} ({4}), take a snapshot with it first'.format(
+                snapshot, self.path, endpoint, virus, country or 'global'))
+        mutations = list(mutations)
+        proportions = pd.read_sql_query(
+            'SELECT mutation, count, proportion FROM mutations WHERE mutation IN ({0}) AND country = ? AND virus = ? '
+            'AND endpoint = ? AND snapshot = ? ORDER BY rowid'.format(', '.join('?' * len(mutations))),
+            self.connection, params=mutations + [country or '', virus, endpoint, snapshot])
+        proportions['total'] = proportions['count'] / proportions['proportion']
+        return proportions
+
+
+def main(db=SNAPSHOT_DB, viruses=VIRUSES, endpoints=ENDPOINTS, countries=COUNTRIES, base_url=LAPIS_URL,
+         max_workers=MAX_WORKERS):
+    store = SnapshotStore(db)
+    snapshot = store.snapshot(LapisClient(base_url=base_url, max_workers=max_workers), viruses=viruses,
+                              endpoints=endpoints, countries=countries)
+    snapshots = store.snapshots()
+    print(snapshots[snapshots['snapshot'] == snapshot].to_string(index=False))
+    store.close()
+
+
+def query(db, virus, mutations, country=None, endpoint='aminoAcidMutations', snapshot=None):
+    store = SnapshotStore(db)
+    print(store.proportions(virus, mutations, country=country, endpoint=endpoint, snapshot=snapshot)
+          .to_string(index=False))
+    store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local snapshot store of LAPIS mutation tables')
+    parser.add_argument('--db', default=SNAPSHOT_DB, help='SQLite file of the snapshots')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    snapshot_parser = commands.add_parser('snapshot', help='download the tables of LAPIS into a new snapshot')
+    snapshot_parser.add_argument('--viruses', nargs='+', default=VIRUSES)
+    snapshot_parser.add_argument('--endpoints', nargs='+', default=ENDPOINTS,
+                                 help='aggregate tables, e.g. aminoAcidMutations nucleotideMutations')
+    snapshot_parser.add_argument('--countries', nargs='*', default=COUNTRIES,
+                                 help='countries downloaded besides the global tables')
+    snapshot_parser.add_argument('--base-url', default=LAPIS_URL, help='LAPIS instance to query')
+    snapshot_parser.add_argument('--max-workers', type=int, default=MAX_WORKERS, help='number of concurrent requests')
+
+    query_parser = commands.add_parser('query', help='proportions of mutations in a snapshot, e.g. F:T12I')
+    query_parser.add_argument('virus', help='e.g. rsv-a')
+    query_parser.add_argument('mutations', nargs='+')
+    query_parser.add_argument('--country', default=None, help='country of the table (default: global)')
+    query_parser.add_argument('--endpoint', default='aminoAcidMutations')
+    query_parser.add_argument('--snapshot', type=int, default=None, help='snapshot id (default: the latest)')
+
+    commands.add_parser('list', help='snapshots in the store')
+
+    args = parser.parse_args()
+    if args.command == 'snapshot':
+        main(args.db, viruses=args.viruses, endpoints=args.endpoints, countries=args.countries,
+             base_url=args.base_url, max_workers=args.max_workers)
+    elif args.command == 'query':
+        query(args.db, args.virus, args.mutations, country=args.country, endpoint=args.endpoint,
+              snapshot=args.snapshot)
+    else:
+        store = SnapshotStore(args.db)
+        print(store.snapshots().to_string(index=False))
+        store.close()
@@ -1,11 +1,18 @@
+import os
+import logging
 import numpy as np
-import pysam
 import pandas as pd
-import json
-import glob
 import argparse
-import re
+import coverage_reader
+import instrumentation
+from vcf_ingest import process_multiple_vcfs_by_reference, list_vcf_files
+from parse_cache import ParseCache
+from mutation_catalog import MutationCatalog
+from mutation_matrix import MutationMatrix
+from timeline_io import write_timeline, is_binary_timeline, JSON_COLUMNS
+from timeline_state import TimelineState
 
+logger = logging.getLogger(__name__)
 
 THRESHOLD_VALUE = 0.02
 RARE_MUTATION_LIMIT_DAYS = 2
@@ -23,123 +30,72 @@ def extract_codon_position(value):
     return '*'  # if no number is found, return NaN
 
 
-# Processing vcf files
-
-# Iterate over multiple VCF files and use the name of the directory containing each file as the sample name
-def load_convert(vcf_path, sample_name, reference):
-    ''' function to load a vcf and output a Pandas dataframe'''
-    # Create a VariantFile object
-    vcf_file = pysam.VariantFile(vcf_path)
-    # record rows for df
-    rows = []
-
-    # iterate over the records (variants) in the VCF file
-    for record in vcf_file:
-        if record.chrom == reference:
-            # iterate over possible mutated positions
-            for alt in record.alts:
-                # Take allele frequences (AF) from INFO
-                af = record.info.get('AF')
-
-                CodonPosition = record.info.get('CodonPosition')
-                RefAminoAcid = record.info.get('RefAminoAcid')
-                AltAminoAcid = record.info.get('AltAminoAcid')
-                Gene = record.info.get('Gene')
-                # put results in rows
-                row = {
-                    'sample': sample_name,
-                    'pos': record.pos,
-                    'ref': record.ref,
-                    'alt': alt,
-                    'af': af,
-                    # 'CodonPosition': extract_codon_position(CodonPosition),
-                    'CodonPosition': CodonPosition,
-                    'RefAminoAcid': RefAminoAcid[0],
-                    'AltAminoAcid': AltAminoAcid[0],
-                    'Gene': Gene[0]
-
-                }
-                rows.append(row)
-    # close the VCF file
-    vcf_file.close()
-    # convert to dataframe
-    df_out = pd.DataFrame(rows)
-
-    return df_out
-
-
-def process_multiple_vcfs(input_dir, reference):
-    # get list of VCF files in the input directory
-    vcf_files = glob.glob(input_dir, recursive=True)
-
-    # record rows for df
-    rows = []
-    # iterate over the VCF files from the list
-    for vcf_file in vcf_files:
-        # extract the sample name from the directory name
-        sample_name = vcf_file.split('/')[-5]
-        # load the VCF and convert to dataframe
-        df = load_convert(vcf_file, sample_name, reference)
-        # append the dataframe to the list of rows
-        rows.append(df)
-
-    # concatenate all dataframes
-    df_out = pd.concat(rows, axis=0, ignore_index=True)
-
-    return (df_out)
-
-
-def create_mut_freq_dict(col):
-    # create empty dictionary to hold the mutation proportions for this sample
-    mutation_proportions = {}
-    # iterate through all columns except the 'sample' column
-    for mutation, frequency in col.items():
-        if pd.isna(frequency):
-            mutation_proportions[mutation] = None
-        else:
-            mutation_proportions[mutation] = frequency
-
-    # convert dictionary to a json-formatted string with double quotes
-    mutation_json = json.dumps(mutation_proportions, ensure_ascii=False)
-    # print(mutation_json)
-    return mutation_json
-
-
-def extract_cov(coverage_tsv_file, sample_name, reference):
-    # read coverage.tsv file
-    coverage_file = pd.read_csv(coverage_tsv_file, sep='\t', usecols=['ref', 'pos', f'{sample_name}/date'])
-    # coverage.tsv files are 1-based
-    coverage_file = coverage_file[coverage_file['ref'] == reference]
-    position = pd.DataFrame(coverage_file['pos'])
-    coverage = pd.DataFrame(coverage_file[f'{sample_name}/date']).rename(columns={f'{sample_name}/date': 'coverage'})
-    total_coverage = pd.concat([position, coverage], axis=1).set_index('pos')
-    total_coverage['sample'] = sample_name
-    # print(total_coverage.head())
-    return total_coverage
-
-
-def process_multiple_coverage_files(input_dir, reference_genome):
-    # get list of coverage files in the input directory
-    coverage_files = glob.glob(input_dir, recursive=True)
-    rows = []
-    for coverage_file in coverage_files:
-        # extract the sample name from the directory name
-        sample_name = coverage_file.split('/')[-4]
-        # print(sample_name)
-
-        df = extract_cov(coverage_file, sample_name, reference=reference_genome)
-        # append the dataframe to the list of dataframes
-        rows.append(df)
-
-    coverage_out = pd.concat(rows, axis=0, ignore_index=False)
-    return coverage_out
-
-
-def main(path_to_vcf, timeline_tsv, path_to_coverage, reference):
-    # Process multiple vcfs and produce data frame
-
-    output_multiple_vcfs = process_multiple_vcfs(path_to_vcf, reference)
-    # print(output_multiple_vcfs)
+def main(path_to_vcf, timeline_tsv, path_to_coverage, reference, jobs=1, cache_dir=None, cache_max_mb=1024,
+         region=None, output_format='tsv', update=False):
+    # several references can be processed at once (with one timeline.tsv per reference, or a single shared one);
+    # every VCF and coverage file is then read a single time and routed by contig
+    references = reference if isinstance(reference, list) else [reference]
+    timeline_tsvs = timeline_tsv.split(',') if isinstance(timeline_tsv, str) else timeline_tsv
+    timeline_tsvs = dict(zip(references, timeline_tsvs * len(references) if len(timeline_tsvs) == 1 else timeline_tsvs))
+    # the output of a single reference keeps its season name, several references are told apart by name
+    output_names = {reference: path_to_vcf.split("/")[-7] + (f'_{reference}' if len(references) > 1 else '')
+                    for reference in references}
+
+    # Process multiple vcfs (with annotation info fields) and produce data frame
+    # parsed VCFs are reused between reruns if a cache directory is given
+    cache = ParseCache(cache_dir, max_bytes=cache_max_mb * 1024 * 1024) if cache_dir else None
+
+    if update:
+        update_timelines(path_to_vcf, timeline_tsvs, path_to_coverage, references, output_names, output_format,
+                         jobs=jobs, cache=cache, region=region)
+        return
+
+    # region (start, end) limits the mutations to a genome window, e.g. the F gene;
+    # bgzipped and tabix-indexed VCFs are then only read in that window
+    with instrumentation.stage('read_vcfs'):
+        output_multiple_vcfs = process_multiple_vcfs_by_reference(path_to_vcf, references, annotated=True, jobs=jobs,
+                                                                  cache=cache,
+                                                                  regions={reference: region for reference in references}
+                                                                  if region else None)
+    # coverage is only needed at the positions of the called mutations
+    with instrumentation.stage('read_coverage'):
+        collected_coverage = coverage_reader.process_multiple_coverage_files(
+            path_to_coverage, references,
+            positions={reference: output_multiple_vcfs[reference]['pos'].unique() for reference in references})
+
+    for reference in references:
+        with instrumentation.stage(f'timeline_{reference}'):
+            tsv_samples_locations, mutation_matrices = make_timeline_mutations(output_multiple_vcfs[reference],
+                                                                               collected_coverage[reference],
+                                                                               timeline_tsvs[reference])
+
+            # .tsv with json columns, or a long .parquet/.arrow table (timeline_io.py)
+            with instrumentation.stage('write'):
+                write_timeline(tsv_samples_locations, f'timeline_mutation_{output_names[reference]}.{output_format}',
+                               mutation_matrices)
+                instrumentation.count(rows=len(tsv_samples_locations))
+
+
+# Mask of sufficient coverage of the samples at the positions of the mutations (samples x mutations, one bit per
+# sample and mutation), parsing every position once; samples or positions without coverage information have zero coverage
+def coverage_mask(collected_coverage, mutations, samples):
+    coverage_samples, coverage_matrix = collected_coverage
+    columns = MutationCatalog().positions(mutations) - 1
+    known_columns = np.flatnonzero(columns < coverage_matrix.shape[1])
+
+    covered = np.zeros((len(samples), (len(columns) + 7) // 8), dtype=np.uint8)
+    for i, row in enumerate(coverage_samples.get_indexer(samples)):
+        if row < 0:
+            continue
+        sample_covered = np.zeros(len(columns), dtype=bool)
+        sample_covered[known_columns] = coverage_matrix[row, columns[known_columns]] >= COVERAGE_THRESHOLD
+        covered[i] = np.packbits(sample_covered)
+    return covered
+
+
+# Nucleotide and amino acid mutation keys of the calls of the processed vcfs, columns sample, mut, freq_total, AA_mut
+# and mut_aa_mut
+def mutation_calls(output_multiple_vcfs):
     output_multiple_vcfs['ref_pos'] = output_multiple_vcfs['ref'] + output_multiple_vcfs['pos'].astype(str)
     output_multiple_vcfs['mut'] = output_multiple_vcfs['ref_pos'] + output_multiple_vcfs['alt']
     output_multiple_vcfs['freq_total'] = output_multiple_vcfs['af']
@@ -152,115 +108,204 @@ def main(path_to_vcf, timeline_tsv, path_to_coverage, reference):
 
     output_multiple_vcfs = output_multiple_vcfs[['sample', 'mut', 'freq_total', 'AA_mut']].drop_duplicates()
     output_multiple_vcfs['mut_aa_mut'] = output_multiple_vcfs['AA_mut'] + '_' + output_multiple_vcfs['mut']
-    print(output_multiple_vcfs)
-    #    output_multiple_vcfs = output_multiple_vcfs[['sample', 'mut', 'freq_total']].drop_duplicates()
-    mut_freq = output_multiple_vcfs.pivot_table(values='freq_total',
-                                                index='mut',
-                                                columns='sample',
-                                                sort=False)
-
-    # For positions where coverage is > threshold, set missing values to zeros (mutation is not present)
-    collected_coverage = process_multiple_coverage_files(path_to_coverage, reference)
-    collected_coverage = collected_coverage.pivot_table(values='coverage',
-                                                        index='pos',
-                                                        columns='sample',
-                                                        sort=False)
-    print(len(mut_freq.index))
-    mut_freq.columns = mut_freq.columns.astype(str)
-
-    for mut in mut_freq.index:  # iterate over the mutations
-        position = int(re.findall(r'\d+', mut)[0])
-
-        for sample in mut_freq.columns:
-            # coverage_at_position = collected_coverage[(collected_coverage.index == position) & (collected_coverage["sample"] == sample)]
-            if (collected_coverage.loc[position, sample] >= COVERAGE_THRESHOLD):
-                if (pd.isna(mut_freq.loc[mut, sample])):
-                    mut_freq.loc[mut, sample] = 0.0
-            # if coverage at the position is below the COVERAGE_THRESHOLD -> missing value
-            else:
-                mut_freq.loc[mut, sample] = np.nan
-
-        # We trust only mutations that appear above THRESHOLD_VALUE for at least RARE_MUTATION_LIMIT_DAYS days
-    nonzero_counts = ((mut_freq > THRESHOLD_VALUE) & pd.notna(mut_freq)).sum(axis=1)
-    # print(nonzero_counts)
-    rare_mutations = nonzero_counts[nonzero_counts < RARE_MUTATION_LIMIT_DAYS]
-    # print(rare_mutations)
-    print(mut_freq.index.isin(rare_mutations.index))
-    # Drop the rows with rare mutations from the DataFrame
-    # rare_mutations.to_frame().reset_index(inplace=True)
-
-    #    rare_mutations.index = rare_mutations.index.astype(str)
-    # print(rare_mutations)
-
-    #    print(mut_freq[mut_freq.index.isin(rare_mutations.index)])
-    #    mut_freq.reset_index(inplace=True)
-    print(mut_freq)
-    mut_freq_old = mut_freq
-    mut_freq = mut_freq[~mut_freq_old.index.isin(rare_mutations.index)]  # ~mut_freq.index.isin(rare_mutations.index)]
-    print(len(mut_freq_old.index))
-    print(len(rare_mutations.index))
-    # set index back
-    #    mut_freq.set_index(mut_freq.columns[0])
-    #    output_multiple_vcfs = output_multiple_vcfs[~output_multiple_vcfs['mut'].isin(rare_mutations.index)]
-    # make missing a.a. mutations unique (otherwise cannot set as an index)
-
-    AA_mut_freq = output_multiple_vcfs.pivot_table(values='freq_total',
-                                                   index='mut_aa_mut',
-                                                   columns='sample',
-                                                   sort=False)
-
-    #    print(keep_mut_numeric_index)
-    print(len(AA_mut_freq.index))
-
-    #    AA_mut_freq.reset_index(inplace=True)
-
-    AA_mut_freq = AA_mut_freq.loc[
-        ~mut_freq_old.index.isin(rare_mutations.index)]  # ~AA_mut_freq.index.isin(rare_mutations.index)]
-    #    AA_mut_freq.set_index(AA_mut_freq.columns[0], inplace=True)
-
-    #    AA_mut_freq = AA_mut_freq[~mut_freq.index.isin(rare_mutations.index)]
-    print(AA_mut_freq)
-    #    AA_mut_freq.set_index(AA_mut_freq.columns[0], inplace=True)
-
-    #    AA_mut_freq.columns = AA_mut_freq.columns.astype(str) # the order of the columns should be the same as mut_freq
-
-    #    rare_mut_numeric_index = rare_mutations.reset_index().index.tolist()
+    return output_multiple_vcfs
 
+
+# samples of the timeline with empty mutation frequency columns, filled in by timeline_io.write_timeline
+def timeline_samples(timeline_tsv):
     tsv_samples_locations = pd.read_csv(timeline_tsv, sep='\t',
                                         usecols=["submissionId", "date", "location", "primerProtocol", "reference"])
-
-    # Each column of mut_freq is passed to the create_mut_freq_dict function as a pandas Series
-    # print("new")
-    # print(mut_freq.shape)
-    # print(AA_mut_freq.shape)
-    nucleotide_mut_freq = mut_freq.apply(create_mut_freq_dict, axis=0)
-    # print(nucleotide_mut_freq)
-    AA_mut_freq_dict = AA_mut_freq.apply(create_mut_freq_dict, axis=0)
-    # print(AA_mut_freq_dict)
-
-    tsv_samples_locations['nucleotideMutationFrequency'] = tsv_samples_locations["submissionId"].map(
-        nucleotide_mut_freq)
-
-    tsv_samples_locations['aminoAcidMutationFrequency'] = tsv_samples_locations["submissionId"].map(
-        AA_mut_freq_dict)
+    for column in JSON_COLUMNS:
+        tsv_samples_locations[column] = None
 
     tsv_samples_locations['lineageFrequencyEstimates'] = None
 
-    tsv_samples_locations.to_csv(
-        f'timeline_mutation_{path_to_vcf.split("/")[-7]}.tsv', sep='\t',
-        index=False, quoting=3)
+    return tsv_samples_locations
+
+
+# Prepare the timeline with nucleotide and amino acid mutation frequencies of a single reference
+def make_timeline_mutations(output_multiple_vcfs, collected_coverage, timeline_tsv):
+    output_multiple_vcfs = mutation_calls(output_multiple_vcfs)
+    logger.debug('calls:\n%s', output_multiple_vcfs)
+    # sparse samples x mutations matrix of the calls, mutations in order of their first appearance
+    mut_freq = MutationMatrix.from_calls(output_multiple_vcfs['sample'], output_multiple_vcfs['mut'],
+                                         output_multiple_vcfs['freq_total'], sort=False)
+
+    # For positions where coverage is > threshold, set missing values to zeros (mutation is not present),
+    # where coverage is below the threshold the value is missing
+    logger.debug('%d mutations', len(mut_freq.mutations))
+    mut_freq = mut_freq.with_coverage_mask(coverage_mask(collected_coverage, mut_freq.mutations, mut_freq.samples))
+
+    # We trust only mutations that appear above THRESHOLD_VALUE for at least RARE_MUTATION_LIMIT_DAYS days
+    nonzero_counts = mut_freq.count_above(THRESHOLD_VALUE)
+    is_rare = nonzero_counts < RARE_MUTATION_LIMIT_DAYS
+    logger.debug('rare mutations: %s\n%r', is_rare, mut_freq)
+    # Drop the rare mutations
+    logger.info('%d of %d mutations are rare and dropped', is_rare.sum(), len(mut_freq.mutations))
+    mut_freq = mut_freq.take_mutations(~is_rare)
+
+    AA_mut_freq = MutationMatrix.from_calls(output_multiple_vcfs['sample'], output_multiple_vcfs['mut_aa_mut'],
+                                            output_multiple_vcfs['freq_total'], sort=False)
+    logger.debug('%d amino acid mutations', len(AA_mut_freq.mutations))
+    # amino acid mutations are in the same order as the nucleotide mutations
+    AA_mut_freq = AA_mut_freq.take_mutations(~is_rare)
+    logger.debug('%r', AA_mut_freq)
+
+    # mutation frequencies per sample, written as json dictionaries or as a long table by timeline_io.write_timeline
+    mutation_matrices = {'nucleotideMutationFrequency': mut_freq, 'aminoAcidMutationFrequency': AA_mut_freq}
+
+    return timeline_samples(timeline_tsv), mutation_matrices
+
+
+
+# Incremental update of the timelines: only the VCF and coverage files of samples not processed before are read.
+# The calls, coverage bits and support counts of the processed samples are kept in a state sidecar per timeline
+# (timeline_state.py); without a state (or with other thresholds), the full season is computed and the state written
+def update_timelines(path_to_vcf, timeline_tsvs, path_to_coverage, references, output_names, output_format, jobs=1,
+                     cache=None, region=None):
+    settings = {'threshold_value': THRESHOLD_VALUE,
+                'rare_mutation_limit_days': RARE_MUTATION_LIMIT_DAYS,
+                'coverage_threshold': COVERAGE_THRESHOLD,
+                'region': list(region) if region else None}
+    output_files = {reference: f'timeline_mutation_{output_names[reference]}.{output_format}'
+                    for reference in references}
+    state_files = {reference: f'timeline_mutation_{output_names[reference]}.state.npz' for reference in references}
+
+    states = {}
+    for reference in references:
+        state = TimelineState.load(state_files[reference])
+        if state is None or state.settings != settings or not os.path.exists(output_files[reference]):
+            logger.info('%s: no state of the current timeline, computing the full season', reference)
+            state = TimelineState(settings)
+        states[reference] = state
+
+    # samples not processed for every reference yet
+    _, sample_names = list_vcf_files(path_to_vcf)
+    processed = {reference: set(states[reference].processed) for reference in references}
+    new_samples = [sample_name for sample_name in sample_names
+                   if any(sample_name not in processed[reference] for reference in references)]
+
+    if new_samples:
+        with instrumentation.stage('read_vcfs'):
+            output_multiple_vcfs = process_multiple_vcfs_by_reference(
+                path_to_vcf, references, annotated=True, jobs=jobs, cache=cache, samples=new_samples,
+                regions={reference: region for reference in references} if region else None)
+        # the full coverage of the new samples, later mutations may be at any position
+        with instrumentation.stage('read_coverage'):
+            collected_coverage = coverage_reader.process_multiple_coverage_files(path_to_coverage, references,
+                                                                                 samples=new_samples)
+
+    for reference in references:
+        with instrumentation.stage(f'update_{reference}'):
+            state = states[reference]
+            old_kept = state.kept.copy()
+            reference_samples = [sample_name for sample_name in new_samples
+                                 if sample_name not in processed[reference]]
+            changed = []
+            if reference_samples:
+                calls = mutation_calls(output_multiple_vcfs[reference])
+                calls = calls[calls['sample'].isin(reference_samples)]
+                changed = state.add_samples(reference_samples, calls, collected_coverage[reference])
+
+            added = write_updated_timeline(state, old_kept, reference_samples, timeline_tsvs[reference],
+                                           output_files[reference])
+            state.save(state_files[reference])
+            instrumentation.count(rows=len(reference_samples))
+            logger.info('%s: %d new samples, %d mutations re-evaluated, %d mutations added to the timeline',
+                        reference, len(reference_samples), len(changed), len(added))
+
+
+# Write the timeline of the state. The json dictionaries of a .tsv timeline are only computed for the new samples,
+# the dictionaries of the other samples are taken from the existing output and extended by the added mutations
+def write_updated_timeline(state, old_kept, new_samples, timeline_tsv, output_file):
+    tsv_samples_locations = timeline_samples(timeline_tsv)
+    kept_ids = np.flatnonzero(state.kept)
+    # new mutations were not kept before
+    added_ids = np.flatnonzero(state.kept & ~np.pad(old_kept, (0, len(state.kept) - len(old_kept))))
+    # amino acid mutations are in the same order as the nucleotide mutations
+    n_amino_acid = len(state.amino_acid.mutations)
+    column_ids = {'nucleotideMutationFrequency': (kept_ids, added_ids),
+                  'aminoAcidMutationFrequency': (kept_ids[kept_ids < n_amino_acid],
+                                                 added_ids[added_ids < n_amino_acid])}
+    frequencies = {'nucleotideMutationFrequency': state.nucleotide_frequencies,
+                   'aminoAcidMutationFrequency': state.amino_acid_frequencies}
+    matrix_samples = {'nucleotideMutationFrequency': state.nucleotide.samples,
+                      'aminoAcidMutationFrequency': state.amino_acid.samples}
+
+    if is_binary_timeline(output_file) or len(old_kept) == 0:
+        write_timeline(tsv_samples_locations, output_file,
+                       {column: frequencies[column](mutation_ids=column_ids[column][0]) for column in JSON_COLUMNS})
+        return added_ids
+
+    old_timeline = pd.read_csv(output_file, sep='\t', usecols=['submissionId'] + JSON_COLUMNS, dtype=str,
+                               keep_default_na=False).drop_duplicates('submissionId').set_index('submissionId')
+    sample_ids = tsv_samples_locations['submissionId'].astype(str)
+    new_samples = set(new_samples)
+    for column in JSON_COLUMNS:
+        kept, added = column_ids[column]
+        old_json = old_timeline[column].reindex(sample_ids).fillna('').to_numpy()
+        keep_old = (old_json != '') & ~sample_ids.isin(new_samples).to_numpy()
+
+        # json of the samples without a usable old row, from scratch; samples without calls stay empty
+        fresh = pd.Index(sample_ids[~keep_old].unique())
+        fresh_json = frequencies[column](samples=fresh[fresh.isin(matrix_samples[column])],
+                                         mutation_ids=kept).to_json()
+
+        # old json extended by the added mutations
+        if len(added):
+            kept_samples = sample_ids[keep_old].unique()
+            added_json = frequencies[column](samples=kept_samples, mutation_ids=added).to_json()
+            old_json[keep_old] = [_extend_json(old, added_json[sample])
+                                  for old, sample in zip(old_json[keep_old], sample_ids[keep_old])]
+
+        tsv_samples_locations[column] = np.where(keep_old, old_json, sample_ids.map(fresh_json).to_numpy())
+
+    tsv_samples_locations.to_csv(output_file, sep='\t', index=False, quoting=3)
+    return added_ids
+
+
+def _extend_json(json_dictionary, added_json):
+    # '{"A123C": 0.5}' and '{"T140C": null}' -> '{"A123C": 0.5, "T140C": null}'
+    if added_json == '{}':
+        return json_dictionary
+    if json_dictionary == '{}':
+        return added_json
+    return json_dictionary[:-1] + ', ' + added_json[1:]
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process annotated VCF file and tsv files and prepare datamatrix')
     parser.add_argument('path_to_vcf',
                         help='input directory containing annotated VCF files snvs_annotated.vcf')
-    parser.add_argument('timeline_tsv', help='path to timeline.tsv file')
+    parser.add_argument('timeline_tsv', help='path to timeline.tsv file (comma separated, one per reference, '
+                                             'if several references are given)')
     parser.add_argument('path_to_coverage',
-                        help='input directory containing coverage tsv files coverage.tsv.gz')
-    parser.add_argument('reference',
-                        help='reference: it should be e.g. (for RSV-A:) EPI_ISL_412866; (for RSV-B:) EPI_ISL_1653999')
+                        help='input directory containing coverage tsv files coverage.tsv.gz, or a coverage store '
+                             'directory written by extract_coverage_RSV_Vpipe.py --store ({reference} is replaced by '
+                             'the reference name)')
+    parser.add_argument('reference', nargs='+',
+                        help='reference: it should be e.g. (for RSV-A:) EPI_ISL_412866; (for RSV-B:) EPI_ISL_1653999; '
+                             'both can be given to read the VCFs and coverage files only once')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes parsing the VCF files')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of the parsed VCF cache, unchanged VCFs are not parsed again on reruns')
+    parser.add_argument('--cache-max-mb', type=int, default=1024, help='size limit of the parsed VCF cache')
+    parser.add_argument('--region', default=None,
+                        help='only mutations in this 1-based window START-END, e.g. 5697-7421 for the RSV-A F gene')
+    parser.add_argument('--update', action='store_true',
+                        help='update the existing timeline output incrementally: only the VCF and coverage files of '
+                             'new samples are read, using the state kept next to the output (.state.npz); without a '
+                             'state the full season is computed and the state written')
+    parser.add_argument('--format', default='tsv', choices=['tsv', 'parquet', 'arrow'],
+                        help='timeline format: tsv with json columns, or a long parquet/arrow table of the mutation '
+                             'frequencies read by make_tallymut.py --timeline-mutations and the heatmaps')
+
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
+    instrumentation.setup(args, 'make_mutation_tsv')
 
-    main(args.path_to_vcf, args.timeline_tsv, args.path_to_coverage, args.reference)
\ No newline at end of file
+    main(args.path_to_vcf, args.timeline_tsv, args.path_to_coverage, args.reference, jobs=args.jobs,
+         cache_dir=args.cache_dir, cache_max_mb=args.cache_max_mb,
+         region=tuple(int(bound) for bound in args.region.split('-')) if args.region else None,
+         output_format=args.format, update=args.update)
\ No newline at end of file
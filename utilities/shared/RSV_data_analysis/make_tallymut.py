@@ -1,154 +1,94 @@
-import re
 import pandas as pd
 import numpy as np
+import gzip
 import json
-import glob
+import logging
+import os
 import argparse
-import pysam
+import coverage_reader
+import instrumentation
+from vcf_ingest import process_multiple_vcfs, process_multiple_vcfs_by_reference, positions_to_regions, list_vcf_files
+from parse_cache import ParseCache, file_sha256
+from mutation_catalog import MutationCatalog
+from mutation_matrix import MutationMatrix
+from timeline_io import read_timeline_matrices
 
 """
 The script outputs tallymut.tsv file for variants deconvolution after Lofreq (VCFs)
-- extract_cov and process_multiple_coverage_files functions prepares a df of the total coverage for multiple samples (1-based)
-- load_convert, process_multiple_vcfs functions process multiple vcf files and make a dataframe of observed mutations x samples (frequency values)
-- create_mut_freq_dict function creates a dictionary {'A123C' : 0.67, "T140C" : 0.01, ...} to stores values of frequency from single sample
+- process_multiple_coverage_files function (coverage_reader.py) prepares a samples x positions matrix of the total coverage
+  for multiple samples (1-based), reading each file once for all references of the concatenated RSV-A/RSV-B reference
+- process_multiple_vcfs function (vcf_ingest.py) processes multiple vcf files, optionally in parallel, and makes a dataframe of observed mutations x samples (frequency values)
+- MutationMatrix (mutation_matrix.py) keeps the observed frequencies as a sparse samples x mutations matrix and writes a dictionary {'A123C' : 0.67, "T140C" : 0.01, ...} of frequencies per sample
 - make_timeline_mutations_tsv function from each sample collects information into tsv file of columns ["submissionId", "primerProtocol", "reads", "date", "location", "reference", 'nucleotideMutationFrequency']
-- make_tallymut_file function prepares a tallymut.tsv file. We iterate through all samples and all signature mutations (of variants used for deconvolution)
+- build_coverage_matrix function arranges a long (pos, coverage, sample) coverage data frame into the same dense matrix (int32)
+- make_tallymut_file function prepares a tallymut.tsv file. Coverage, frequency and lineage flags of all samples and all signature mutations (of variants used for deconvolution) are gathered at once from the coverage matrix, chunk by chunk of samples
+- write_tallymut function streams the chunks into a .tsv, .tsv.gz or .parquet file
+- main runs in stages (reading the VCFs, the coverage, one tallymut file per reference) measured by instrumentation.py,
+  reported with --profile
+- with --append, only the samples of the timeline not processed yet are added; the samples written, all timeline
+  samples processed (drop-outs of zero coverage included) and the content hash of the signatures matrix are kept in
+  a .meta.json sidecar, and the file is rebuilt when the signatures change. Samples whose coverage or VCF file is not
+  there yet are left for a later run
 
 Additionally, we set frequency to 0.0 or Nan, depending on coverage (the threshold is pre-specified at the beginning):
 - if signature mutation is not called, the value of frequency stays zero if the coverage is sufficient, otherwise - missing value.
 
 """
 
-COVERAGE_THRESHOLD = 30
-
-# Extract the coverage information from single coverage.tsv.gz file
-def extract_cov(coverage_tsv_file, sample_name, reference):
-    # read coverage.tsv file
-    coverage_file = pd.read_csv(coverage_tsv_file, sep='\t', usecols=['ref', 'pos', f'{sample_name}/date'])
-    # coverage.tsv files are 1-based
-    coverage_file = coverage_file[coverage_file['ref'] == reference]
-    position = pd.DataFrame(coverage_file['pos'])
-    coverage = pd.DataFrame(coverage_file[f'{sample_name}/date']).rename(columns={f'{sample_name}/date': 'coverage'})
-    total_coverage = pd.concat([position, coverage], axis=1)#.set_index('pos')
-    total_coverage['sample'] = sample_name
-
-    return total_coverage
-
-# Extract the coverage information from multiple coverage.tsv.gz files and concatenate them into single data frame
-def process_multiple_coverage_files(coverage_input_dir, reference_genome):
-    # get list of coverage files in the input directory
-    coverage_files = glob.glob(coverage_input_dir, recursive=True)
-    rows = []
-    for coverage_file in coverage_files:
-        # extract the sample name from the directory name
-        sample_name = coverage_file.split('/')[-4]
-        # print(sample_name)
-
-        df = extract_cov(coverage_file, sample_name, reference=reference_genome)
-        # append the dataframe to the list of dataframes
-        rows.append(df)
-
-    coverage_out = pd.concat(rows, axis=0, ignore_index=True)
-    return coverage_out
-
-
-# Extract the called mutations and their frequency values from VCF files
-def load_convert(vcf_path, sample_name, reference):
-    ''' function to load a vcf and output a Pandas dataframe'''
-    # Create a VariantFile object
-    vcf_file = pysam.VariantFile(vcf_path)
-    # record rows for df
-    rows = []
-
-    # iterate over the records (variants) in the VCF file
-    for record in vcf_file:
-        if record.chrom == reference:
-            # iterate over possible mutated positions
-            for alt in record.alts:
-                # Take allele frequences (AF) from INFO
-                af = record.info.get('AF')
-                # put results in rows
-                row = {
-                    'sample': sample_name,
-                    'pos': record.pos,
-                    'ref': record.ref,
-                    'alt': alt,
-                    'af': af
-                }
-                rows.append(row)
-    # close the VCF file
-    vcf_file.close()
-    # convert to dataframe
-    df_out = pd.DataFrame(rows)
-
-    return df_out
-
-
-def process_multiple_vcfs(input_dir, reference):
-    # get list of VCF files in the input directory
-    vcf_files = glob.glob(input_dir, recursive=True)
-
-    # record rows for df
-    rows = []
-    # iterate over the VCF files from the list
-    for vcf_file in vcf_files:
-        # extract the sample name from the directory name
-        sample_name = vcf_file.split('/')[-5]
-        # load the VCF and convert to dataframe
-        df = load_convert(vcf_file, sample_name, reference)
-        # append the dataframe to the list of rows
-        rows.append(df)
-
-    # concatenate all dataframes
-    df_out = pd.concat(rows, axis=0, ignore_index=True)
-
-    return (df_out)
-
-
-def create_mut_freq_dict(col):
-    # create empty dictionary to hold the MUTATION PROPORTION FOR SINGLE SAMPLE
-    mutation_proportions = {}
-    # iterate through all columns except the 'sample' column
-    for mutation, frequency in col.items():
-        if pd.isna(frequency):
-            mutation_proportions[mutation] = None
-        else:
-            mutation_proportions[mutation] = frequency
-
-    # convert dictionary to a json-formatted string with double quotes
-    mutation_json = json.dumps(mutation_proportions, ensure_ascii=False)
-    # print(mutation_json)
-    return mutation_json
+logger = logging.getLogger(__name__)
 
+COVERAGE_THRESHOLD = 30
+TALLYMUT_META_VERSION = 2
+# signature positions closer than this are fetched from indexed VCFs as a single region
+SIGNATURE_REGION_GAP = 200
 
 # get frequencies of all observed mutations
-def make_timeline_mutations_tsv(path_to_vcf, timeline_tsv, reference):
+def make_timeline_mutations_tsv(path_to_vcf, timeline_tsv, reference, jobs=1, cache=None):
     # Process multiple vcfs and produce data frame
 
-    output_multiple_vcfs = process_multiple_vcfs(path_to_vcf, reference)
+    output_multiple_vcfs = process_multiple_vcfs(path_to_vcf, reference, jobs=jobs, cache=cache)
     # print(output_multiple_vcfs)
+    return timeline_mutations_from_vcfs(output_multiple_vcfs, timeline_tsv)
+
+
+# collect the mutation frequencies of the processed vcfs (of a single reference) per sample of the timeline
+def timeline_mutations_from_vcfs(output_multiple_vcfs, timeline_tsv):
     output_multiple_vcfs['ref_pos'] = output_multiple_vcfs['ref'] + output_multiple_vcfs['pos'].astype(str)
     output_multiple_vcfs['mut'] = output_multiple_vcfs['ref_pos'] + output_multiple_vcfs['alt']
     output_multiple_vcfs['freq_total'] = output_multiple_vcfs['af']
     output_multiple_vcfs = output_multiple_vcfs[['sample', 'mut', 'freq_total']].drop_duplicates()
-    # missing values remains as NaN's
-    mut_freq = output_multiple_vcfs.pivot_table(values='freq_total',
-                                                index='mut',
-                                                columns='sample')
-
-    mut_freq.columns = mut_freq.columns.astype(str)
+    # sparse samples x mutations matrix of the calls, missing values remain null
+    mut_freq = MutationMatrix.from_calls(output_multiple_vcfs['sample'], output_multiple_vcfs['mut'],
+                                         output_multiple_vcfs['freq_total'])
 
     tsv_samples_locations = pd.read_csv(timeline_tsv, sep='\t',
                                         usecols=["submissionId", "primerProtocol", "reads", "date", "location", "reference"])
 
-    nucleotide_mut_freq = mut_freq.apply(create_mut_freq_dict, axis=0)
-
-    tsv_samples_locations['nucleotideMutationFrequency'] = tsv_samples_locations["submissionId"].map(
-        nucleotide_mut_freq)
+    mut_freq.to_timeline(tsv_samples_locations, 'nucleotideMutationFrequency')
 
     return tsv_samples_locations
 
 
+# take the mutation frequencies of a precomputed timeline (make_mutation_tsv.py, .tsv, .parquet or .arrow) for the
+# samples of the timeline, instead of reading the VCFs. Rare mutations and calls at low coverage, which are missing
+# values in make_mutation_tsv.py, are not observed
+def timeline_mutations_from_file(timeline_mutations, timeline_tsv):
+    mutation_timeline, mutation_matrices = read_timeline_matrices(timeline_mutations,
+                                                                  columns=['nucleotideMutationFrequency'], usecols=[])
+
+    tsv_samples_locations = pd.read_csv(timeline_tsv, sep='\t',
+                                        usecols=["submissionId", "primerProtocol", "reads", "date", "location", "reference"])
+
+    # rows of the samples in the precomputed timeline (first one of repeated samples), -1 if not there
+    precomputed_samples = pd.Index(mutation_timeline['submissionId'].astype(str))
+    is_first = ~precomputed_samples.duplicated()
+    sample_ids = tsv_samples_locations['submissionId'].astype(str)
+    positions = precomputed_samples[is_first].get_indexer(sample_ids)
+    rows = np.where(positions >= 0, np.flatnonzero(is_first)[positions], -1)
+
+    return tsv_samples_locations, mutation_matrices['nucleotideMutationFrequency'].take_samples(rows, samples=sample_ids)
+
+
 def find_loc_code(location):
     code = {
         'Lugano (TI)': '05',
@@ -162,12 +102,34 @@ def find_loc_code(location):
     return code.get(location, 'Unknown')
 
 
-def make_tallymut_file(signatures_matrix, timeline_tsv_mutation, collected_coverage):
+# Positions of the signature mutations (columns of the signatures matrix)
+def signature_positions(signatures_matrix):
+    signature_muts = pd.read_csv(signatures_matrix, nrows=0).columns.drop('Lineages')
+    return MutationCatalog().positions(signature_muts)
+
+
+# Arrange the long coverage data frame into a dense (samples x positions) matrix, built once per run
+def build_coverage_matrix(collected_coverage):
+    # samples in order of their first appearance, positions are shifted by pos_offset (the smallest covered position)
+    sample_codes, samples = pd.factorize(collected_coverage['sample'])
+    positions = collected_coverage['pos'].to_numpy(dtype=np.int64)
+    pos_offset = int(positions.min())
+    coverage_matrix = np.zeros((len(samples), int(positions.max()) - pos_offset + 1), dtype=np.int32)
+    # positions absent from a coverage file stay at zero coverage
+    coverage_matrix[sample_codes, positions - pos_offset] = collected_coverage['coverage'].to_numpy()
+
+    return pd.Index(samples.astype(str)), coverage_matrix, pos_offset
+
+
+# Generate the tallymut table in chunks of samples_per_chunk samples, so it never has to be held in memory at once
+# mutation_matrix holds the observed frequencies, one row per row of timeline_tsv_mutation (parsed from its json column if None)
+# first_row is the row index of the first row, to continue the index of an existing tallymut file
+def iter_tallymut_chunks(signatures_matrix, timeline_tsv_mutation, collected_coverage, samples_per_chunk=1,
+                         mutation_matrix=None, first_row=0):
     rsv_definitions = pd.read_csv(signatures_matrix)
     rsv_definitions.set_index('Lineages', inplace=True)
     signature_muts = rsv_definitions.columns.values
 
-
     lineages = rsv_definitions.index
     # columns of tallymut.tsv file
     columns = ['sample',
@@ -184,111 +146,320 @@ def make_tallymut_file(signatures_matrix, timeline_tsv_mutation, collected_cover
                'var',
                'frac'] + list(lineages)
 
-    tallymut = pd.DataFrame(columns=columns)
-
-
-    mutation_list = []
-
-    # iterate through all SAMPLES:
-    for _, row in timeline_tsv_mutation.iterrows():
-        nucleotide_mut_freq_raw = row['nucleotideMutationFrequency']
-
-        if pd.isna(nucleotide_mut_freq_raw) or nucleotide_mut_freq_raw == '' or nucleotide_mut_freq_raw is None:
-            nucleotide_mut_freq = {}
+    # parse position and variant nt of every signature mutation once, signature i gets id i
+    catalog = MutationCatalog(signature_muts)
+    sign_pos = catalog.field('position')
+    sign_base = catalog.field('alt')
+    n_signatures = len(signature_muts)
+
+    # lineage flags: 'mut' where the signature mutation belongs to the lineage, missing otherwise.
+    # Stored as a categorical block, so the 'mut' string is not repeated in every row
+    lineage_flags = [pd.Categorical.from_codes(np.where(in_lineage == 1, 0, -1), categories=['mut'])
+                     for in_lineage in rsv_definitions.to_numpy()]
+
+    # collected_coverage is either the (samples, matrix) pair of coverage_reader or a long coverage data frame
+    if isinstance(collected_coverage, pd.DataFrame):
+        coverage_samples, coverage_matrix, pos_offset = build_coverage_matrix(collected_coverage)
+    else:
+        (coverage_samples, coverage_matrix), pos_offset = collected_coverage, 1
+    pos_columns = sign_pos - pos_offset
+    in_range = (pos_columns >= 0) & (pos_columns < coverage_matrix.shape[1])
+
+    # if sample is complete drop-out -> skip
+    is_covered = timeline_tsv_mutation['submissionId'].astype(str).isin(coverage_samples)
+    for dropout in timeline_tsv_mutation.loc[~is_covered, 'submissionId']:
+        logger.info('no coverage, skipped: %s', dropout)
+    samples = timeline_tsv_mutation[is_covered.values].reset_index(drop=True)
+    timeline_rows = np.flatnonzero(is_covered.values)
+    if mutation_matrix is None:
+        mutation_matrix = MutationMatrix.from_timeline(timeline_tsv_mutation)
+
+    if len(samples) == 0:
+        yield pd.DataFrame(columns=columns)
+        return
+
+    for chunk_start in range(0, len(samples), samples_per_chunk):
+        chunk = samples.iloc[chunk_start:chunk_start + samples_per_chunk]
+        n_samples = len(chunk)
+
+        # coverage of every sample at every signature position, gathered in one go (samples x signatures)
+        sample_rows = coverage_samples.get_indexer(chunk['submissionId'].astype(str))
+        sign_coverage = np.zeros((n_samples, n_signatures), dtype=np.int32)
+        sign_coverage[:, in_range] = coverage_matrix[sample_rows[:, None], pos_columns[in_range][None, :]]
+
+        # if there are no mutations observed in the sample -> set signature frequency to 0.0 or Nan, depending on coverage:
+        sign_freq = np.where(sign_coverage > COVERAGE_THRESHOLD, 0.0, np.nan)
+
+        # if mutation is among the keys (observed in the time period of interest), and it's value is not missing (observed in the sample), take the outputted frequency value from Lofreq:
+        # only the calls are taken, covered mutations without a call are set to 0.0 from the coverage above
+        observed_freq = mutation_matrix.take_samples(timeline_rows[chunk_start:chunk_start + samples_per_chunk]) \
+            .with_coverage_mask(None).to_dense(mutations=signature_muts)
+        sign_freq = np.where(np.isnan(observed_freq), sign_freq, observed_freq)
+
+        location_info = chunk['location']
+        tallymut = pd.DataFrame({'sample': np.repeat(chunk['submissionId'].to_numpy(), n_signatures),
+                                 'batch': np.nan,
+                                 'reads': np.repeat(chunk['reads'].to_numpy(), n_signatures),
+                                 'proto': np.repeat(chunk['primerProtocol'].to_numpy(), n_signatures),
+                                 'location_code': np.repeat(location_info.map(find_loc_code).to_numpy(), n_signatures),
+                                 'date': np.repeat(chunk['date'].to_numpy(), n_signatures),
+                                 'location': np.repeat(location_info.to_numpy(), n_signatures),
+                                 'pos': np.tile(sign_pos, n_samples),
+                                 'gene': np.nan,
+                                 'base': np.tile(sign_base, n_samples),
+                                 'cov': sign_coverage.ravel(),
+                                 'var': np.nan,
+                                 'frac': sign_freq.ravel()
+                                 })
+
+        for lineage, flags in zip(lineages, lineage_flags):
+            tallymut[lineage] = pd.Categorical.from_codes(np.tile(flags.codes, n_samples), categories=['mut'])
+
+        # keep a running row index across chunks, as in a single to_csv of the whole table
+        chunk_first_row = first_row + chunk_start * n_signatures
+        tallymut.index = pd.RangeIndex(chunk_first_row, chunk_first_row + len(tallymut))
+
+        yield tallymut[columns]
 
-        else:
-            nucleotide_mut_freq = json.loads(row['nucleotideMutationFrequency'])
 
-        location_info = row['location']
-
-        # if sample is complete drop-out -> skip
-        if row['submissionId'] not in (collected_coverage['sample'].values):
-            print(row['submissionId'])
-            continue
-
-        # iterate through all SIGNATURE MUTATIONS:
-
-        for sign_mut in signature_muts:
-
-
-            sign_pos = int(re.findall(r'\d+', sign_mut)[0])  # position in the genome
-            sign_base = re.findall(r'\D+', sign_mut)[1]  # second position = variant nt
-
-            # coverage of the particular sample at the particular position of the signature mutation:
-            sign_coverage = (collected_coverage[(collected_coverage['sample'] == row['submissionId']) &
-                                                (collected_coverage['pos'] == sign_pos)]['coverage']).iloc[0]
-
-            # if there are no mutations observed in the sample -> set signature frequency to 0.0 or Nan, depending on coverage:
-            if sign_coverage > COVERAGE_THRESHOLD:
-                sign_freq = 0.0
+def make_tallymut_file(signatures_matrix, timeline_tsv_mutation, collected_coverage):
+    return pd.concat(iter_tallymut_chunks(signatures_matrix=signatures_matrix,
+                                          timeline_tsv_mutation=timeline_tsv_mutation,
+                                          collected_coverage=collected_coverage,
+                                          samples_per_chunk=len(timeline_tsv_mutation) or 1))
+
+
+# Stream tallymut chunks to disk. The format follows the file extension: .tsv, .tsv.gz or .parquet
+# With append, the chunks are added to the existing file (a parquet file is rewritten, its row groups copied as they are)
+# Returns the samples written and the number of rows
+def write_tallymut(tallymut_chunks, output_file, append=False):
+    samples, n_rows = [], 0
+    if output_file.endswith('.parquet'):
+        # pyarrow is only needed for the parquet output
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        if append:
+            existing = pq.ParquetFile(output_file)
+            writer = pq.ParquetWriter(output_file + '.tmp', existing.schema_arrow)
+            for row_group in range(existing.num_row_groups):
+                writer.write_table(existing.read_row_group(row_group))
+        for tallymut in tallymut_chunks:
+            if append and len(tallymut) == 0:
+                continue
+            table = pa.Table.from_pandas(tallymut, schema=writer.schema if writer else None, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output_file, table.schema)
+            writer.write_table(table)
+            samples.extend(pd.unique(tallymut['sample'].astype(str)))
+            n_rows += len(tallymut)
+        writer.close()
+        if append:
+            os.replace(output_file + '.tmp', output_file)
+
+    else:
+        # gzip is picked based on the file extension, appended gzip output is a new gzip member
+        open_output = gzip.open if output_file.endswith('.gz') else open
+        with open_output(output_file, 'at' if append else 'wt', newline='') as output:
+            for chunk_number, tallymut in enumerate(tallymut_chunks):
+                tallymut.to_csv(output, sep='\t', header=(chunk_number == 0 and not append))
+                samples.extend(pd.unique(tallymut['sample'].astype(str)))
+                n_rows += len(tallymut)
+
+    return samples, n_rows
+
+
+# Sidecar of an appendable tallymut file: content hash of the signatures matrix, samples and rows written, file size,
+# and all timeline samples processed (also the drop-outs without rows, so they are not read again on every append)
+def tallymut_meta_file(output_file):
+    return output_file + '.meta.json'
+
+
+def tallymut_settings(signatures_matrix):
+    return {'signatures_sha256': file_sha256(signatures_matrix),
+            'coverage_threshold': COVERAGE_THRESHOLD}
+
+
+# Sidecar of the existing tallymut file if new samples can be appended to it, None if it has to be rebuilt.
+# A .tsv(.gz) file longer than recorded (an interrupted append) is cut back to the recorded size
+def appendable_tallymut(output_file, settings):
+    meta_file = tallymut_meta_file(output_file)
+    if not (os.path.exists(meta_file) and os.path.exists(output_file)):
+        return None
+    with open(meta_file) as fh:
+        meta = json.load(fh)
+    if meta['version'] != TALLYMUT_META_VERSION or meta['settings'] != settings:
+        return None
+    size = os.path.getsize(output_file)
+    if size != meta['size'] and (size < meta['size'] or output_file.endswith('.parquet')):
+        return None
+    if size > meta['size']:
+        os.truncate(output_file, meta['size'])
+    return meta
+
+
+def write_tallymut_meta(output_file, settings, samples, n_rows, processed):
+    meta = {'version': TALLYMUT_META_VERSION,
+            'settings': settings,
+            'samples': samples,
+            'processed': processed,
+            'rows': n_rows,
+            'size': os.path.getsize(output_file)}
+    meta_file = tallymut_meta_file(output_file)
+    with open(meta_file + '.tmp', 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(meta_file + '.tmp', meta_file)
+
+
+def main(signatures_matrix, input_dir_vcf, input_dir_cov, timeline_tsv, reference_genome, output_file=None,
+         samples_per_chunk=1, jobs=1, cache_dir=None, cache_max_mb=1024, timeline_mutations=None, append=False):
+    # several references can be processed at once, with one signatures matrix (and timeline) per reference;
+    # every VCF and coverage file is then read a single time and routed by contig
+    references = _as_list(reference_genome)
+    signatures_matrices = dict(zip(references, _as_list(signatures_matrix)))
+    timeline_tsvs = _as_list(timeline_tsv)
+    timeline_tsvs = dict(zip(references, timeline_tsvs * len(references) if len(timeline_tsvs) == 1 else timeline_tsvs))
+    output_file = output_file or 'tallymut_{reference}.tsv'
+    output_files = {reference: output_file.format(reference=reference) for reference in references}
+
+    # with append, the samples already in the tallymut file of each reference (None if it is rebuilt), and the
+    # samples of the timelines missing in any of them - only their VCF and coverage files are read
+    settings = {reference: tallymut_settings(signatures_matrices[reference]) for reference in references}
+    existing = {reference: appendable_tallymut(output_files[reference], settings[reference]) if append else None
+                for reference in references}
+    new_samples = None
+    if append and all(meta is not None for meta in existing.values()):
+        new_samples = set()
+        for reference in references:
+            timeline_ids = pd.read_csv(timeline_tsvs[reference], sep='\t', usecols=['submissionId'])['submissionId']
+            new_samples.update(set(timeline_ids.astype(str)) - set(existing[reference]['processed']))
+        if not new_samples:
+            logger.info('no new samples, the tallymut files are up to date')
+            return
+
+    # parsed VCFs are reused between reruns if a cache directory is given
+    cache = ParseCache(cache_dir, max_bytes=cache_max_mb * 1024 * 1024) if cache_dir else None
+
+    # extract mutation frequency information from VCFs - input of make_tallymut_file function.
+    # Only signature mutations end up in the tallymut file, so only their positions are read
+    # (fetched from bgzipped, tabix-indexed VCFs, or filtered while scanning plain VCFs)
+    # The VCFs are not read if the frequencies come from a precomputed timeline
+    if timeline_mutations is None:
+        signature_regions = {reference: positions_to_regions(signature_positions(signatures_matrices[reference]),
+                                                             max_gap=SIGNATURE_REGION_GAP)
+                             for reference in references}
+        with instrumentation.stage('read_vcfs'):
+            output_multiple_vcfs = process_multiple_vcfs_by_reference(input_dir_vcf, references, jobs=jobs,
+                                                                      cache=cache, regions=signature_regions,
+                                                                      samples=new_samples)
+
+    # prepare coverage matrices, again only at the signature positions - input of make_tallymut_file function
+    with instrumentation.stage('read_coverage'):
+        collected_coverage = coverage_reader.process_multiple_coverage_files(
+            input_dir_cov, references,
+            positions={reference: signature_positions(signatures_matrices[reference]) for reference in references},
+            samples=new_samples)
+
+    # with append, samples of the timeline without a VCF yet (their results did not arrive) are left for a later run
+    vcf_samples = set(list_vcf_files(input_dir_vcf)[1]) if append and timeline_mutations is None else None
+
+    for reference in references:
+        with instrumentation.stage(f'tallymut_{reference}'):
+            # prepare timeline_tsv file - input of make_tallymut_file function
+            if timeline_mutations is None:
+                timeline_tsv_mutation = timeline_mutations_from_vcfs(output_multiple_vcfs[reference],
+                                                                     timeline_tsvs[reference])
+                mutation_matrix = None
             else:
-                sign_freq = np.nan
-
-            # if mutation is among the keys (observed in the time period of interest), and it's value is not missing (observed in the sample), take the outputted frequency value from Lofreq:
-
-            if (sign_mut in nucleotide_mut_freq.keys()) and (nucleotide_mut_freq[sign_mut] is not None) and sign_freq is not None:
-                sign_freq = nucleotide_mut_freq[sign_mut]
-
-            mut_row = {'sample': row['submissionId'],
-                       'batch': np.nan,
-                       'reads': row['reads'],
-                       'proto': row['primerProtocol'],
-                       'location_code': find_loc_code(location=location_info),
-                       'date': row['date'],
-                       'location': location_info,
-                       'pos': sign_pos,
-                       'gene': np.nan,
-                       'base': sign_base,
-                       'cov': sign_coverage,
-                       'var': np.nan,
-                       'frac': sign_freq
-                       }
-
-            for lineage in lineages:
-
-                if (rsv_definitions.at[lineage, sign_mut]) == 1:
-                    mut_row[lineage] = 'mut'
-                else:
-                    mut_row[lineage] = np.nan
-
-            mutation_list.append(mut_row)
-
-
-    # concatenate tallymut.tsv's from separate mutations
-    tallymut = pd.concat([tallymut, pd.DataFrame(mutation_list)], ignore_index=True)
-
-
-    return tallymut
-
-
-def main(signatures_matrix, input_dir_vcf, input_dir_cov, timeline_tsv, reference_genome):
-
-    # extract mutation frequency information from VCFs and prepare timeline_tsv file - input of make_tallymut_file function
-    timeline_tsv_mutation = make_timeline_mutations_tsv(path_to_vcf=input_dir_vcf,
-                                                        timeline_tsv=timeline_tsv,
-                                                        reference=reference_genome)
-
-    # prepare concat coverage files - input of make_tallymut_file function
-    collected_coverage = process_multiple_coverage_files(coverage_input_dir=input_dir_cov,
-                                                         reference_genome=reference_genome)
-
-    tallymut = make_tallymut_file(signatures_matrix=signatures_matrix,
-                       timeline_tsv_mutation=timeline_tsv_mutation,
-                       collected_coverage=collected_coverage)
-
-    tallymut.to_csv(f"tallymut_{reference_genome}.tsv", sep='\t')
-
+                timeline_tsv_mutation, mutation_matrix = timeline_mutations_from_file(
+                    timeline_mutations.format(reference=reference), timeline_tsvs[reference])
+
+            meta = existing[reference]
+            if append and meta is None:
+                logger.info('%s: signatures changed or no appendable tallymut file, writing all samples', reference)
+            if append:
+                # only the samples not processed yet whose inputs were read: samples without a coverage or VCF file
+                # are neither written nor recorded as processed, so they are added once their results arrive
+                # (samples with a coverage file of zero coverage are drop-outs, written and recorded)
+                sample_ids = timeline_tsv_mutation['submissionId'].astype(str)
+                is_new = ~sample_ids.isin(meta['processed'] if meta is not None else []).values
+                has_inputs = sample_ids.isin(collected_coverage[reference][0]).values
+                if vcf_samples is not None:
+                    has_inputs = has_inputs & sample_ids.isin(vcf_samples).values
+                if (is_new & ~has_inputs).any():
+                    logger.info('%s: %d samples without results yet, left for a later --append', reference,
+                                (is_new & ~has_inputs).sum())
+                keep = is_new & has_inputs
+                if mutation_matrix is not None:
+                    mutation_matrix = mutation_matrix.take_samples(np.flatnonzero(keep))
+                timeline_tsv_mutation = timeline_tsv_mutation[keep].reset_index(drop=True)
+
+            tallymut_chunks = iter_tallymut_chunks(signatures_matrix=signatures_matrices[reference],
+                                                   timeline_tsv_mutation=timeline_tsv_mutation,
+                                                   collected_coverage=collected_coverage[reference],
+                                                   samples_per_chunk=samples_per_chunk,
+                                                   mutation_matrix=mutation_matrix,
+                                                   first_row=meta['rows'] if meta else 0)
+
+            processed = list(pd.unique(timeline_tsv_mutation['submissionId'].astype(str)))
+            samples, n_rows = write_tallymut(tallymut_chunks, output_files[reference], append=meta is not None)
+            instrumentation.count(rows=n_rows)
+            if append:
+                if meta is not None:
+                    logger.info('%s: %d samples appended', reference, len(samples))
+                    samples, n_rows = meta['samples'] + samples, meta['rows'] + n_rows
+                    processed = meta['processed'] + processed
+                write_tallymut_meta(output_files[reference], settings[reference], samples, n_rows, processed)
+
+
+def _as_list(value):
+    # single values or comma separated lists (as given on the command line)
+    return value if isinstance(value, list) else value.split(',')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='produce tallymut.tsv file, which is used as an input for deconvolution')
 
-    parser.add_argument("signatures_matrix", help='lineages definition matrix with lineages in the rows and mutations in the columns')
-    parser.add_argument("input_dir_vcf")
-    parser.add_argument("input_dir_cov", help='path to coverage.tsv.gz')
-    parser.add_argument("timeline_tsv")
-    parser.add_argument("reference_genome")
+    parser.add_argument("signatures_matrix", help='lineages definition matrix with lineages in the rows and mutations in the columns '
+                                                  '(comma separated, one per reference, if several references are given)')
+    parser.add_argument("input_dir_vcf", help='annotated or plain VCF files (not read with --timeline-mutations)')
+    parser.add_argument("input_dir_cov", help='path to coverage.tsv.gz, or a coverage store directory written by '
+                                              'extract_coverage_RSV_Vpipe.py --store ({reference} is replaced by '
+                                              'the reference name)')
+    parser.add_argument("timeline_tsv", help='timeline.tsv file (comma separated, one per reference, or a single shared one)')
+    parser.add_argument("reference_genome", nargs='+',
+                        help='one or several references, e.g. EPI_ISL_412866 EPI_ISL_1653999 for the concatenated reference')
+    parser.add_argument("--output", default=None,
+                        help='output file, .tsv, .tsv.gz or .parquet; {reference} is replaced by the reference name '
+                             '(default: tallymut_{reference}.tsv)')
+    parser.add_argument("--samples-per-chunk", type=int, default=1,
+                        help='number of samples written at once, bounds the memory used by the tallymut table')
+    parser.add_argument("--jobs", type=int, default=1, help='number of worker processes parsing the VCF files')
+    parser.add_argument("--cache-dir", default=None,
+                        help='directory of the parsed VCF cache, unchanged VCFs are not parsed again on reruns')
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help='size limit of the parsed VCF cache')
+    parser.add_argument("--timeline-mutations", default=None,
+                        help='precomputed timeline of make_mutation_tsv.py (.tsv, .parquet or .arrow) to take the '
+                             'mutation frequencies from instead of the VCFs; {reference} is replaced by the reference '
+                             'name. Rare mutations and calls at low coverage, missing values in make_mutation_tsv.py, '
+                             'are treated as not observed')
+    parser.add_argument("--append", action='store_true',
+                        help='add only the timeline samples not processed yet for the existing output, whose samples '
+                             'and signatures hash are kept next to it (.meta.json); samples without a coverage or VCF '
+                             'file yet are added by a later run. The output is rebuilt if the signatures matrix '
+                             'changed or there is no .meta.json')
+
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
-    main(args.signatures_matrix, args.input_dir_vcf, args.input_dir_cov, args.timeline_tsv, args.reference_genome)
+    instrumentation.setup(args, 'make_tallymut')
+    if len(args.reference_genome) > 1 and args.timeline_mutations and '{reference}' not in args.timeline_mutations:
+        parser.error('--timeline-mutations needs a {reference} placeholder when several references are given')
+    if len(args.reference_genome) > 1 and args.output and '{reference}' not in args.output:
+        parser.error('--output needs a {reference} placeholder when several references are given')
+    main(args.signatures_matrix, args.input_dir_vcf, args.input_dir_cov, args.timeline_tsv, args.reference_genome,
+         output_file=args.output, samples_per_chunk=args.samples_per_chunk, jobs=args.jobs,
+         cache_dir=args.cache_dir, cache_max_mb=args.cache_max_mb, timeline_mutations=args.timeline_mutations,
+         append=args.append)
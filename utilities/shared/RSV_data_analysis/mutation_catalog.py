@@ -0,0 +1,103 @@
+import re
+import numpy as np
+
+"""
+Mutation catalog shared by make_tallymut.py, make_mutation_tsv.py and the heatmap scripts
+- nucleotide mutation keys, e.g. A123C (ref, 1-based position, alt; indels as AT123A or A123AT), and amino acid
+  mutation keys, e.g. K750R_G_G2251A (ref amino acid, codon, alt amino acid, gene and the nucleotide key),
+  are parsed a single time and interned to integer ids
+- the parsed fields are kept in arrays indexed by the id, so sorting mutations by genome position, filtering them
+  by a genome window or dropping indels are array operations
+Amino acid keys share the position, ref, alt and indel flag of their nucleotide key.
+"""
+
+NUCLEOTIDE_KEY = re.compile(r'^(\D*)(\d+)(\D*)$')
+AMINO_ACID_CHANGE = re.compile(r'^(\D*)(\d*)(\D*)$')
+
+FIELDS = ['position', 'ref', 'alt', 'indel', 'gene', 'codon', 'ref_aa', 'alt_aa', 'nucleotide']
+FIELD_TYPES = {'position': np.int64, 'indel': bool, 'codon': np.int64}
+
+
+class MutationCatalog(object):
+    """Mutation keys interned to integer ids, with the fields of every key parsed once."""
+
+    def __init__(self, keys=()):
+        self.keys = []
+        self.__ids = {}
+        self.__fields = {field: [] for field in FIELDS}
+        self.__arrays = {}
+        self.intern(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def intern(self, keys):
+        """Ids of the keys (as an array), keys not seen before are parsed and added to the catalog."""
+        ids = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            key_id = self.__ids.get(key)
+            if key_id is None:
+                key_id = self.__add(key)
+            ids[i] = key_id
+        return ids
+
+    def lookup(self, keys):
+        """Ids of the keys (as an array), -1 for keys not in the catalog."""
+        return np.array([self.__ids.get(key, -1) for key in keys], dtype=np.int64)
+
+    def field(self, field):
+        """Array of a parsed field of all keys, indexed by id."""
+        if field not in self.__arrays or len(self.__arrays[field]) != len(self.keys):
+            self.__arrays[field] = np.array(self.__fields[field], dtype=FIELD_TYPES.get(field, object))
+        return self.__arrays[field]
+
+    def positions(self, keys):
+        """1-based genome positions of the keys."""
+        ids = self.intern(keys)
+        return self.field('position')[ids]
+
+    def is_indel(self, keys):
+        """True for insertions and deletions (ref or alt longer than one nucleotide)."""
+        ids = self.intern(keys)
+        return self.field('indel')[ids]
+
+    def is_amino_acid_change(self, keys):
+        """True for amino acid keys changing the amino acid, False for synonymous and non-coding mutations."""
+        ids = self.intern(keys)
+        ref_aa, alt_aa = self.field('ref_aa')[ids], self.field('alt_aa')[ids]
+        return (ref_aa != '') & (alt_aa != '') & (ref_aa != alt_aa)
+
+    def sort_by_position(self, keys):
+        """Keys in order of their genome position (stable, keys at the same position keep their order)."""
+        keys = list(keys)
+        order = np.argsort(self.positions(keys), kind='stable')
+        return [keys[i] for i in order]
+
+    def __add(self, key):
+        fields = _parse_key(key)
+        for field in FIELDS:
+            self.__fields[field].append(fields[field])
+        self.__ids[key] = len(self.keys)
+        self.keys.append(key)
+        return self.__ids[key]
+
+
+def _parse_key(key):
+    parts = key.split('_')
+    nucleotide = parts[-1]
+    match = NUCLEOTIDE_KEY.match(nucleotide)
+    if match is None:
+        raise ValueError('cannot parse mutation key {0}'.format(key))
+    ref, position, alt = match.groups()
+    fields = {'position': int(position), 'ref': ref, 'alt': alt, 'indel': len(ref) > 1 or len(alt) > 1,
+              'gene': '', 'codon': -1, 'ref_aa': '', 'alt_aa': '', 'nucleotide': nucleotide}
+
+    # amino acid key: <ref aa><codon><alt aa>_<gene>_<nucleotide key>, non-coding mutations as .*._._<nucleotide key>
+    if len(parts) > 1:
+        ref_aa, codon, alt_aa = AMINO_ACID_CHANGE.match(parts[0]).groups()
+        fields.update({'gene': '_'.join(parts[1:-1]),
+                       'codon': int(codon) if codon else -1,
+                       # amino acids only, stop codons (*) and missing values (.) are not amino acid changes
+                       'ref_aa': ''.join(re.findall(r'[A-Za-z]+', ref_aa)),
+                       'alt_aa': ''.join(re.findall(r'[A-Za-z]+', alt_aa))})
+    return fields
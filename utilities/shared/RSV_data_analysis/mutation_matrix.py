@@ -0,0 +1,234 @@
+import json
+import numpy as np
+import pandas as pd
+
+"""
+Sparse samples x mutations frequency matrix shared by make_mutation_tsv.py and make_tallymut.py
+- only the called mutations of each sample are stored (CSR: row pointers, mutation ids, float32 frequencies),
+  so memory grows with the number of calls rather than with mutations x samples
+- an optional coverage mask (one bit per sample and mutation) tells apart mutations not called at sufficient
+  coverage (frequency 0.0) from mutations at positions without sufficient coverage (missing value)
+- from_calls builds the matrix from the calls of the parsed VCFs, from_timeline from the json columns of a
+  timeline tsv file and from_entries from the long table of a binary timeline (timeline_io.py); to_json and
+  to_timeline write it back in the timeline tsv format
+"""
+
+
+class MutationMatrix(object):
+    """Sparse samples x mutations frequency matrix (CSR, float32) with an optional coverage mask."""
+
+    def __init__(self, samples, mutations, indptr, indices, values, covered=None):
+        """
+        Calls of sample i are indices[indptr[i]:indptr[i + 1]] (mutation ids) and values[indptr[i]:indptr[i + 1]];
+        covered is None or a packed (np.packbits) samples x mutations mask of sufficient coverage.
+        """
+        self.samples = pd.Index(samples)
+        self.mutations = pd.Index(mutations)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.float32)
+        self.covered = covered
+
+    def __repr__(self):
+        return '<MutationMatrix of {0} samples x {1} mutations, {2} calls{3}>'.format(
+            len(self.samples), len(self.mutations), len(self.values),
+            ', with coverage mask' if self.covered is not None else '')
+
+    @classmethod
+    def from_calls(cls, samples, mutations, values, sort=True):
+        """
+        Matrix of (sample, mutation, frequency) calls, calls with a missing mutation or frequency are skipped and
+        duplicated calls of a sample are averaged. Samples and mutations are sorted (sort) or kept in order of
+        their first appearance, as in pivot_table.
+        """
+        calls = pd.DataFrame({'sample': samples, 'mutation': mutations, 'value': values}).dropna()
+        sample_codes, sample_labels = pd.factorize(calls['sample'], sort=sort)
+        mutation_codes, mutation_labels = pd.factorize(calls['mutation'], sort=sort)
+        n_mutations = len(mutation_labels)
+
+        # cells in row-major order, duplicated cells are averaged
+        cells, cell_codes = np.unique(sample_codes.astype(np.int64) * n_mutations + mutation_codes,
+                                      return_inverse=True)
+        sums = np.bincount(cell_codes.ravel(), weights=calls['value'].to_numpy(dtype=np.float64))
+        counts = np.bincount(cell_codes.ravel())
+        rows = cells // max(n_mutations, 1)
+
+        return cls(pd.Index(sample_labels).astype(str), mutation_labels,
+                   np.searchsorted(rows, np.arange(len(sample_labels) + 1)),
+                   cells % max(n_mutations, 1), sums / counts)
+
+    @classmethod
+    def from_timeline(cls, timeline, column='nucleotideMutationFrequency', sample_column='submissionId'):
+        """
+        Matrix of a json column of a timeline (data frame or tsv file), one row per timeline row, mutations in order
+        of their first appearance. Non-zero values are calls, mutations with a value (also 0.0) are covered and
+        mutations with null values are not.
+        """
+        if not isinstance(timeline, pd.DataFrame):
+            timeline = pd.read_csv(timeline, sep='\t', usecols=[sample_column, column])
+
+        mutation_ids = {}
+        rows, indices, values = [], [], []
+        for row, raw in enumerate(timeline[column]):
+            if isinstance(raw, str) and raw != '':
+                for mutation, frequency in json.loads(raw).items():
+                    mutation_id = mutation_ids.setdefault(mutation, len(mutation_ids))
+                    if frequency is None:
+                        continue
+                    rows.append(row)
+                    indices.append(mutation_id)
+                    values.append(frequency)
+
+        return cls.from_entries(timeline[sample_column].astype(str), list(mutation_ids), rows, indices, values)
+
+    @classmethod
+    def from_entries(cls, samples, mutations, rows, mutation_ids, values):
+        """
+        Matrix of the (sample row, mutation id, frequency) entries of the covered mutations: non-zero frequencies are
+        calls, mutations without an entry are not covered.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        mutation_ids = np.asarray(mutation_ids, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float32)
+
+        covered = np.zeros((len(samples), len(mutations)), dtype=bool)
+        covered[rows, mutation_ids] = True
+
+        # calls in row-major order
+        is_call = values != 0
+        order = np.lexsort((mutation_ids[is_call], rows[is_call]))
+        call_rows = rows[is_call][order]
+        return cls(samples, mutations, np.searchsorted(call_rows, np.arange(len(samples) + 1)),
+                   mutation_ids[is_call][order], values[is_call][order], covered=np.packbits(covered, axis=1))
+
+    def call_rows(self):
+        """Sample (row) index of every call."""
+        return np.repeat(np.arange(len(self.samples)), np.diff(self.indptr))
+
+    def covered_rows(self, rows=None):
+        """Unpacked coverage mask of the given sample rows (all if None), True everywhere without a mask."""
+        rows = np.arange(len(self.samples)) if rows is None else rows
+        if self.covered is None:
+            return np.ones((len(rows), len(self.mutations)), dtype=bool)
+        return np.unpackbits(self.covered[rows], axis=1, count=len(self.mutations)).astype(bool)
+
+    def covered_calls(self):
+        """True for the calls at sufficient coverage (read directly from the packed mask)."""
+        if self.covered is None:
+            return np.ones(len(self.values), dtype=bool)
+        bits = self.covered[self.call_rows(), self.indices >> 3]
+        return ((bits >> (7 - (self.indices & 7))) & 1).astype(bool)
+
+    def with_coverage_mask(self, covered):
+        """The same calls with a (packed) coverage mask."""
+        return MutationMatrix(self.samples, self.mutations, self.indptr, self.indices, self.values, covered)
+
+    def take_samples(self, rows, samples=None):
+        """
+        Matrix of the given sample rows (in the given order, repeats allowed), row -1 gives a sample without calls
+        and coverage. Samples are labelled by samples, or by the labels of the taken rows.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        is_known = rows >= 0
+        known_rows = np.where(is_known, rows, 0)
+        counts = np.where(is_known, np.diff(self.indptr)[known_rows], 0)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        # position of every taken call in the calls of this matrix
+        taken = np.repeat(self.indptr[known_rows] - indptr[:-1], counts) + np.arange(indptr[-1])
+
+        covered = None
+        if self.covered is not None:
+            covered = self.covered[known_rows]
+            covered[~is_known] = 0
+        if samples is None:
+            samples = self.samples.take(known_rows).where(is_known, '')
+        return MutationMatrix(samples, self.mutations, indptr, self.indices[taken], self.values[taken], covered)
+
+    def append_samples(self, other):
+        """
+        Matrix of the samples of this matrix followed by the samples of other; mutations of other that are not in
+        this matrix are appended, in their order in other.
+        """
+        mutations = self.mutations.append(other.mutations[~other.mutations.isin(self.mutations)])
+        other_ids = mutations.get_indexer(other.mutations)
+
+        covered = None
+        if self.covered is not None or other.covered is not None:
+            covered = np.zeros((len(self.samples) + len(other.samples), len(mutations)), dtype=bool)
+            covered[:len(self.samples), :len(self.mutations)] = self.covered_rows()
+            covered[len(self.samples):, other_ids] = other.covered_rows()
+            covered = np.packbits(covered, axis=1)
+        return MutationMatrix(self.samples.append(other.samples), mutations,
+                              np.concatenate([self.indptr, self.indptr[-1] + other.indptr[1:]]),
+                              np.concatenate([self.indices, other_ids[other.indices]]),
+                              np.concatenate([self.values, other.values]), covered)
+
+    def take_mutations(self, keep):
+        """Matrix of a subset of the mutations (boolean mask or positions), all samples are kept."""
+        keep_ids = np.flatnonzero(keep) if np.asarray(keep).dtype == bool else np.asarray(keep, dtype=np.int64)
+        new_ids = np.full(len(self.mutations), -1, dtype=np.int64)
+        new_ids[keep_ids] = np.arange(len(keep_ids))
+        kept = new_ids[self.indices] >= 0
+        rows = self.call_rows()[kept]
+
+        covered = None
+        if self.covered is not None:
+            covered = np.packbits(self.covered_rows()[:, keep_ids], axis=1)
+        return MutationMatrix(self.samples, self.mutations[keep_ids],
+                              np.searchsorted(rows, np.arange(len(self.samples) + 1)),
+                              new_ids[self.indices][kept], self.values[kept], covered)
+
+    def count_above(self, threshold):
+        """Number of samples per mutation with a frequency above threshold (at sufficient coverage)."""
+        above = (self.values > threshold) & self.covered_calls()
+        return np.bincount(self.indices[above], minlength=len(self.mutations))
+
+    def to_dense(self, mutations=None):
+        """
+        Dense samples x mutations float array of the given mutations (all if None): frequency of the calls, 0.0 for
+        covered mutations not called, NaN otherwise (or for mutations not in the matrix).
+        """
+        columns = np.arange(len(self.mutations)) if mutations is None else self.mutations.get_indexer(mutations)
+        dense = np.full((len(self.samples), len(self.mutations) + 1), np.nan)
+        if self.covered is not None:
+            dense[:, :-1][self.covered_rows()] = 0.0
+        is_covered = self.covered_calls()
+        dense[self.call_rows()[is_covered], self.indices[is_covered]] = self.values[is_covered]
+        # column -1 (mutations not in the matrix) is the all-NaN last column
+        return dense[:, columns]
+
+    def entries(self):
+        """
+        (sample row, mutation id, frequency) entries of the covered mutations in row-major order, as taken by
+        from_entries; only the calls without a coverage mask.
+        """
+        dense = self.to_dense()
+        rows, mutation_ids = np.nonzero(~np.isnan(dense))
+        return rows, mutation_ids, dense[rows, mutation_ids].astype(np.float32)
+
+    def to_json(self):
+        """
+        Json dictionary {'A123C': 0.67, 'T140C': null, ...} of all mutations per sample, as in the timeline tsv
+        file: frequency of the calls, 0.0 for covered mutations not called and null otherwise.
+        """
+        mutations = list(self.mutations)
+        json_rows = []
+        for i in range(len(self.samples)):
+            start, end = self.indptr[i], self.indptr[i + 1]
+            if self.covered is None:
+                row = [None] * len(mutations)
+                for mutation_id, value in zip(self.indices[start:end].tolist(), self.values[start:end].tolist()):
+                    row[mutation_id] = value
+            else:
+                row_covered = self.covered_rows([i])[0]
+                row = np.where(row_covered, 0.0, None).tolist()
+                for mutation_id, value in zip(self.indices[start:end].tolist(), self.values[start:end].tolist()):
+                    if row_covered[mutation_id]:
+                        row[mutation_id] = value
+            json_rows.append(json.dumps(dict(zip(mutations, row)), ensure_ascii=False))
+        return pd.Series(json_rows, index=self.samples, dtype=object)
+
+    def to_timeline(self, timeline, column='nucleotideMutationFrequency', sample_column='submissionId'):
+        """Fill a json column of a timeline data frame, samples without calls are left empty."""
+        timeline[column] = timeline[sample_column].map(self.to_json())
+        return timeline
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+"""
+Persistent cache of parsed input files (e.g. the columnar arrays of vcf_ingest.read_vcf_columns)
+- every entry is a .npz file in the cache directory, keyed by the file path and the parse parameters
+- an entry is valid while the file size and mtime are unchanged; if only the mtime changed, the content hash decides
+- the least recently used entries are evicted once the cache grows over max_bytes
+"""
+
+CACHE_VERSION = 1
+INDEX_FILE = 'index.json'
+
+
+class ParseCache(object):
+    """A size-bounded LRU cache of parsed files, stored as .npz sidecars."""
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        """Initialize variables and load the cache index."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = {}
+        index_path = os.path.join(cache_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as index_fh:
+                self.index = json.load(index_fh)
+
+    def get(self, path, params):
+        """Return the cached arrays of a file, or None if the file is new or changed."""
+        key = self.__key(path, params)
+        entry = self.index.get(key)
+        entry_file = os.path.join(self.cache_dir, entry['file']) if entry else None
+        stat = os.stat(path)
+
+        if entry is None or not os.path.exists(entry_file) or entry['size'] != stat.st_size:
+            self.misses += 1
+            return None
+        if entry['mtime_ns'] != stat.st_mtime_ns:
+            # touched, but maybe not modified
+            if file_sha256(path) != entry['sha256']:
+                self.misses += 1
+                return None
+            entry['mtime_ns'] = stat.st_mtime_ns
+
+        entry['last_used'] = time.time()
+        self.hits += 1
+        with np.load(entry_file, allow_pickle=False) as cached:
+            # strings are stored as fixed width unicode, the parsers hand out object arrays
+            return {name: cached[name].astype(object) if cached[name].dtype.kind == 'U' else cached[name]
+                    for name in cached.files}
+
+    def put(self, path, params, columns):
+        """Store the arrays parsed from a file."""
+        key = self.__key(path, params)
+        stat = os.stat(path)
+        entry_name = hashlib.sha1(key.encode()).hexdigest() + '.npz'
+        entry_file = os.path.join(self.cache_dir, entry_name)
+        tmp_file = entry_file + '.tmp.npz'
+        np.savez(tmp_file, **{name: values.astype(str) if values.dtype == object else values
+                              for name, values in columns.items()})
+        os.replace(tmp_file, entry_file)
+
+        self.index[key] = {'file': entry_name,
+                           'size': stat.st_size,
+                           'mtime_ns': stat.st_mtime_ns,
+                           'sha256': file_sha256(path),
+                           'nbytes': os.path.getsize(entry_file),
+                           'last_used': time.time()}
+
+    def save(self):
+        """Evict the least recently used entries over max_bytes and write the index."""
+        total_bytes = sum(entry['nbytes'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if total_bytes <= self.max_bytes:
+                break
+            entry = self.index.pop(key)
+            total_bytes -= entry['nbytes']
+            entry_file = os.path.join(self.cache_dir, entry['file'])
+            if os.path.exists(entry_file):
+                os.remove(entry_file)
+
+        index_path = os.path.join(self.cache_dir, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as index_fh:
+            json.dump(self.index, index_fh)
+        os.replace(index_path + '.tmp', index_path)
+
+    def __key(self, path, params):
+        return '{0}|{1}|v{2}'.format(os.path.abspath(path), params, CACHE_VERSION)
+
+
+def file_sha256(path):
+    """Content hash of a file, read in blocks."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
@@ -1,13 +1,12 @@
-import pandas as pd
-import requests
-import json
+import argparse
+from lapis_snapshot import SnapshotStore, SNAPSHOT_DB
 
+"""
+Proportions of the amino acid substitutions observed in the wastewater among the RSV sequences on LAPIS, globally
+(RSV-A, RSV-B) and in Switzerland (RSV-B); read offline from a snapshot of lapis_snapshot.py, e.g.
+python lapis_snapshot.py snapshot --countries Switzerland
+"""
 
-url_rsva ='https://lapis.genspectrum.org/rsv-a/sample/aminoAcidMutations?minProportion=0.0&orderBy=sequenceName&limit=10000&downloadAsFile=false'
-response_rsva = requests.get(url_rsva)
-data_rsva = (json.loads(response_rsva.content))['data']
-
-print("RSV-A mutations")
 # Amino acid substitutions of RSV-A observed in the wastewater
 rsva_aa_mut = ["F:T12I",
              "F:L20I",
@@ -20,30 +19,6 @@ rsva_aa_mut = ["F:T12I",
              "F:S377N",
              "F:A518V"]
 
-mutation_proportions_rsva = []
-for entry in data_rsva:
-    #print(entry)
-    if entry['mutation'] in rsva_aa_mut:
-        mutation_proportions_rsva.append(
-            {
-                'mutation':entry['mutation'],
-                'percentage %': round(entry['proportion'],5) * 100, # provide in percentage
-                'count': entry['count'],
-                'total': entry['count'] / entry['proportion']
-
-            }
-        )
-
-mutation_proportions_rsva = pd.DataFrame(mutation_proportions_rsva)
-print(mutation_proportions_rsva)
-#mutation_proportions_rsva.to_csv('rsv_a_globally_found_mutations.csv', index=False)
-#print(mutation_proportions)
-
-url_rsvb ='https://lapis.genspectrum.org/rsv-b/sample/aminoAcidMutations?minProportion=0.0&orderBy=sequenceName&limit=10000&downloadAsFile=false'
-response_rsvb = requests.get(url_rsvb)
-print("RSV-B mutations")
-data_rsvb = (json.loads(response_rsvb.content))['data']
-#print(data_rsvb)
 # Amino acid substitutions of RSV-B observed in the wastewater
 rsvb_aa_mut = ["F:F12I",
                "F:R42K",
@@ -55,45 +30,38 @@ rsvb_aa_mut = ["F:F12I",
                "F:T555A"]
 
 
+def mutation_proportions(store, virus, mutations, country=None, snapshot=None):
+    proportions = store.proportions(virus, mutations, country=country, snapshot=snapshot)
+    # provide in percentage
+    proportions.insert(1, 'percentage %', proportions.pop('proportion').round(5) * 100)
+    return proportions
 
-mutation_proportions_rsvb = []
-for entry in data_rsvb:
-    #print(entry)
-    if entry['mutation'] in rsvb_aa_mut:
-        mutation_proportions_rsvb.append(
-            {
-                'mutation':entry['mutation'],
-                'percentage % ': round(entry['proportion'],5) * 100,
-                'count': entry['count'],
-                'total': entry['count']/entry['proportion']
-            }
-        )
-
-mutation_proportions_rsvb = pd.DataFrame(mutation_proportions_rsvb)
-#mutation_proportions_rsvb.to_csv('rsv_b_globally_found_mutations.csv', index=False)
 
-print(mutation_proportions_rsvb)
+def main(db=SNAPSHOT_DB, snapshot=None):
+    store = SnapshotStore(db)
 
+    print("RSV-A mutations")
+    mutation_proportions_rsva = mutation_proportions(store, 'rsv-a', rsva_aa_mut, snapshot=snapshot)
+    print(mutation_proportions_rsva)
+    #mutation_proportions_rsva.to_csv('rsv_a_globally_found_mutations.csv', index=False)
 
-url_swissb = 'https://lapis.genspectrum.org/rsv-b/sample/aminoAcidMutations?country=Switzerland&minProportion=0.0&orderBy=sequenceName&limit=10000&downloadAsFile=false'
-response_rsv_swiss_b = requests.get(url_swissb)
-print("swiss RSV-B mutations")
-data_rsv_swiss_b = (json.loads(response_rsv_swiss_b.content))['data']
+    print("RSV-B mutations")
+    mutation_proportions_rsvb = mutation_proportions(store, 'rsv-b', rsvb_aa_mut, snapshot=snapshot)
+    #mutation_proportions_rsvb.to_csv('rsv_b_globally_found_mutations.csv', index=False)
+    print(mutation_proportions_rsvb)
 
+    print("swiss RSV-B mutations")
+    mutation_proportions_rsv_swiss_b = mutation_proportions(store, 'rsv-b', rsvb_aa_mut, country='Switzerland',
+                                                            snapshot=snapshot)
+    #mutation_proportions_rsv_swiss_b.to_csv('rsv_b_swiss_found_mutations.csv', index=False)
+    print(mutation_proportions_rsv_swiss_b)
+    store.close()
 
-mutation_proportions_rsv_swiss_b = []
-for entry in data_rsv_swiss_b:
-    #print(entry)
-    if entry['mutation'] in rsvb_aa_mut:
-        mutation_proportions_rsv_swiss_b.append(
-            {
-                'mutation':entry['mutation'],
-                'percentage % ': round(entry['proportion'],5) * 100,
-                'count':entry['count'],
-                'total': entry['count']/entry['proportion']
-            }
-        )
 
-mutation_proportions_rsv_swiss_b = pd.DataFrame(mutation_proportions_rsv_swiss_b)
-#mutation_proportions_rsv_swiss_b.to_csv('rsv_b_swiss_found_mutations.csv', index=False)
-print(mutation_proportions_rsv_swiss_b)
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='proportions of the amino acid substitutions observed in the wastewater, globally and in Switzerland')
+    parser.add_argument('--db', default=SNAPSHOT_DB, help='SQLite file of lapis_snapshot.py')
+    parser.add_argument('--snapshot', type=int, default=None, help='snapshot id (default: the latest)')
+    args = parser.parse_args()
+    main(args.db, snapshot=args.snapshot)
@@ -0,0 +1,102 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+"""
+Client of the LAPIS API (lapis.genspectrum.org) used to fetch the RSV clade definitions
+- a single requests.Session with a connection pool, retried with exponential backoff on connection errors and
+  429/5xx responses
+- clade_definitions fetches the nucleotide mutations of all clades concurrently (at most max_workers requests at once)
+- responses are cached on disk by (virus, clade, minProportion, limit), one json file each, so reruns and a growing
+  clade list only fetch the clades not cached yet
+- clade_proportions downloads all mutations of the clades once (minProportion=0, with their proportions), from which
+  the definitions at any threshold are derived offline (rsv_signatures.py)
+- base_url points the client to another LAPIS instance, e.g. a local stub server
+- also used by lapis_snapshot.py, which keeps aggregate tables of LAPIS in a local SQLite store
+"""
+
+LAPIS_URL = 'https://lapis.genspectrum.org'
+MAX_WORKERS = 8
+RETRIES = 5
+BACKOFF_FACTOR = 0.5
+TIMEOUT = 60
+# mutations per clade requested from LAPIS (at a threshold, the proportions download is not limited)
+MUTATION_LIMIT = 1000
+
+
+class LapisClient(object):
+    """Pooled, retrying and caching client of the LAPIS sample endpoints."""
+
+    def __init__(self, base_url=LAPIS_URL, cache_dir=None, max_workers=MAX_WORKERS, retries=RETRIES,
+                 backoff_factor=BACKOFF_FACTOR, timeout=TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=['GET'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, virus, endpoint, params):
+        """'data' of the json response of a sample endpoint, e.g. get('rsv-a', 'nucleotideMutations', {...})."""
+        return self.response(virus, endpoint, params)['data']
+
+    def response(self, virus, endpoint, params):
+        """Json response of a sample endpoint, 'data' and 'info' (with the dataVersion of the LAPIS instance)."""
+        params = dict(params, dataFormat='JSON', downloadAsFile='false')
+        response = self.session.get(f'{self.base_url}/{virus}/sample/{endpoint}', params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def nucleotide_mutations(self, virus, clade, min_proportion, refresh=False, limit=MUTATION_LIMIT):
+        """
+        Nucleotide mutation records (mutation, proportion, count, ...) of a clade, from the cache if there; at most
+        limit records (all if None).
+        """
+        cache_file = self.__cache_file(virus, clade, min_proportion, limit)
+        if cache_file and not refresh and os.path.exists(cache_file):
+            with open(cache_file) as fh:
+                return json.load(fh)
+
+        params = {'lineage': clade, 'minProportion': min_proportion}
+        if limit is not None:
+            params['limit'] = limit
+        data = self.get(virus, 'nucleotideMutations', params)
+        if cache_file:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # written next to the cache file and renamed, an interrupted run never leaves a truncated entry
+            with open(cache_file + '.tmp', 'w') as fh:
+                json.dump(data, fh)
+            os.replace(cache_file + '.tmp', cache_file)
+        return data
+
+    def clade_records(self, virus, clades, min_proportion, refresh=False, limit=MUTATION_LIMIT):
+        """Nucleotide mutation records of every clade, fetched concurrently, {clade: [record, ...]}."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            records = list(executor.map(lambda clade: self.nucleotide_mutations(virus, clade, min_proportion,
+                                                                                refresh=refresh, limit=limit),
+                                        clades))
+        return dict(zip(clades, records))
+
+    def clade_definitions(self, virus, clades, min_proportion, refresh=False):
+        """Mutations of every clade with a proportion of at least min_proportion, {clade: [mutation, ...]}."""
+        return {clade: [record['mutation'] for record in clade_records]
+                for clade, clade_records in self.clade_records(virus, clades, min_proportion, refresh).items()}
+
+    def clade_proportions(self, virus, clades, refresh=False):
+        """All mutations of every clade with their proportion, {clade: {mutation: proportion}}."""
+        return {clade: {record['mutation']: record['proportion'] for record in clade_records}
+                for clade, clade_records in self.clade_records(virus, clades, 0.0, refresh, limit=None).items()}
+
+    def __cache_file(self, virus, clade, min_proportion, limit):
+        if not self.cache_dir:
+            return None
+        # a limited response is not the complete list of an unlimited one, e.g. A.D_0.0_1000.json and A.D_0.0_all.json
+        return os.path.join(self.cache_dir, virus, 'nucleotideMutations',
+                            f'{clade}_{float(min_proportion)!r}_{limit if limit is not None else "all"}.json')
@@ -1,12 +1,22 @@
-import requests
 import json
+import argparse
+from lapis_client import LapisClient, LAPIS_URL, MAX_WORKERS
+
+"""
+Fetch the lineage-defining nucleotide mutations of the RSV-A and RSV-B clades from LAPIS
+(RSVA_nucleotide_mutations_{proportion}.json, RSVB_nucleotide_mutations_{proportion}.json);
+all clades are fetched concurrently and cached on disk (lapis_client.py).
+With --download-proportions, all mutations of the clades are downloaded once with their proportions
+(RSVA_nucleotide_proportions.json, RSVB_nucleotide_proportions.json); rsv_signatures.py --proportions then derives
+the signatures matrices at any thresholds offline
+"""
 
 # To call mutation lineage-defining we set threshold of frequency at 0.9 (default).
 proportion = 0.90
 # """
 # Extract RSV-B clades definitions:
 # """
-clades = [
+rsvb_clades = [
 
     "B.D",
     "B.D.1",
@@ -22,28 +32,11 @@ clades = [
     "B.D.E.4"
 ]
 
-# RSV-B nucleotide mutations
-clades_definitions = {}
-# Create a list of mutations for each clade:
-for clade in clades:
-    url = f'https://lapis.genspectrum.org/rsv-b/sample/nucleotideMutations?lineage={clade}&minProportion={proportion}&limit=1000&dataFormat=JSON&downloadAsFile=false'
-    response = requests.get(url)
-    data = (json.loads(response.content))
-   # print(data)
-    mutations = [single_mut_info["mutation"] for single_mut_info in data['data']]
-    clades_definitions[clade] = mutations
-
-print(clades_definitions)
-file_path = f"RSVB_nucleotide_mutations_{proportion}.json"
-with open(file_path, 'w') as file:
-    json.dump(clades_definitions, file, indent=4)
-
-
 # """
 # Extract RSV-A clades definitions:
 # """
 
-clades = [
+rsva_clades = [
 "A.D",
 
 "A.D.1",
@@ -79,19 +72,41 @@ clades = [
 "A.D.5.4"
 ]
 
-# RSV-A nucleotide mutations
-clades_definitions = {}
-# Create a list of mutations for each clade:
-for clade in clades:
-    url = f'https://lapis.genspectrum.org/rsv-a/sample/nucleotideMutations?lineage={clade}&minProportion={proportion}&limit=1000&dataFormat=JSON&downloadAsFile=false'
-    response = requests.get(url)
-    data = (json.loads(response.content))
-   # print(data)
-    mutations = [single_mut_info["mutation"] for single_mut_info in data['data']]
-    clades_definitions[clade] = mutations
-
-print(clades_definitions)
-file_path = f"RSVA_nucleotide_mutations_{proportion}.json"
-with open(file_path, 'w') as file:
-    json.dump(clades_definitions, file, indent=4)
+# virus on LAPIS, clades and output file prefix
+VIRUSES = [('rsv-b', rsvb_clades, 'RSVB'), ('rsv-a', rsva_clades, 'RSVA')]
+
+
+def main(proportion=proportion, cache_dir=None, base_url=LAPIS_URL, max_workers=MAX_WORKERS, refresh=False,
+         download_proportions=False):
+    client = LapisClient(base_url=base_url, cache_dir=cache_dir, max_workers=max_workers)
+    for virus, clades, prefix in VIRUSES:
+        if download_proportions:
+            # {clade: {mutation: proportion}}, clades without mutations are kept
+            with open(f"{prefix}_nucleotide_proportions.json", 'w') as file:
+                json.dump(client.clade_proportions(virus, clades, refresh=refresh), file, indent=4)
+            continue
+
+        # Create a list of mutations for each clade:
+        clades_definitions = client.clade_definitions(virus, clades, proportion, refresh=refresh)
+
+        print(clades_definitions)
+        file_path = f"{prefix}_nucleotide_mutations_{proportion}.json"
+        with open(file_path, 'w') as file:
+            json.dump(clades_definitions, file, indent=4)
+
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fetch the lineage-defining mutations of the RSV clades from LAPIS')
+    parser.add_argument('--proportion', type=float, default=proportion,
+                        help='minimal proportion of the sequences of a clade with the mutation')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of the cached LAPIS responses, cached clades are not fetched again')
+    parser.add_argument('--download-proportions', action='store_true',
+                        help='download all mutations of the clades with their proportions (minProportion=0) instead, '
+                             'for rsv_signatures.py --proportions')
+    parser.add_argument('--refresh', action='store_true', help='fetch all clades again and update the cache')
+    parser.add_argument('--base-url', default=LAPIS_URL, help='LAPIS instance to query')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS, help='number of concurrent requests')
+    args = parser.parse_args()
+    main(args.proportion, cache_dir=args.cache_dir, base_url=args.base_url, max_workers=args.max_workers,
+         refresh=args.refresh, download_proportions=args.download_proportions)
@@ -1,37 +1,150 @@
+import os
+import sys
 import json
 import csv
+import argparse
+import numpy as np
+import pandas as pd
 
-#Prepare binary data matrix: lineages x signature mutations
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mutation_catalog import MutationCatalog
 
-#json_file = "RSVB_nucleotide_mutations_0.9.json"
-json_file = "RSVA_nucleotide_mutations_0.9.json"
-with open(json_file, "r") as file:
-    clades_definitions = json.load(file)
+"""
+Prepare binary data matrix: lineages x signature mutations
+- from the clade definitions at one threshold (RSVA_nucleotide_mutations_0.9.json of rsv_definitions.py)
+- or (--proportions) from the mutation proportions of the clades (RSVA_nucleotide_proportions.json of
+  rsv_definitions.py --download-proportions), for several thresholds at once: a mutation is lineage-defining if its
+  proportion in the clade is at least the threshold, one signatures matrix is written per threshold
+The mutations of every lineage are a packed bitset (one bit per mutation, mutations sorted by genome position with
+the keys parsed by mutation_catalog.py, deletions as A123-). Optionally, the matrix is compressed:
+- --collapse-shared N keeps only N of the mutations shared by a lineage and all its sub-lineages (named by the
+  clade, A.D > A.D.1 > A.D.1.5) and by no other lineage, their columns are identical
+- --drop-uninformative drops the mutations of all lineages, they tell no lineage apart
+"""
 
 
+# Mutations sorted by genome position (and key, for mutations at the same position)
+def sort_mutations(mutations):
+    mutations = sorted(mutations)
+    order = np.argsort(MutationCatalog(mutations).positions(mutations), kind='stable')
+    return [mutations[i] for i in order]
 
-# Collect the set of mutations
-mutations = set()
-for lineage, lineage_mutations in clades_definitions.items():
-    mutations.update(lineage_mutations)
-# Prepare the CSV data
-# First column of lineages, then mutations sorted
-header = ['Lineages'] + sorted(mutations, key=lambda x: int(''.join([char for char in x if char.isdigit()])))
-rows = []
 
-# Create rows for each lineage with 1 or 0 indicating presence of mutation
-for lineage, lineage_mutations in clades_definitions.items():
-    row = [lineage] + [1 if mutation in lineage_mutations else 0 for mutation in header[1:]]
-    rows.append(row)
+# lineages x mutations bitsets: row i has the bit of mutation j set if lineage i has it
+def signature_bits(clades_definitions):
+    lineages = list(clades_definitions)
+    mutations = sort_mutations(set().union(*clades_definitions.values()))
+    columns = {mutation: j for j, mutation in enumerate(mutations)}
 
+    bits = np.zeros((len(lineages), (len(mutations) + 7) // 8), dtype=np.uint8)
+    for i, lineage in enumerate(lineages):
+        lineage_columns = np.array([columns[mutation] for mutation in set(clades_definitions[lineage])], dtype=np.int64)
+        np.bitwise_or.at(bits[i], lineage_columns >> 3, (0x80 >> (lineage_columns & 7)).astype(np.uint8))
+    return lineages, mutations, bits
 
-# Specify the file name
-#filename = 'rsv_b_signatures.csv'
-filename = 'rsv_a_signatures.csv'
 
-# Write to CSV
-with open(filename, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(header)  # Write header
-    writer.writerows(rows)   # Write data rows
+# Sub-lineages of every lineage with at least one, by name: A.D.1 and A.D.1.5 are sub-lineages of A.D
+def lineage_subtrees(lineages):
+    subtrees = {}
+    for lineage in lineages:
+        subtree = [other for other in lineages if other == lineage or other.startswith(lineage + '.')]
+        if len(subtree) > 1:
+            subtrees[lineage] = subtree
+    return subtrees
 
+
+# Mask of the mutations kept in the matrix, see --collapse-shared and --drop-uninformative
+def compressed_columns(lineages, n_mutations, bits, collapse_shared=None, drop_uninformative=False):
+    flags = np.unpackbits(bits, axis=1, count=n_mutations).astype(bool)
+    keep = np.ones(n_mutations, dtype=bool)
+    if drop_uninformative:
+        keep &= ~flags.all(axis=0)
+
+    if collapse_shared is not None:
+        # lineages of every mutation as a packed bitset, compared with the lineages of every subtree
+        column_bits = np.packbits(flags.T, axis=1)
+        subtree_bits = {}
+        for lineage, subtree in lineage_subtrees(lineages).items():
+            in_subtree = np.isin(lineages, subtree)
+            subtree_bits[np.packbits(in_subtree).tobytes()] = lineage
+        kept = dict.fromkeys(subtree_bits, 0)
+        for j in np.flatnonzero(keep):
+            pattern = column_bits[j].tobytes()
+            if pattern in kept:
+                keep[j] = kept[pattern] < collapse_shared
+                kept[pattern] += 1
+    return keep
+
+
+def signature_matrix(clades_definitions, collapse_shared=None, drop_uninformative=False):
+    lineages, mutations, bits = signature_bits(clades_definitions)
+    keep = compressed_columns(lineages, len(mutations), bits, collapse_shared, drop_uninformative)
+    flags = np.unpackbits(bits, axis=1, count=len(mutations))[:, keep]
+    # First column of lineages, then mutations sorted, 1 or 0 indicating presence of mutation
+    header = ['Lineages'] + [mutation for mutation, kept in zip(mutations, keep) if kept]
+    rows = [[lineage] + lineage_flags.tolist() for lineage, lineage_flags in zip(lineages, flags)]
+    return header, rows
+
+
+# Signatures matrices of every threshold, from the {clade: {mutation: proportion}} proportions; the lineages x
+# mutations proportions are compared with all thresholds in one go, mutations of no lineage are left out
+def signature_matrices(clade_proportions, thresholds, collapse_shared=None, drop_uninformative=False):
+    proportions = pd.DataFrame.from_dict(clade_proportions, orient='index').reindex(list(clade_proportions))
+    proportions = proportions[sort_mutations(proportions.columns)].fillna(0.0)
+
+    flags = proportions.to_numpy()[None, :, :] >= np.asarray(thresholds, dtype=float)[:, None, None]
+    lineages = proportions.index.tolist()
+    matrices = {}
+    for threshold, threshold_flags in zip(thresholds, flags):
+        in_lineage = threshold_flags.any(axis=0)
+        threshold_flags = threshold_flags[:, in_lineage]
+        keep = compressed_columns(lineages, threshold_flags.shape[1], np.packbits(threshold_flags, axis=1),
+                                  collapse_shared, drop_uninformative)
+        matrices[threshold] = pd.DataFrame(threshold_flags[:, keep].astype(int), index=proportions.index,
+                                           columns=proportions.columns[in_lineage][keep]).rename_axis('Lineages')
+    return matrices
+
+
+def write_signature_matrix(filename, header, rows):
+    # Write to CSV
+    with open(filename, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)  # Write header
+        writer.writerows(rows)   # Write data rows
+
+
+def main(json_file, filename, proportions_file=None, thresholds=None, collapse_shared=None, drop_uninformative=False):
+    if proportions_file is None:
+        with open(json_file, "r") as file:
+            clades_definitions = json.load(file)
+        write_signature_matrix(filename, *signature_matrix(clades_definitions, collapse_shared, drop_uninformative))
+        return
+
+    with open(proportions_file, "r") as file:
+        clade_proportions = json.load(file)
+    # one file per threshold, e.g. rsv_a_signatures_0.9.csv
+    prefix = filename[:-len('.csv')] if filename.endswith('.csv') else filename
+    for threshold, matrix in signature_matrices(clade_proportions, thresholds, collapse_shared,
+                                                drop_uninformative).items():
+        matrix.to_csv(f'{prefix}_{threshold}.csv')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='prepare the lineages x signature mutations matrix')
+    parser.add_argument('json_file', nargs='?', default="RSVA_nucleotide_mutations_0.9.json",
+                        help='clade definitions of rsv_definitions.py, e.g. RSVB_nucleotide_mutations_0.9.json')
+    parser.add_argument('--output', default='rsv_a_signatures.csv',
+                        help='signatures matrix, e.g. rsv_b_signatures.csv; with --proportions, the threshold is '
+                             'added to the file name (rsv_a_signatures_0.9.csv)')
+    parser.add_argument('--proportions', default=None,
+                        help='mutation proportions of rsv_definitions.py --download-proportions, e.g. '
+                             'RSVA_nucleotide_proportions.json, used instead of json_file')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.7, 0.8, 0.9, 0.95],
+                        help='minimal proportions of a lineage-defining mutation, with --proportions')
+    parser.add_argument('--collapse-shared', type=int, default=None, metavar='N',
+                        help='keep only N of the mutations shared by exactly a lineage and all its sub-lineages')
+    parser.add_argument('--drop-uninformative', action='store_true',
+                        help='drop the mutations of all lineages')
+    args = parser.parse_args()
+    main(args.json_file, args.output, proportions_file=args.proportions, thresholds=args.thresholds,
+         collapse_shared=args.collapse_shared, drop_uninformative=args.drop_uninformative)
@@ -0,0 +1,171 @@
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import coverage_reader
+import instrumentation
+from make_tallymut import COVERAGE_THRESHOLD, signature_positions
+
+"""
+Select a reduced set of signature mutations that still tells the lineages apart, as the signatures matrix of
+make_tallymut.py: the tallymut file and the deconvolution shrink with the number of mutations
+- coverage_weights function gives every signature mutation the share of the samples covering its position above the
+  coverage threshold of make_tallymut.py (coverage.tsv.gz files or a coverage store, as in make_tallymut.py)
+- select_signatures function picks mutations greedily: every step adds the mutation raising the rank of the
+  mutations x lineages design matrix, then the one completing the markers of a lineage (--min-per-lineage), then
+  the one maximising the smallest eigenvalue of the coverage-weighted Gram matrix, so well covered mutations are
+  favoured; once all lineages are identifiable (full rank), mutations are only added while the condition number of
+  the selected design keeps improving, up to --max-condition; the selection with the lowest condition number is kept,
+  with a warning if --max-condition cannot be reached
+- the lineages can be restricted (--lineages, e.g. the clades circulating in Switzerland), mutations of none of them
+  are never selected
+"""
+
+logger = logging.getLogger(__name__)
+
+MAX_CONDITION = 10.0
+# mutations added without lowering the condition number before the selection stops
+CONDITION_PATIENCE = 20
+# weight of positions never covered, they are only selected if the lineages cannot be told apart otherwise
+MIN_WEIGHT = 0.01
+
+
+# Share of the samples with coverage above the threshold at the position of every signature mutation
+def coverage_weights(signatures_matrix, input_dir_cov, reference, coverage_threshold=COVERAGE_THRESHOLD):
+    positions = signature_positions(signatures_matrix)
+    samples, coverage_matrix = coverage_reader.process_multiple_coverage_files(
+        input_dir_cov, [reference], positions={reference: positions})[reference]
+
+    # column j of the coverage matrix holds position j + 1
+    covered = np.zeros(len(positions))
+    in_range = positions <= coverage_matrix.shape[1]
+    if len(samples):
+        covered[in_range] = (coverage_matrix[:, positions[in_range] - 1] > coverage_threshold).mean(axis=0)
+    logger.info('%s: coverage of %d signature positions in %d samples', reference, len(positions), len(samples))
+    return np.maximum(covered, MIN_WEIGHT)
+
+
+# Indices of the selected mutations (columns of the lineages x mutations design), in order of selection
+def select_signatures(design, weights, max_condition=MAX_CONDITION, min_per_lineage=1, max_mutations=None):
+    n_lineages, n_mutations = design.shape
+    columns = design.T.astype(float)
+    # coverage-weighted contribution of every mutation to the lineages x lineages Gram matrix
+    contributions = weights[:, None, None] * columns[:, :, None] * columns[:, None, :]
+    target_rank = np.linalg.matrix_rank(columns) if n_mutations else 0
+    if target_rank < n_lineages:
+        logger.warning('the signatures of %d lineages are not linearly independent, rank %d',
+                       n_lineages, target_rank)
+
+    gram = np.zeros((n_lineages, n_lineages))
+    markers = np.zeros(n_lineages, dtype=np.int64)
+    available = columns.any(axis=1)
+    selected, rank = [], 0
+    # once the lineages are identifiable, the prefix of the selection with the lowest condition number so far
+    best_size, best_condition = None, np.inf
+    while available.any() and (max_mutations is None or len(selected) < max_mutations):
+        if rank == target_rank and (markers >= min_per_lineage).all():
+            condition = np.linalg.cond(columns[selected])
+            if condition < best_condition:
+                best_size, best_condition = len(selected), condition
+            # stop at max_condition, or once the condition number stopped improving
+            if condition <= max_condition or len(selected) - best_size >= CONDITION_PATIENCE:
+                break
+
+        candidates = np.flatnonzero(available)
+        eigenvalues = np.linalg.eigvalsh(gram + contributions[candidates])
+        candidate_ranks = (eigenvalues > 1e-9 * np.maximum(eigenvalues[:, -1:], 1.0)).sum(axis=1)
+        marker_gains = columns[candidates][:, markers < min_per_lineage].sum(axis=1)
+        # the last key is the primary one
+        best = candidates[np.lexsort((weights[candidates], eigenvalues[:, 0], marker_gains, candidate_ranks))[-1]]
+
+        selected.append(best)
+        available[best] = False
+        gram += contributions[best]
+        markers += design[:, best].astype(np.int64)
+        rank = np.linalg.matrix_rank(columns[selected])
+
+    if rank == target_rank and (markers >= min_per_lineage).all():
+        condition = np.linalg.cond(columns[selected])
+        if condition < best_condition:
+            best_size, best_condition = len(selected), condition
+    if best_size is None:
+        logger.warning('the constraints are not met by the %d selected mutations (rank %d of %d)',
+                       len(selected), rank, target_rank)
+        return selected
+    if best_condition > max_condition:
+        logger.warning('condition number %.1f cannot be reached, the lowest found is %.1f with %d mutations',
+                       max_condition, best_condition, best_size)
+    return selected[:best_size]
+
+
+def main(signatures_matrix, output_file, input_dir_cov=None, reference=None, lineages=None,
+         max_condition=MAX_CONDITION, min_per_lineage=1, max_mutations=None, coverage_threshold=COVERAGE_THRESHOLD):
+    signatures = pd.read_csv(signatures_matrix, index_col='Lineages')
+    if input_dir_cov is not None:
+        with instrumentation.stage('read_coverage'):
+            weights = coverage_weights(signatures_matrix, input_dir_cov, reference, coverage_threshold)
+    else:
+        weights = np.ones(signatures.shape[1])
+
+    if lineages is not None:
+        missing = [lineage for lineage in lineages if lineage not in signatures.index]
+        if missing:
+            raise ValueError('lineages not in {0}: {1}'.format(signatures_matrix, ', '.join(missing)))
+        signatures = signatures.loc[lineages]
+
+    with instrumentation.stage('select'):
+        selected = select_signatures(signatures.to_numpy(), weights, max_condition=max_condition,
+                                     min_per_lineage=min_per_lineage, max_mutations=max_mutations)
+    # mutations keep the order of the signatures matrix
+    selected = np.sort(selected)
+    reduced = signatures.iloc[:, selected]
+    reduced.to_csv(output_file)
+
+    logger.info('%d of %d signature mutations selected for %d lineages (rank %d, condition number %.1f), '
+                'mean coverage share %.2f instead of %.2f',
+                len(selected), signatures.shape[1], len(signatures), np.linalg.matrix_rank(reduced.to_numpy().T),
+                np.linalg.cond(reduced.to_numpy().T), weights[selected].mean() if len(selected) else 0.0,
+                weights.mean())
+    if len(selected) == signatures.shape[1]:
+        logger.warning('no signature mutation could be left out')
+    return len(selected), signatures.shape[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='select the signature mutations telling the lineages apart, favouring well covered positions')
+
+    parser.add_argument('signatures_matrix', help='lineages definition matrix with lineages in the rows and mutations '
+                                                  'in the columns (rsv_signatures.py)')
+    parser.add_argument('output', help='reduced signatures matrix, input of make_tallymut.py')
+    parser.add_argument('--coverage', default=None,
+                        help='path to coverage.tsv.gz, or a coverage store directory written by '
+                             'extract_coverage_RSV_Vpipe.py --store; all positions are weighted alike without it')
+    parser.add_argument('--reference', default=None, help='reference of the coverage, e.g. EPI_ISL_412866')
+    parser.add_argument('--lineages', default=None,
+                        help='comma separated lineages to tell apart (default: all lineages of the matrix)')
+    parser.add_argument('--max-condition', type=float, default=MAX_CONDITION,
+                        help='largest condition number of the selected mutations x lineages design matrix')
+    parser.add_argument('--min-per-lineage', type=int, default=1,
+                        help='smallest number of selected mutations of every lineage')
+    parser.add_argument('--max-mutations', type=int, default=None,
+                        help='largest number of selected mutations, even if the constraints are not met')
+    parser.add_argument('--coverage-threshold', type=int, default=COVERAGE_THRESHOLD,
+                        help='coverage above which a position counts as covered in a sample')
+    parser.add_argument('--require-reduction', action='store_true',
+                        help='exit with an error if the selection keeps all signature mutations (used as a check by '
+                             'utilities/benchmarks/run_benchmarks.py)')
+
+    instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+    instrumentation.setup(args, 'select_signatures')
+    if args.coverage and not args.reference:
+        parser.error('--coverage needs --reference')
+    n_selected, n_signatures = main(args.signatures_matrix, args.output, input_dir_cov=args.coverage,
+                                    reference=args.reference,
+                                    lineages=args.lineages.split(',') if args.lineages else None,
+                                    max_condition=args.max_condition, min_per_lineage=args.min_per_lineage,
+                                    max_mutations=args.max_mutations, coverage_threshold=args.coverage_threshold)
+    if args.require_reduction and n_selected == n_signatures:
+        parser.exit(1, f'all {n_signatures} signature mutations were selected\n')
@@ -0,0 +1,192 @@
+import json
+import numpy as np
+import pandas as pd
+from mutation_matrix import MutationMatrix
+
+"""
+Timeline files with mutation frequencies, written by make_mutation_tsv.py and read by make_tallymut.py and the heatmaps
+- .tsv: one row per sample, the mutation frequencies as json dictionaries {'A123C': 0.67, 'T140C': null, ...} in the
+  nucleotideMutationFrequency and aminoAcidMutationFrequency columns (LAPIS-style export)
+- .parquet or .arrow (Arrow IPC): long table of the mutation frequencies, one row per sample and covered mutation
+  (row, column, mutation, frequency), with dictionary-encoded column and mutation names and float32 frequencies.
+  The other sample columns, the order of the mutations and the rows with frequencies are kept in the schema metadata
+read_timeline returns the tsv layout for both formats, read_timeline_matrices a MutationMatrix per json column
+without parsing any json from the binary formats.
+"""
+
+JSON_COLUMNS = ['nucleotideMutationFrequency', 'aminoAcidMutationFrequency']
+BINARY_FORMATS = ('.parquet', '.arrow')
+TIMELINE_VERSION = 1
+METADATA_KEY = b'timeline'
+
+
+def is_binary_timeline(path):
+    return str(path).endswith(BINARY_FORMATS)
+
+
+def write_timeline(timeline, path, matrices=None, sample_column='submissionId'):
+    """
+    Write a timeline in the format given by the file extension. Json columns are taken from matrices (samples matched
+    to the timeline rows by sample_column, as in MutationMatrix.to_timeline) or from the json strings of the timeline.
+    """
+    matrices = matrices or {}
+    if not is_binary_timeline(path):
+        timeline = timeline.copy()
+        for column, matrix in matrices.items():
+            matrix.to_timeline(timeline, column, sample_column)
+        timeline.to_csv(path, sep='\t', index=False, quoting=3)
+        return
+
+    # pyarrow is only needed for the binary formats
+    import pyarrow as pa
+
+    json_columns = [column for column in timeline.columns if column in JSON_COLUMNS or column in matrices]
+    samples = timeline.drop(columns=json_columns)
+    metadata = {'version': TIMELINE_VERSION,
+                'columns': list(timeline.columns),
+                'samples': {'columns': list(samples.columns),
+                            'data': samples.astype(object).where(samples.notna(), None).values.tolist()},
+                'mutations': {},
+                'rows': {}}
+
+    rows, column_codes, mutations, frequencies = [], [], [], []
+    for code, column in enumerate(json_columns):
+        matrix, has_frequencies = _timeline_matrix(timeline, column, matrices.get(column), sample_column)
+        entry_rows, mutation_ids, entry_frequencies = matrix.entries()
+        rows.append(entry_rows)
+        column_codes.append(np.full(len(entry_rows), code))
+        mutations.append(matrix.mutations.take(mutation_ids))
+        frequencies.append(entry_frequencies)
+        metadata['mutations'][column] = list(matrix.mutations)
+        metadata['rows'][column] = np.flatnonzero(has_frequencies).tolist()
+
+    mutations = pd.Index(np.concatenate(mutations) if mutations else [], dtype=object)
+    mutation_codes, mutation_names = pd.factorize(mutations)
+    table = pa.table({'row': pa.array(np.concatenate(rows) if rows else [], type=pa.int32()),
+                      'column': pa.DictionaryArray.from_arrays(
+                          pa.array(np.concatenate(column_codes) if column_codes else [], type=pa.int8()),
+                          pa.array(json_columns, type=pa.string())),
+                      'mutation': pa.DictionaryArray.from_arrays(
+                          pa.array(mutation_codes, type=pa.int32()), pa.array(list(mutation_names), type=pa.string())),
+                      'frequency': pa.array(np.concatenate(frequencies) if frequencies else [], type=pa.float32())})
+    table = table.replace_schema_metadata({METADATA_KEY: json.dumps(metadata)})
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        pq.write_table(table, path)
+    else:
+        with pa.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table)
+
+
+def read_timeline(path, usecols=None):
+    """Timeline in the tsv layout (json columns as json strings) from a .tsv, .parquet or .arrow file."""
+    if not is_binary_timeline(path):
+        return pd.read_csv(path, sep='\t', usecols=usecols)
+
+    metadata, table = _read_binary_timeline(path)
+    samples = pd.DataFrame(metadata['samples']['data'], columns=metadata['samples']['columns'])
+    timeline = {}
+    for column in metadata['columns']:
+        if usecols is not None and column not in usecols:
+            continue
+        if column in metadata['mutations']:
+            matrix = _binary_matrix(metadata, table, column, samples)
+            json_rows = pd.Series(np.nan, index=samples.index, dtype=object)
+            rows = metadata['rows'][column]
+            json_rows[rows] = matrix.take_samples(rows).to_json().to_numpy()
+            timeline[column] = json_rows
+        else:
+            timeline[column] = samples[column]
+    return pd.DataFrame(timeline, index=samples.index)
+
+
+def read_timeline_matrices(path, columns=JSON_COLUMNS, usecols=None, dropna=False, sample_column='submissionId'):
+    """
+    Sample columns (usecols, all if None) and a MutationMatrix per json column, one matrix row per timeline row.
+    Rows without frequencies in any of the json columns are dropped if dropna.
+    """
+    if is_binary_timeline(path):
+        metadata, table = _read_binary_timeline(path)
+        timeline = pd.DataFrame(metadata['samples']['data'], columns=metadata['samples']['columns'])
+        matrices, has_frequencies = {}, np.zeros(len(timeline), dtype=bool)
+        for column in columns:
+            matrices[column] = _binary_matrix(metadata, table, column, timeline, sample_column)
+            has_frequencies[metadata['rows'][column]] = True
+    else:
+        timeline = pd.read_csv(path, sep='\t',
+                               usecols=None if usecols is None else
+                               lambda column: column in usecols or column in columns or column == sample_column)
+        matrices, has_frequencies = {}, np.zeros(len(timeline), dtype=bool)
+        for column in columns:
+            matrices[column], column_has_frequencies = _timeline_matrix(timeline, column, None, sample_column)
+            has_frequencies |= column_has_frequencies
+        timeline = timeline.drop(columns=list(columns))
+
+    if usecols is not None:
+        timeline = timeline[[column for column in timeline.columns if column in usecols or column == sample_column]]
+    if dropna:
+        rows = np.flatnonzero(has_frequencies)
+        timeline = timeline.iloc[rows].reset_index(drop=True)
+        matrices = {column: matrix.take_samples(rows) for column, matrix in matrices.items()}
+    return timeline, matrices
+
+
+def frequency_table(matrix, index):
+    """
+    Data frame of the mutation frequencies of a MutationMatrix, labelled by index (one label per matrix row).
+    Rows of a repeated label are replaced by the last one, at the place of the first one.
+    """
+    table = pd.DataFrame(matrix.to_dense(), index=index, columns=matrix.mutations)
+    if table.index.has_duplicates:
+        table = table[~table.index.duplicated(keep='last')].reindex(table.index[~table.index.duplicated()])
+    return table
+
+
+# MutationMatrix of a json column, one row per timeline row, and the rows that have frequencies
+def _timeline_matrix(timeline, column, matrix, sample_column='submissionId'):
+    if matrix is None:
+        raw = timeline[column]
+        has_frequencies = (raw.notna() & (raw != '')).to_numpy()
+        return MutationMatrix.from_timeline(timeline, column, sample_column), has_frequencies
+
+    sample_rows = matrix.samples.get_indexer(timeline[sample_column].astype(str))
+    return (matrix.take_samples(sample_rows, samples=timeline[sample_column].astype(str)),
+            sample_rows >= 0)
+
+
+def _read_binary_timeline(path):
+    import pyarrow as pa
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+    else:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+    metadata = json.loads(table.schema.metadata[METADATA_KEY])
+    if metadata['version'] != TIMELINE_VERSION:
+        raise ValueError('{0}: unsupported timeline version {1}'.format(path, metadata['version']))
+    return metadata, table
+
+
+# MutationMatrix of a json column of a binary timeline, straight from the long table
+def _binary_matrix(metadata, table, column, samples, sample_column='submissionId'):
+    mutations = pd.Index(metadata['mutations'][column])
+    in_column = _codes(table.column('column'), [column]) == 0
+    return MutationMatrix.from_entries(samples[sample_column].astype(str), mutations,
+                                       table.column('row').to_numpy()[in_column],
+                                       _codes(table.column('mutation'), mutations)[in_column],
+                                       table.column('frequency').to_numpy()[in_column])
+
+
+# codes of the values of a (dictionary-encoded) string column in names, -1 for other values
+def _codes(column, names):
+    import pyarrow as pa
+
+    if not pa.types.is_dictionary(column.type):
+        column = column.dictionary_encode()
+    # dictionaries may differ between chunks, codes are mapped chunk by chunk
+    codes = [pd.Index(names).get_indexer(chunk.dictionary.to_pylist())[chunk.indices.to_numpy(zero_copy_only=False)]
+             for chunk in column.chunks]
+    return np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
@@ -0,0 +1,151 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from mutation_catalog import MutationCatalog
+from mutation_matrix import MutationMatrix
+
+"""
+State of a timeline_mutation output, kept next to it as a .state.npz sidecar by make_mutation_tsv.py --update
+- the nucleotide and amino acid mutation frequencies of all processed samples before the rare mutation filter
+  (MutationMatrix, CSR arrays), so new samples are appended without reading the old VCFs again
+- one bit per sample and genome position for coverage >= the coverage threshold, so the coverage of old samples at
+  new mutations is known without reading the old coverage files again
+- the support count of every nucleotide mutation (samples with a frequency above the threshold at sufficient
+  coverage) and whether it passed the rare mutation filter; only mutations whose count changed are re-evaluated
+The thresholds are stored with the state, a state of other thresholds is not updated.
+"""
+
+STATE_VERSION = 1
+META_KEY = 'meta'
+
+
+class TimelineState(object):
+    """Pre-filter mutation frequencies, coverage bits and support counts of the processed samples of a timeline."""
+
+    def __init__(self, settings, processed=(), nucleotide=None, amino_acid=None, coverage_samples=(),
+                 coverage_bits=None, genome_length=0, support=None, kept=None):
+        self.settings = settings
+        self.processed = list(processed)
+        self.nucleotide = nucleotide if nucleotide is not None else _empty_matrix()
+        self.amino_acid = amino_acid if amino_acid is not None else _empty_matrix()
+        self.coverage_samples = pd.Index(coverage_samples)
+        self.coverage_bits = coverage_bits if coverage_bits is not None else np.zeros((0, 0), dtype=np.uint8)
+        self.genome_length = genome_length
+        self.support = support if support is not None else np.zeros(0, dtype=np.int64)
+        self.kept = kept if kept is not None else np.zeros(0, dtype=bool)
+        self.__positions = MutationCatalog().positions(self.nucleotide.mutations)
+
+    @classmethod
+    def load(cls, path):
+        """State saved by save(), None if there is no state file."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as arrays:
+            meta = json.loads(str(arrays[META_KEY]))
+            if meta['version'] != STATE_VERSION:
+                return None
+            matrices = {name: MutationMatrix(arrays[name + '_samples'], arrays[name + '_mutations'],
+                                             arrays[name + '_indptr'], arrays[name + '_indices'],
+                                             arrays[name + '_values'])
+                        for name in ['nucleotide', 'amino_acid']}
+            return cls(meta['settings'], arrays['processed'], matrices['nucleotide'], matrices['amino_acid'],
+                       arrays['coverage_samples'], arrays['coverage_bits'], meta['genome_length'],
+                       arrays['support'], arrays['kept'])
+
+    def save(self, path):
+        arrays = {META_KEY: np.array(json.dumps({'version': STATE_VERSION, 'settings': self.settings,
+                                                 'genome_length': self.genome_length})),
+                  'processed': np.array(self.processed, dtype=str),
+                  'coverage_samples': np.array(self.coverage_samples, dtype=str),
+                  'coverage_bits': self.coverage_bits,
+                  'support': self.support,
+                  'kept': self.kept}
+        for name, matrix in [('nucleotide', self.nucleotide), ('amino_acid', self.amino_acid)]:
+            arrays.update({name + '_samples': np.array(matrix.samples, dtype=str),
+                           name + '_mutations': np.array(matrix.mutations, dtype=str),
+                           name + '_indptr': matrix.indptr,
+                           name + '_indices': matrix.indices,
+                           name + '_values': matrix.values})
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    def add_samples(self, sample_names, calls, collected_coverage):
+        """
+        Append the calls (sample, mut, freq_total, mut_aa_mut) and coverage of newly processed samples, update the
+        support counts and re-evaluate the rare mutation filter of the mutations whose count changed.
+        Returns the ids of these mutations.
+        """
+        processed = set(self.processed)
+        self.processed += [sample_name for sample_name in sample_names if sample_name not in processed]
+        n_samples = len(self.nucleotide.samples)
+        self.nucleotide = self.nucleotide.append_samples(
+            MutationMatrix.from_calls(calls['sample'], calls['mut'], calls['freq_total'], sort=False))
+        self.amino_acid = self.amino_acid.append_samples(
+            MutationMatrix.from_calls(calls['sample'], calls['mut_aa_mut'], calls['freq_total'], sort=False))
+        self.__positions = MutationCatalog().positions(self.nucleotide.mutations)
+        self.__add_coverage(collected_coverage)
+
+        # support of the new samples only, the old samples have no calls of new mutations
+        new_samples = self.nucleotide.samples[n_samples:]
+        new_support = self.nucleotide_frequencies(samples=new_samples).count_above(self.settings['threshold_value'])
+        self.support = np.concatenate([self.support, np.zeros(len(new_support) - len(self.support), dtype=np.int64)])
+        self.kept = np.concatenate([self.kept, np.zeros(len(new_support) - len(self.kept), dtype=bool)])
+        changed = np.flatnonzero(new_support > 0)
+        self.support[changed] += new_support[changed]
+        self.kept[changed] = self.support[changed] >= self.settings['rare_mutation_limit_days']
+        return changed
+
+    def nucleotide_frequencies(self, samples=None, mutation_ids=None):
+        """
+        Nucleotide mutation frequencies of the given samples and mutation ids (all if None), with the coverage mask
+        of the coverage bits.
+        """
+        matrix = _take(self.nucleotide, samples, mutation_ids)
+        positions = self.__positions if mutation_ids is None else self.__positions[mutation_ids]
+        return matrix.with_coverage_mask(self.coverage_mask(matrix.samples, positions))
+
+    def amino_acid_frequencies(self, samples=None, mutation_ids=None):
+        """Amino acid mutation frequencies of the given samples and mutation ids (all if None)."""
+        return _take(self.amino_acid, samples, mutation_ids)
+
+    def coverage_mask(self, samples, positions):
+        """Packed samples x positions mask of sufficient coverage, samples without coverage are not covered."""
+        columns = np.asarray(positions, dtype=np.int64) - 1
+        known_columns = np.flatnonzero((columns >= 0) & (columns < self.genome_length))
+        covered = np.zeros((len(samples), len(columns)), dtype=bool)
+        rows = self.coverage_samples.get_indexer(samples)
+        known_rows = np.flatnonzero(rows >= 0)
+        if len(known_rows) and len(known_columns):
+            bits = np.unpackbits(self.coverage_bits[rows[known_rows]], axis=1, count=self.genome_length)
+            covered[np.ix_(known_rows, known_columns)] = bits[:, columns[known_columns]]
+        return np.packbits(covered, axis=1)
+
+    def __add_coverage(self, collected_coverage):
+        coverage_samples, coverage_matrix = collected_coverage
+        # only samples with calls and coverage not yet known
+        new_samples = self.nucleotide.samples[~self.nucleotide.samples.isin(self.coverage_samples)]
+        rows = coverage_samples.get_indexer(new_samples)
+        new_samples, rows = new_samples[rows >= 0], rows[rows >= 0]
+
+        # rows are packed from the first position on, a longer genome only pads the old rows with zero bytes
+        self.genome_length = max(self.genome_length, coverage_matrix.shape[1])
+        width = (self.genome_length + 7) // 8
+        new_bits = np.zeros((len(rows), self.genome_length), dtype=bool)
+        new_bits[:, :coverage_matrix.shape[1]] = coverage_matrix[rows] >= self.settings['coverage_threshold']
+        old_bits = np.pad(self.coverage_bits, ((0, 0), (0, width - self.coverage_bits.shape[1])))
+
+        self.coverage_samples = self.coverage_samples.append(new_samples)
+        self.coverage_bits = np.vstack([old_bits, np.packbits(new_bits, axis=1)])
+
+
+# matrix of the given samples (by label) and mutation ids, all if None
+def _take(matrix, samples, mutation_ids):
+    if samples is not None:
+        matrix = matrix.take_samples(matrix.samples.get_indexer(samples), samples=samples)
+    return matrix if mutation_ids is None else matrix.take_mutations(mutation_ids)
+
+
+def _empty_matrix():
+    return MutationMatrix([], [], [0], [], [])
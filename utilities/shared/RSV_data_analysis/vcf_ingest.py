@@ -0,0 +1,223 @@
+import bisect
+import glob
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pysam
+import instrumentation
+
+"""
+VCF ingestion shared by make_tallymut.py and make_mutation_tsv.py
+- read_vcf_columns function parses a single VCF into compact columnar arrays (pos int32, ref/alt codes, af float32)
+- read_vcf_columns_by_reference function does the same for several references (contigs) in a single pass over the VCF;
+  if only some windows or positions are needed (e.g. signature mutations, F gene) and the VCF is bgzipped and
+  tabix-indexed, just these regions are fetched, otherwise the whole file is scanned
+- columns_to_frame function turns the arrays of one sample back into the long data frame used by the scripts
+- process_multiple_vcfs function parses all VCFs matching a glob, optionally in a pool of worker processes (jobs > 1)
+  and reusing the arrays of unchanged VCFs from a parse_cache.ParseCache
+- process_multiple_vcfs_by_reference function does the same for several references, reading every VCF once
+"""
+
+# INFO fields written by annotate_vcf.py and needed for the amino acid mutations
+ANNOTATION_FIELDS = ['CodonPosition', 'RefAminoAcid', 'AltAminoAcid', 'Gene']
+
+
+# Extract the called mutations and their frequency values from a single VCF file
+def read_vcf_columns(vcf_path, reference, annotated=False, regions=None):
+    return read_vcf_columns_by_reference(vcf_path, [reference], annotated,
+                                         {reference: regions} if regions is not None else None)[reference]
+
+
+# Read a VCF once and route its records by contig, e.g. both references of the concatenated RSV-A/RSV-B reference.
+# regions optionally limits every reference to 1-based inclusive (start, end) windows (see positions_to_regions)
+def read_vcf_columns_by_reference(vcf_path, references, annotated=False, regions=None):
+    # Create a VariantFile object
+    vcf_file = pysam.VariantFile(vcf_path)
+
+    fields = ['pos', 'ref', 'alt', 'af'] + (ANNOTATION_FIELDS if annotated else [])
+    rows = {reference: {field: [] for field in fields} for reference in references}
+    regions = {reference: _as_windows(regions[reference]) for reference in references} if regions else None
+
+    if regions is not None and vcf_file.index is not None:
+        # bgzipped and indexed VCF: fetch only the requested windows of each reference
+        for reference in references:
+            if reference not in vcf_file.index:
+                continue
+            for start, end in regions[reference]:
+                for record in vcf_file.fetch(reference, start - 1, end):
+                    # records overlapping a window but starting before it belong to another window (or none)
+                    if start <= record.pos <= end:
+                        _add_record(rows[reference], record, annotated)
+    else:
+        # iterate over the records (variants) in the VCF file
+        for record in vcf_file:
+            reference_rows = rows.get(record.chrom)
+            if reference_rows is not None and (regions is None or _in_windows(record.pos, regions[record.chrom])):
+                _add_record(reference_rows, record, annotated)
+    # close the VCF file
+    vcf_file.close()
+
+    return {reference: _to_columns(reference_rows, annotated) for reference, reference_rows in rows.items()}
+
+
+def _add_record(rows, record, annotated):
+    # iterate over possible mutated positions
+    for record_alt in record.alts:
+        rows['pos'].append(record.pos)
+        rows['ref'].append(record.ref)
+        rows['alt'].append(record_alt)
+        # Take allele frequences (AF) from INFO
+        rows['af'].append(record.info.get('AF'))
+        if annotated:
+            rows['CodonPosition'].append(record.info.get('CodonPosition'))
+            rows['RefAminoAcid'].append(record.info.get('RefAminoAcid')[0])
+            rows['AltAminoAcid'].append(record.info.get('AltAminoAcid')[0])
+            rows['Gene'].append(record.info.get('Gene')[0])
+
+
+# Merge sorted positions (e.g. of signature mutations) into windows, so nearby positions are fetched together
+def positions_to_regions(positions, max_gap=0):
+    regions = []
+    for position in sorted(set(int(position) for position in positions)):
+        if regions and position - regions[-1][1] <= max_gap + 1:
+            regions[-1][1] = position
+        else:
+            regions.append([position, position])
+
+    return [tuple(region) for region in regions]
+
+
+def _as_windows(region):
+    # a (start, end) window, or a list of windows
+    if len(region) == 2 and all(isinstance(bound, (int, np.integer)) for bound in region):
+        return [tuple(region)]
+    return sorted(tuple(window) for window in region)
+
+
+def _in_windows(position, windows):
+    # windows are sorted and do not overlap
+    i = bisect.bisect_right(windows, (position, float('inf'))) - 1
+    return i >= 0 and windows[i][0] <= position <= windows[i][1]
+
+
+def _to_columns(rows, annotated):
+    # alleles (and annotation labels) are stored once, the records only keep integer codes into them
+    alleles, (ref_codes, alt_codes) = _encode([rows['ref'], rows['alt']])
+    columns = {'pos': np.array(rows['pos'], dtype=np.int32),
+               'ref': ref_codes,
+               'alt': alt_codes,
+               'alleles': alleles,
+               'af': np.array(rows['af'], dtype=np.float32)}
+    if annotated:
+        labels, (ref_aa_codes, alt_aa_codes, gene_codes) = _encode([rows['RefAminoAcid'], rows['AltAminoAcid'],
+                                                                    rows['Gene']])
+        columns.update({'CodonPosition': np.array(rows['CodonPosition'], dtype=np.float32),
+                        'RefAminoAcid': ref_aa_codes,
+                        'AltAminoAcid': alt_aa_codes,
+                        'Gene': gene_codes,
+                        'labels': labels})
+
+    return columns
+
+
+def _encode(value_lists):
+    # shared dictionary encoding of several lists of strings
+    codes, vocabulary = pd.factorize(np.array(sum(value_lists, []), dtype=object))
+    codes = codes.astype(np.int32)
+    split_at = np.cumsum([len(values) for values in value_lists])[:-1]
+
+    return np.asarray(vocabulary, dtype=object), np.split(codes, split_at)
+
+
+def columns_to_frame(columns, sample_name):
+    ''' function to convert the arrays of read_vcf_columns into a Pandas dataframe'''
+    df_out = pd.DataFrame({'sample': sample_name,
+                           'pos': columns['pos'],
+                           'ref': columns['alleles'][columns['ref']],
+                           'alt': columns['alleles'][columns['alt']],
+                           'af': columns['af']})
+    if 'labels' in columns:
+        df_out['CodonPosition'] = columns['CodonPosition']
+        for field in ANNOTATION_FIELDS[1:]:
+            df_out[field] = columns['labels'][columns[field]]
+
+    return df_out
+
+
+def _read_vcf_columns_task(task):
+    return read_vcf_columns_by_reference(*task)
+
+
+def _regions_digest(regions, reference):
+    if not regions:
+        return 'all'
+    return hashlib.sha1(repr(_as_windows(regions[reference])).encode()).hexdigest()
+
+
+# Iterate over multiple VCF files and use the name of the directory containing each file as the sample name
+def process_multiple_vcfs(input_dir, reference, annotated=False, jobs=1, cache=None, regions=None):
+    return process_multiple_vcfs_by_reference(input_dir, [reference], annotated, jobs, cache,
+                                              {reference: regions} if regions is not None else None)[reference]
+
+
+# VCF files matching a glob and their sample names (name of the directory containing each file)
+def list_vcf_files(input_dir):
+    vcf_files = glob.glob(input_dir, recursive=True)
+    return vcf_files, [vcf_file.split('/')[-5] for vcf_file in vcf_files]
+
+
+# Same as process_multiple_vcfs for several references, every VCF is read a single time.
+# If samples is given, only the VCFs of these samples are read
+def process_multiple_vcfs_by_reference(input_dir, references, annotated=False, jobs=1, cache=None, regions=None,
+                                       samples=None):
+    # get list of VCF files in the input directory
+    vcf_files, sample_names = list_vcf_files(input_dir)
+    if samples is not None:
+        samples = set(samples)
+        wanted = [i for i, sample_name in enumerate(sample_names) if sample_name in samples]
+        vcf_files, sample_names = [vcf_files[i] for i in wanted], [sample_names[i] for i in wanted]
+    instrumentation.count_files(vcf_files)
+
+    tasks = [(vcf_file, references, annotated, regions) for vcf_file in vcf_files]
+    # cache entries are per reference, so single- and multi-reference runs share them
+    cache_params = {reference: 'vcf|{0}|annotated={1}|regions={2}'.format(reference, annotated,
+                                                                         _regions_digest(regions, reference))
+                    for reference in references}
+    parsed = []
+    for vcf_file in vcf_files:
+        cached = {reference: cache.get(vcf_file, cache_params[reference]) if cache else None
+                  for reference in references}
+        parsed.append(cached if all(columns is not None for columns in cached.values()) else None)
+    # only new or changed VCFs are parsed
+    to_parse = [i for i, columns in enumerate(parsed) if columns is None]
+
+    if jobs > 1 and len(to_parse) > 1:
+        # workers only send back the compact arrays, the data frame is built here
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            newly_parsed = list(executor.map(_read_vcf_columns_task, [tasks[i] for i in to_parse],
+                                             chunksize=max(1, len(to_parse) // (4 * jobs))))
+    else:
+        newly_parsed = [_read_vcf_columns_task(tasks[i]) for i in to_parse]
+
+    for i, columns_by_reference in zip(to_parse, newly_parsed):
+        parsed[i] = columns_by_reference
+        if cache:
+            for reference, columns in columns_by_reference.items():
+                cache.put(vcf_files[i], cache_params[reference], columns)
+    if cache:
+        cache.save()
+
+    # concatenate all dataframes, per reference (an empty data frame if no VCF is read)
+    empty = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in
+                          [('sample', str), ('pos', np.int64), ('ref', str), ('alt', str), ('af', np.float32)] +
+                          ([('CodonPosition', np.int64)] + [(field, str) for field in ANNOTATION_FIELDS[1:]]
+                           if annotated else [])})
+    df_out = {}
+    for reference in references:
+        df_out[reference] = pd.concat([columns_to_frame(columns_by_reference[reference], sample_name)
+                                       for columns_by_reference, sample_name in zip(parsed, sample_names)],
+                                      axis=0, ignore_index=True) if parsed else empty
+        instrumentation.count(rows=len(df_out[reference]))
+
+    return df_out
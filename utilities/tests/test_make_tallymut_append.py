@@ -0,0 +1,61 @@
+import os
+import sys
+import shutil
+import subprocess
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import synthetic_season
+
+"""
+make_tallymut.py --append on a season whose results arrive in two steps: the timeline lists all samples from the
+start, samples without a coverage or VCF file yet are added by the second run
+"""
+
+MAKE_TALLYMUT = os.path.join(synthetic_season.SCRIPTS_DIR, 'make_tallymut.py')
+REFERENCE = 'EPI_ISL_412866'
+VCF_GLOB = 'season/results/*/*/variants/SNVs/snvs.vcf'
+COVERAGE_GLOB = 'season/results/*/*/alignments/coverage.tsv.gz'
+
+
+def make_tallymut(season_dir, output, *args):
+    return subprocess.run([sys.executable, MAKE_TALLYMUT, f'signatures_{REFERENCE}.csv', VCF_GLOB, COVERAGE_GLOB,
+                           'timeline.tsv', REFERENCE, '--output', output] + list(args),
+                          cwd=season_dir, capture_output=True, text=True, check=True)
+
+
+def read_tallymut(path):
+    # rows of the appended file follow the order of the runs, compared independent of it
+    tallymut = pd.read_csv(path, sep='\t', index_col=0)
+    return tallymut.sort_values(['sample', 'pos', 'base']).reset_index(drop=True)
+
+
+def test_append_samples_arriving_later(tmp_path):
+    season_dir = str(tmp_path)
+    synthetic_season.make_season(season_dir, 10, genome_length=2000, variants_per_sample=20, n_signatures=30,
+                                 seed=3, annotate=False)
+    make_tallymut(season_dir, 'full.tsv')
+
+    # the results of the later sampling days are not there yet at the first run
+    results_dir = os.path.join(season_dir, 'season', 'results')
+    pending_dir = os.path.join(season_dir, 'pending')
+    os.makedirs(pending_dir)
+    later_samples = sorted(os.listdir(results_dir))[-4:]
+    for sample in later_samples:
+        shutil.move(os.path.join(results_dir, sample), pending_dir)
+    make_tallymut(season_dir, 'append.tsv', '--append')
+    assert not set(later_samples) & set(read_tallymut(os.path.join(season_dir, 'append.tsv'))['sample'])
+
+    for sample in later_samples:
+        shutil.move(os.path.join(pending_dir, sample), results_dir)
+    second_run = make_tallymut(season_dir, 'append.tsv', '--append')
+    assert 'up to date' not in second_run.stderr
+
+    full = read_tallymut(os.path.join(season_dir, 'full.tsv'))
+    appended = read_tallymut(os.path.join(season_dir, 'append.tsv'))
+    assert set(later_samples) <= set(appended['sample'])
+    pd.testing.assert_frame_equal(appended, full)
+
+    # nothing left to add (the drop-outs of the synthetic season without results stay pending)
+    make_tallymut(season_dir, 'append.tsv', '--append')
+    pd.testing.assert_frame_equal(read_tallymut(os.path.join(season_dir, 'append.tsv')), full)